@@ -0,0 +1,102 @@
+'''
+直接解码到画布(compose_in_place)与先解码再粘贴两种合成方式的对比.
+
+对合成语料中的每张图片分别用两种方式输出, 逐字节比较输出文件, 并记录每张的耗时与峰值内存;
+旋转、缩小与非 JPEG 的图片不走直接解码, 同样参与比较, 用于确认没有误用快速路径. 任何输出不一致时以 1 退出.
+
+    python benchmarks/bench_compose.py --sizes 24,50
+
+每种方式在独立的子进程中单线程运行, 峰值内存互不影响.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from bench_pipeline import generate_corpus, peak_rss_bytes
+
+DEFAULT_SIZES = [12, 24]
+# (输出格式, 质量)
+DEFAULT_OUTPUTS = [('jpg', 100), ('jpg', 90), ('png', 100)]
+RESOLUTIONS = ['原图分辨率', '1080P']
+
+
+def _run_case(case: dict) -> dict:
+    import watermark
+
+    agent = watermark.WaterMarkAgent()
+    agent.compose_in_place = case['in_place']
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        start = time.perf_counter()
+        agent.run(case['input'], case['output'], case['format'], case['quality'], case['resolution'], 'thread', 1, use_index=False)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    return {'elapsed': elapsed, 'peak_rss': peak_rss_bytes()}
+
+
+def _spawn(case: dict) -> dict:
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _outputs(out_dir: str) -> dict:
+    ret = {}
+    if os.path.exists(out_dir):
+        for name in os.listdir(out_dir):
+            if name.startswith('Mark_'):
+                with open(os.path.join(out_dir, name), 'rb') as f:
+                    ret[name] = f.read()
+    return ret
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Compare in-place composition with the paste path.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, type=lambda s: [int(x) for x in s.split(',')], help='megapixels, comma separated')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'wm_bench_corpus'), help='corpus cache directory')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    if args.case:
+        print(json.dumps(_run_case(json.loads(args.case))))
+        return 0
+
+    corpus = generate_corpus(args.corpus, args.sizes, args.seed)
+    mismatched = 0
+    for size, in_dir in corpus.items():
+        for name in sorted(os.listdir(in_dir)):
+            if name.startswith('.') or name.startswith('noexif'):
+                continue
+            for out_format, quality in DEFAULT_OUTPUTS:
+                for resolution in RESOLUTIONS:
+                    results = {}
+                    work_dir = tempfile.mkdtemp(prefix='wm_compose_')
+                    try:
+                        for in_place in (False, True):
+                            case = {'input': os.path.join(in_dir, name), 'output': os.path.join(work_dir, str(in_place)), 'format': out_format, 'quality': quality, 'resolution': resolution, 'in_place': in_place}
+                            results[in_place] = _spawn(case)
+                        outputs = _outputs(os.path.join(work_dir, 'False'))
+                        same = outputs == _outputs(os.path.join(work_dir, 'True'))
+                    finally:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                    if not same:
+                        mismatched += 1
+                    paste, in_place = results[False], results[True]
+                    print(F"{size}mp/{name:<11} {out_format}/q{quality:<3} {resolution:<6}  paste {paste['elapsed']:6.2f}s {paste['peak_rss'] / 1024 / 1024:6.0f}MB  "
+                          F"in-place {in_place['elapsed']:6.2f}s {in_place['peak_rss'] / 1024 / 1024:6.0f}MB  {('identical' if outputs else 'no output') if same else 'MISMATCH'}")
+    return 1 if mismatched else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+'''
+编码预设的耗时与文件大小.
+
+从合成语料中取若干张图片, 先合成出带水印的画布, 再按每个预设与输出格式分别编码(不写文件),
+记录编码耗时的中位数、输出大小与每像素比特数. 当前环境没有编码器的格式跳过.
+
+    python benchmarks/bench_encode.py [--sizes 12] [--presets standard,web] [--formats jpg,webp] [--repeat 3] [--output encode.json]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import encoder
+from bench_pipeline import generate_corpus
+
+DEFAULT_SIZES = [12]
+# 语料中参与编码的图片
+DEFAULT_IMAGES = ['cam0.jpg', 'png0.png']
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Compare encode time and file size of the encoder presets.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, type=lambda s: [int(x) for x in s.split(',')], help='megapixels, comma separated')
+    parser.add_argument('--presets', default=list(encoder.PRESETS), type=lambda s: s.split(','), help='presets, comma separated')
+    parser.add_argument('--formats', default=list(encoder.OUT_FORMAT_CODECS), type=lambda s: s.split(','), help='output formats, comma separated')
+    parser.add_argument('--images', default=DEFAULT_IMAGES, type=lambda s: s.split(','), help='corpus files, comma separated')
+    parser.add_argument('--repeat', default=3, type=int, help='encodes per case, the median is reported')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'wm_bench_corpus'), help='corpus cache directory')
+    parser.add_argument('--output', default=None, help='write results JSON here')
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    import watermark
+    available = encoder.available_formats()
+    formats = [out_format for out_format in args.formats if out_format in available]
+    skipped = [out_format for out_format in args.formats if out_format not in available]
+    if skipped:
+        print(F"skipped (no encoder): {', '.join(skipped)}", file=sys.stderr)
+
+    agent = watermark.WaterMarkAgent()
+    results = []
+    print(F"{'image':<16} {'preset':<13} {'format':<6} {'encode':>9} {'size':>12} {'bpp':>6}")
+    for mp, corpus_dir in generate_corpus(args.corpus, args.sizes, args.seed).items():
+        for name in args.images:
+            path = os.path.join(corpus_dir, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 带水印的画布与原图中的 exif/ICC, 各预设共用
+            canvas = agent.render(data, out_format=None)
+            metadata = encoder.source_metadata(watermark.ingest.open_image(data))
+            pixels = canvas.width * canvas.height
+            for preset_name in args.presets:
+                preset = encoder.get_preset(preset_name)
+                for out_format in formats:
+                    times = []
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        out = encoder.encode(canvas, out_format, preset.quality, preset, *metadata)
+                        times.append(time.perf_counter() - start)
+                    result = {'image': F"{mp}mp/{name}", 'preset': preset_name, 'format': out_format, 'quality': preset.quality,
+                              'encode_seconds': round(statistics.median(times), 4), 'bytes': len(out), 'bits_per_pixel': round(8 * len(out) / pixels, 3)}
+                    results.append(result)
+                    print(F"{result['image']:<16} {preset_name:<13} {out_format:<6} {result['encode_seconds']:8.3f}s {len(out):12d} {result['bits_per_pixel']:6.2f}", flush=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
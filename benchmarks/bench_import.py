@@ -0,0 +1,82 @@
+'''
+冷启动导入耗时: 每种入口在新的解释器中以 -X importtime 运行多次, 取导入耗时的中位数(扣除解释器自身启动时的导入),
+并检查入口导入后没有提前加载 Pillow、pillow_heif、exifread、numpy 与多进程模块.
+
+    python benchmarks/bench_import.py [--runs 7] [--budget watermark=50,cli=60]
+
+worker 为多进程后端中工作进程的初始化(导入 watermark 并预加载字体与 logo), 以 spawn 方式启动的工作进程每个都要付出这部分开销.
+任何入口超过预算或加载了不应加载的模块时以 1 退出.
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+# 入口导入后不应出现的模块: 只在第一次渲染、解析 exif、遇到 HEIF 文件或使用多进程时加载
+HEAVY_MODULES = ['PIL', 'pillow_heif', 'exifread', 'numpy', 'multiprocessing', 'concurrent.futures.process']
+# 名称 -> (代码, 不应加载的模块, 默认预算毫秒)
+CASES = {
+    'watermark': ("import watermark", HEAVY_MODULES, 50),
+    'cli': ("import cli", HEAVY_MODULES, 60),
+    # 构造参数解析器(查看帮助、参数错误时)同样不应加载 Pillow; argparse 此时还会导入 locale 与 shutil, 约多 10ms
+    'cli_parser': ("import cli; cli.build_parser()", HEAVY_MODULES, 75),
+    'server': ("import server", ['pillow_heif', 'exifread', 'numpy', 'multiprocessing'], 120),
+    'worker': ("import watermark; watermark._init_worker({})", ['pillow_heif', 'exifread', 'numpy'], 120),
+}
+
+
+def _import_ms(stderr: str) -> float:
+    # 只累加最外层的导入, 其累计耗时已包含嵌套导入
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith('  '):
+            total += int(parts[1])
+    return total / 1000
+
+
+def run_case(code: str) -> tuple[float, list]:
+    # 最后一行输出为已加载的模块列表
+    code = F"{code}; import sys, json; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SRC_PATH, capture_output=True, text=True, check=True)
+    return _import_ms(result.stderr), json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Measure cold import time of the entry points.')
+    parser.add_argument('--runs', default=7, type=int)
+    parser.add_argument('--budget', default={}, type=lambda s: {k: float(v) for k, v in (item.split('=') for item in s.split(','))}, help='milliseconds per case, e.g. watermark=50,cli=60')
+    parser.add_argument('--cases', default=list(CASES), type=lambda s: s.split(','), help=','.join(CASES))
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    baseline = statistics.median(run_case("pass")[0] for _ in range(args.runs))
+    failed = 0
+    for name in args.cases:
+        code, forbidden, budget = CASES[name]
+        budget = args.budget.get(name, budget)
+        samples = []
+        loaded = set()
+        for _ in range(args.runs):
+            import_ms, modules = run_case(code)
+            samples.append(max(import_ms - baseline, 0.0))
+            loaded.update(m for m in modules if m in forbidden)
+        median = statistics.median(samples)
+        problems = []
+        if median > budget:
+            problems.append(F"over budget {budget:.0f}ms")
+        if loaded:
+            problems.append(F"loaded {', '.join(sorted(loaded))}")
+        failed += bool(problems)
+        print(F"{name:<10} median {median:7.1f}ms  min {min(samples):7.1f}ms  budget {budget:5.0f}ms  {'; '.join(problems) or 'ok'}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
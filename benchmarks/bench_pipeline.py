@@ -0,0 +1,333 @@
+'''
+WaterMarkAgent 性能基准.
+
+生成带 exif 的合成图片(JPEG/PNG/HEIC, 12/24/50/100 MP), 对 run 与 run2 在每种输出格式、质量与分辨率下
+分别计时, 记录吞吐量、单张延迟分位数与峰值内存, 结果保存为 JSON. run2 对没有 exif 的图片渲染 --run2-copies 次,
+延迟分位数来自多个样本.
+
+    python benchmarks/bench_pipeline.py --output results.json
+    python benchmarks/bench_pipeline.py --output new.json --compare results.json
+
+每个组合在独立的子进程中运行 --repeat 次, 峰值内存互不影响; 各指标取重复结果的中位数, --compare 比较的也是中位数. 语料按参数缓存在 --corpus 目录中, 重复运行时复用.
+'''
+import os
+import sys
+import json
+import math
+import time
+import statistics
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_PATH, 'src'))
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from profiling import percentile
+
+DEFAULT_SIZES = [12, 24, 50, 100]
+DEFAULT_QUALITIES = [100, 90]
+# 每个组合重复运行的次数与 run2 每次渲染的图片数
+DEFAULT_REPEAT = 3
+DEFAULT_RUN2_COPIES = 8
+# 按重复结果的中位数记录与比较的指标
+METRICS = ('elapsed', 'images_per_sec', 'latency_p50', 'latency_p95', 'latency_p99', 'peak_rss')
+CORPUS_VERSION = 1
+# (Make, Model, LensModel), 品牌均在 resources/logos 中
+CAMERAS = [
+    ('NIKON CORPORATION', 'NIKON Z 8', 'NIKKOR Z 24-120mm f/4 S'),
+    ('Canon', 'Canon EOS R5', 'RF24-70mm F2.8 L IS USM'),
+    ('SONY', 'ILCE-7RM5', 'FE 35mm F1.4 GM'),
+    ('FUJIFILM', 'GFX100S', 'GF63mmF2.8 R WR'),
+    ('Panasonic', 'DC-S1R', 'LUMIX S 50/F1.8'),
+    ('Leica Camera AG', 'LEICA M11', 'Summilux-M 1:1.4/35 ASPH.'),
+]
+XIAOMI = ('Xiaomi', 'xiaomi 13 ultra', 'XIAOMI 13 ULTRA', '')
+# 相对上一次结果变差超过该比例视为性能回退
+DEFAULT_THRESHOLD = 0.10
+
+
+def _vm_hwm_kb() -> int | None:
+    # Linux 上 ru_maxrss 会跨 exec 保留父进程的峰值, 以本进程地址空间的 VmHWM 为准
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = _vm_hwm_kb()
+    if own is None:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+def _make_exif(rng: random.Random, camera: tuple | None, gps: bool):
+    from PIL import Image
+
+    exif = Image.Exif()
+    if camera is None:
+        return exif
+    make, model, lens = camera[:3]
+    exif[0x010F] = make
+    exif[0x0110] = model
+    exif[0x011A] = 300
+    exif[0x011B] = 300
+    exif[0x013B] = 'bench'
+    sub = exif.get_ifd(0x8769)
+    sub[0x829A] = (1, rng.choice([60, 125, 250, 1000]))
+    sub[0x829D] = (rng.choice([14, 18, 28, 40, 80]), 10)
+    sub[0x8827] = rng.choice([100, 400, 1600, 6400])
+    sub[0x920A] = (rng.choice([24, 35, 50, 85]), 1)
+    sub[0xA405] = rng.choice([24, 35, 50, 85])
+    sub[0x9003] = '2024:06:01 18:30:00'
+    if lens:
+        sub[0xA434] = lens
+    if make == 'Xiaomi':
+        # 小米机型名称在 0x9A00 中
+        sub[0x9A00] = camera[1]
+    if gps:
+        gps_ifd = exif.get_ifd(0x8825)
+        gps_ifd[1] = 'N'
+        gps_ifd[2] = (31.0, 14.0, 12.34)
+        gps_ifd[3] = 'E'
+        gps_ifd[4] = (121.0, 28.0, 56.78)
+    return exif
+
+
+def _make_pixels(width: int, height: int, seed: int):
+    from PIL import Image
+
+    # 噪声 + 渐变, 压缩率接近真实照片
+    noise = Image.effect_noise((width, height), 48)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    bands = [noise, gradient, radial]
+    random.Random(seed).shuffle(bands)
+    return Image.merge('RGB', bands)
+
+
+def generate_corpus(corpus_dir: str, sizes: list, seed: int=0) -> dict:
+    '''
+    每个尺寸生成: 各品牌 JPEG(部分带 GPS 与方向标记)、小米 JPEG、PNG、HEIC 以及没有 exif 的 JPEG.
+    返回 {尺寸: 目录}.
+    '''
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        heif = True
+    except ImportError:
+        heif = False
+
+    dirs = {}
+    for mp in sizes:
+        out = os.path.join(corpus_dir, F"v{CORPUS_VERSION}_s{seed}_{mp}mp")
+        dirs[mp] = out
+        if os.path.exists(os.path.join(out, '.complete')):
+            continue
+        shutil.rmtree(out, ignore_errors=True)
+        os.makedirs(out)
+        rng = random.Random(seed * 1000 + mp)
+        width = int(math.sqrt(mp * 1e6 * 1.5))
+        height = int(width / 1.5)
+        pixels = _make_pixels(width, height, seed + mp)
+        for i, camera in enumerate(CAMERAS):
+            exif = _make_exif(rng, camera, gps=i % 2 == 0)
+            if i % 3 == 1:
+                exif[0x0112] = 6
+            pixels.save(os.path.join(out, F"cam{i}.jpg"), exif=exif.tobytes(), quality=92)
+        pixels.save(os.path.join(out, 'xiaomi.jpg'), exif=_make_exif(rng, XIAOMI, gps=True).tobytes(), quality=92)
+        pixels.save(os.path.join(out, 'png0.png'), exif=_make_exif(rng, CAMERAS[0], gps=False).tobytes())
+        if heif:
+            pixels.save(os.path.join(out, 'heic0.heic'), exif=_make_exif(rng, CAMERAS[2], gps=True).tobytes(), quality=90)
+        pixels.save(os.path.join(out, 'noexif.jpg'), quality=92)
+        open(os.path.join(out, '.complete'), 'w').close()
+    return dirs
+
+
+def _run_case(case: dict) -> dict:
+    import watermark
+
+    agent = watermark.WaterMarkAgent()
+    out_dir = tempfile.mkdtemp(prefix='wm_bench_')
+    latencies = []
+    statuses = {}
+
+    def on_job(job):
+        statuses[job.status] = statuses.get(job.status, 0) + 1
+        if job.ok:
+            latencies.append(job.elapsed)
+
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        start = time.perf_counter()
+        if case['mode'] == 'run':
+            exit_code, failed = agent.run(case['input'], out_dir, case['format'], case['quality'], case['resolution'], case['backend'], case['workers'], callback=on_job, use_index=False)
+            images = len(latencies)
+        else:
+            # 同一张图片渲染多次, 每次单独计时
+            files = [os.path.join(case['input'], name) for name in sorted(os.listdir(case['input'])) if name.startswith('noexif')] * case.get('copies', 1)
+            exit_code = 0
+            for file in files:
+                t = time.perf_counter()
+                agent.run2([file], 'Sony', 'ILCE-7RM5', 'FE 35mm F1.4 GM', out_dir, case['format'], case['quality'], case['resolution'])
+                latencies.append(time.perf_counter() - t)
+            images = len(files)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return {
+        'images': images,
+        'exit_code': exit_code,
+        'statuses': statuses,
+        'elapsed': elapsed,
+        'images_per_sec': images / elapsed if elapsed > 0 else 0.0,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'peak_rss': peak_rss_bytes(),
+    }
+
+
+def summarize(runs: list) -> dict:
+    '''
+    同一组合多次运行的结果: METRICS 取中位数, 每次的原始结果保存在 runs 中.
+    '''
+    result = {key: statistics.median(run[key] for run in runs) for key in METRICS}
+    result.update(images=runs[0]['images'], exit_code=runs[0]['exit_code'], statuses=runs[0]['statuses'], repeat=len(runs), runs=runs)
+    return result
+
+
+def case_name(case: dict) -> str:
+    return F"{case['mode']}/{case['size']}mp/{case['format']}/q{case['quality']}/{case['resolution']}"
+
+
+def run_benchmarks(args) -> dict:
+    import watermark
+
+    corpus = generate_corpus(args.corpus, args.sizes, args.seed)
+    cases = []
+    for size in args.sizes:
+        for mode in args.modes:
+            for out_format in args.formats:
+                for quality in args.qualities:
+                    for resolution in watermark.OUT_RESOLUTION.keys():
+                        cases.append({'mode': mode, 'size': size, 'input': corpus[size], 'format': out_format, 'quality': quality, 'resolution': resolution, 'backend': args.backend, 'workers': args.workers, 'copies': args.run2_copies})
+
+    results = {}
+    for case in cases:
+        name = case_name(case)
+        runs = []
+        for _ in range(args.repeat):
+            # 子进程中运行, 峰值内存只包含本组合
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case, ensure_ascii=False)], capture_output=True, text=True, encoding='utf-8')
+            if proc.returncode != 0:
+                print(F"{name}: failed\n{proc.stderr}", file=sys.stderr)
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        if len(runs) < args.repeat:
+            continue
+        results[name] = summarize(runs)
+        r = results[name]
+        print(F"{name:<40} {r['images_per_sec']:7.2f} img/s  p50 {r['latency_p50'] * 1000:8.1f}ms  p95 {r['latency_p95'] * 1000:8.1f}ms  rss {r['peak_rss'] / 1024 / 1024:7.0f}MB", file=sys.stderr)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'backend': args.backend,
+            'workers': args.workers,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'run2_copies': args.run2_copies,
+        },
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    '''
+    返回回退项列表: (组合, 指标, 基准值, 当前值).
+    比较各组合重复结果的中位数, 吞吐量下降、延迟或内存上升超过 threshold 视为回退.
+    '''
+    regressions = []
+    for name, base in baseline['results'].items():
+        cur = current['results'].get(name)
+        if cur is None:
+            continue
+        if base['images_per_sec'] > 0 and cur['images_per_sec'] < base['images_per_sec'] * (1 - threshold):
+            regressions.append((name, 'images_per_sec', base['images_per_sec'], cur['images_per_sec']))
+        for metric in ('latency_p50', 'latency_p95', 'peak_rss'):
+            if base[metric] > 0 and cur[metric] > base[metric] * (1 + threshold):
+                regressions.append((name, metric, base[metric], cur[metric]))
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    import watermark
+
+    parser = argparse.ArgumentParser(description='Benchmark the watermark pipeline.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, type=lambda s: [int(x) for x in s.split(',')], help='megapixels, comma separated')
+    parser.add_argument('--formats', default=['jpg', 'png'], type=lambda s: s.split(','), help='output formats, comma separated; also ' + ', '.join(watermark.SUPPORT_OUT_FORMAT[2:]))
+    parser.add_argument('--qualities', default=DEFAULT_QUALITIES, type=lambda s: [int(x) for x in s.split(',')], help='output qualities, comma separated')
+    parser.add_argument('--modes', default=['run', 'run2'], type=lambda s: s.split(','), help='run, run2')
+    parser.add_argument('--backend', default='auto', choices=watermark.SUPPORT_BACKEND)
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--repeat', default=DEFAULT_REPEAT, type=int, help='runs per case; the median of each metric is recorded and compared')
+    parser.add_argument('--run2-copies', default=DEFAULT_RUN2_COPIES, type=int, help='times the photo without exif is rendered in each run2 case')
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'wm_bench_corpus'), help='corpus cache directory')
+    parser.add_argument('--output', default=None, help='write results JSON here')
+    parser.add_argument('--compare', default=None, help='baseline results JSON')
+    parser.add_argument('--threshold', default=DEFAULT_THRESHOLD, type=float, help='allowed relative regression')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    if args.case:
+        print(json.dumps(_run_case(json.loads(args.case))))
+        return 0
+
+    current = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, metric, base, cur in regressions:
+            print(F"REGRESSION {name} {metric}: {base:.4g} -> {cur:.4g}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(F"no regressions against {args.compare}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
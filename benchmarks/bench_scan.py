@@ -0,0 +1,68 @@
+'''
+目录扫描耗时: 在临时目录中生成多层目录树, 比较 os.walk 与 scanner.Scanner 在不同线程数下的耗时, 并检查结果一致.
+--latency 为每次列目录额外等待的毫秒数, 用于模拟网络存储.
+
+    python benchmarks/bench_scan.py [--dirs 1000] [--files 60] [--latency 5] [--workers 1,8,32]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import scanner
+
+EXTENSIONS = ['.jpg', '.JPG', '.jpeg', '.png', '.heic', '.txt', '.xmp']
+
+
+def build_tree(root: str, dirs: int, files: int) -> None:
+    for i in range(dirs):
+        path = os.path.join(root, F"d{i % 40}", F"s{i}")
+        os.makedirs(path)
+        for j in range(files):
+            open(os.path.join(path, F"f{j}{EXTENSIONS[j % len(EXTENSIONS)]}"), 'wb').close()
+
+
+def walk(root: str) -> list:
+    return [os.path.join(path, name) for path, _, names in os.walk(root) for name in names if scanner.has_image_extension(name)]
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Compare os.walk with the parallel scanner.')
+    parser.add_argument('--dirs', default=1000, type=int)
+    parser.add_argument('--files', default=60, type=int, help='files per folder')
+    parser.add_argument('--latency', default=0.0, type=float, help='extra milliseconds per folder listing')
+    parser.add_argument('--workers', default=[1, 8, 32], type=lambda s: [int(n) for n in s.split(',')])
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    root = tempfile.mkdtemp(prefix='bench_scan_')
+    try:
+        build_tree(root, args.dirs, args.files)
+        if args.latency > 0:
+            scandir = os.scandir
+            def slow_scandir(path='.'):
+                time.sleep(args.latency / 1000)
+                return scandir(path)
+            os.scandir = slow_scandir
+        start = time.perf_counter()
+        expected = sorted(walk(root))
+        print(F"{'os.walk':<12} {time.perf_counter() - start:8.3f}s  {len(expected)} photos")
+        failed = 0
+        for workers in args.workers:
+            start = time.perf_counter()
+            found = sorted(scanner.Scanner(workers).scan(root))
+            elapsed = time.perf_counter() - start
+            failed += found != expected
+            print(F"{F'scanner x{workers}':<12} {elapsed:8.3f}s  {len(found)} photos  {'ok' if found == expected else 'MISMATCH'}")
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
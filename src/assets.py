@@ -0,0 +1,133 @@
+import os
+import io
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from PIL import Image, ImageFont
+
+ROOT_PATH = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+FONTS_PATH = os.path.join(ROOT_PATH, 'resources', 'fonts')
+LOGOS_PATH = os.path.join(ROOT_PATH, 'resources', 'logos')
+
+# 字体文件内容与原始 logo 在进程内只读取一次, 渲染线程/进程共享
+_lock = threading.Lock()
+_font_data = {}
+_logo_sources = {}
+
+
+class LRUCache(object):
+    '''
+    线程安全的 LRU 缓存, 统计命中/未命中次数.
+    '''
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, factory: Callable):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+        # 在锁外创建, 避免阻塞其他线程; 并发未命中时以先写入的为准
+        value = factory()
+        with self._lock:
+            if key in self._data:
+                return self._data[key]
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def peek(self, key: Hashable):
+        # 只查询, 不创建也不计入命中统计; 没有时返回 None
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+# (字体文件, 字号) -> 字体; (品牌, 边长) -> (logo, alpha 通道)
+FONT_CACHE = LRUCache(32)
+LOGO_CACHE = LRUCache(64)
+
+
+def _read_font_data(font_file: str) -> bytes:
+    data = _font_data.get(font_file)
+    if data is None:
+        with _lock:
+            data = _font_data.get(font_file)
+            if data is None:
+                with open(font_file, 'rb') as f:
+                    data = f.read()
+                _font_data[font_file] = data
+    return data
+
+
+def load_font(font_file: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(io.BytesIO(_read_font_data(font_file)), size)
+
+
+def load_logo(brand: str) -> Image.Image | None:
+    # 返回共享的 RGBA logo, 调用方不可修改; logo 不存在时返回 None
+    if brand in _logo_sources:
+        return _logo_sources[brand]
+    with _lock:
+        if brand not in _logo_sources:
+            logo_file = os.path.join(LOGOS_PATH, F"{brand}.png")
+            if os.path.exists(logo_file):
+                with Image.open(logo_file) as logo_img:
+                    _logo_sources[brand] = logo_img.convert("RGBA")
+            else:
+                _logo_sources[brand] = None
+        return _logo_sources[brand]
+
+
+def get_font(font_file: str, size: int) -> ImageFont.FreeTypeFont:
+    return FONT_CACHE.get((font_file, size), lambda: load_font(font_file, size))
+
+
+def _scale_logo(brand: str, content_height: int) -> tuple[Image.Image, Image.Image] | None:
+    logo_src = load_logo(brand)
+    if logo_src is None:
+        return None
+    logo_img = logo_src.resize((content_height, content_height), Image.LANCZOS)
+    r, g, b, a = logo_img.split()
+    return logo_img, a
+
+
+def get_logo(brand: str, content_height: int) -> tuple[Image.Image, Image.Image] | None:
+    # 返回缩放好的 logo 与粘贴用的 mask, 两者共享只读; logo 不存在时返回 None
+    return LOGO_CACHE.get((brand, content_height), lambda: _scale_logo(brand, content_height))
+
+
+def cache_stats() -> dict:
+    return {'fonts': FONT_CACHE.stats(), 'logos': LOGO_CACHE.stats()}
+
+
+def preload() -> None:
+    if os.path.isdir(FONTS_PATH):
+        for file in os.listdir(FONTS_PATH):
+            if os.path.splitext(file)[-1].lower() in ('.ttf', '.otf'):
+                _read_font_data(os.path.join(FONTS_PATH, file))
+    if os.path.isdir(LOGOS_PATH):
+        for file in os.listdir(LOGOS_PATH):
+            name, ext = os.path.splitext(file)
+            if ext == '.png':
+                load_logo(name)
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+
+import encoder
+import watermark
+import scheduler
+from pipeline import RenderJob
+from profiling import Profiler
+from scanner import Scanner, DEFAULT_WORKERS
+from watcher import WatchService, SETTLE_TIME, POLL_INTERVAL
+
+
+class EventWriter(object):
+    '''
+    以 JSON lines 输出进度事件, 每行一个事件.
+    '''
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.start = time.perf_counter()
+        # 监视模式下指标事件来自另一个线程
+        self._lock = threading.Lock()
+
+    def emit(self, event: str, **fields) -> None:
+        fields = {'event': event, 't': round(time.perf_counter() - self.start, 4), **fields}
+        with self._lock:
+            self.stream.write(json.dumps(fields, ensure_ascii=False) + '\n')
+            self.stream.flush()
+
+    def job(self, job: RenderJob) -> None:
+        fields = {}
+        if hasattr(job.timer, 'stages'):
+            fields['stages'] = {name: round(seconds, 4) for name, seconds in job.timer.stages.items()}
+            fields['counters'] = job.timer.counters
+            if job.timer.trace_memory:
+                fields['peak_bytes'] = job.timer.peak_bytes
+        self.emit('file', index=job.index, path=job.image_file, status=job.status, output=job.out_file, error=job.error, elapsed=round(job.elapsed, 4), **fields)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='cli.py', description='Add Mi&Leica style watermark to photos without the GUI.')
+    parser.add_argument('input', nargs='+', help='photo file or folder; with --watch, one or more folders')
+    parser.add_argument('-o', '--output', default=watermark.DEFAULT_OUT_DIR, help='output folder')
+    parser.add_argument('-f', '--format', default='jpg', choices=list(watermark.OUT_FORMAT_CODECS), help='output format; webp/avif/heif need a Pillow build that can encode them')
+    parser.add_argument('-q', '--quality', default=None, type=int, help='output quality (1-100), defaults to the preset\'s quality')
+    parser.add_argument('-p', '--preset', default=encoder.DEFAULT_PRESET, choices=list(encoder.PRESETS), help='encoder settings: standard (same as before), fast-preview, web or archive (keeps exif and ICC profile)')
+    parser.add_argument('-r', '--resolution', default='original', choices=list(watermark.OUT_RESOLUTION.keys()) + list(watermark.RESOLUTION_ALIASES.keys()), help='output resolution')
+    parser.add_argument('-j', '--workers', default=None, type=int, help='worker count, defaults to the CPU count')
+    parser.add_argument('-b', '--backend', default='auto', choices=watermark.SUPPORT_BACKEND, help='execution backend')
+    parser.add_argument('--memory-budget', default=None, help='memory allowed for photos in flight, e.g. 8G; 0 for no limit; defaults to half of the physical memory')
+    parser.add_argument('--lossless', action='store_true', help='for jpg at original resolution, keep the photo\'s JPEG data and only encode the watermark band (ignores --quality; photos that do not allow it are rendered normally)')
+    parser.add_argument('--encode-workers', default=None, type=int, help='threads for the encode stage of the thread backend, defaults to --workers')
+    parser.add_argument('--tile-threshold', default=watermark.TILED_THRESHOLD / 1e6, type=float, metavar='MP', help='photos of at least this many megapixels are decoded, composed and encoded in strips at original resolution, so memory does not grow with the image area; 0 to disable')
+    parser.add_argument('--incremental', action='store_true', help='skip photos whose output is up to date')
+    parser.add_argument('--profile', action='store_true', help='report per-stage timings')
+    parser.add_argument('--sniff', action='store_true', help='identify photos by their file header instead of the extension')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB', help='only render files whose name or relative path matches; may be repeated')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB', help='skip files and folders whose name or relative path matches; may be repeated')
+    parser.add_argument('--max-depth', default=None, type=int, help='how many levels of subfolders to scan; 0 for the input folder only')
+    parser.add_argument('--scan-workers', default=DEFAULT_WORKERS, type=int, help='threads listing folders in parallel')
+    parser.add_argument('--watch', action='store_true', help='keep running and render photos as they are added to or changed in the input folders (implies --incremental)')
+    parser.add_argument('--settle', default=SETTLE_TIME, type=float, help='with --watch, seconds a file must stay unchanged before it is rendered')
+    parser.add_argument('--poll', action='store_true', help='with --watch, scan the folders periodically instead of using inotify')
+    parser.add_argument('--poll-interval', default=POLL_INTERVAL, type=float, help='with --watch, seconds between scans when polling')
+    parser.add_argument('--metrics-interval', default=0, type=float, help='with --watch, emit a metrics event every N seconds; 0 to disable')
+    parser.add_argument('--trace-memory', action='store_true', help='with --profile, also record the tracemalloc peak per photo')
+    return parser
+
+
+def main(argv: list | None=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.quality is None:
+        args.quality = encoder.PRESETS[args.preset].quality
+    if not 1 <= args.quality <= 100:
+        print("quality must be between 1 and 100", file=sys.stderr)
+        return 2
+    # 查询编码器需要导入 Pillow, 在参数解析之后才检查, 查看帮助或参数错误时不加载
+    if args.format not in watermark.SUPPORT_OUT_FORMAT:
+        print(F"{args.format} output is not supported by this Pillow build, available: {', '.join(watermark.SUPPORT_OUT_FORMAT)}", file=sys.stderr)
+        return 2
+    resolution_key = watermark.RESOLUTION_ALIASES.get(args.resolution, args.resolution)
+    if args.memory_budget is not None:
+        try:
+            memory_budget = scheduler.parse_size(args.memory_budget)
+        except ValueError:
+            print(F"invalid memory budget: {args.memory_budget}", file=sys.stderr)
+            return 2
+    if args.watch:
+        missing = [d for d in args.input if not os.path.isdir(d)]
+        if missing:
+            print(F"not a folder: {', '.join(missing)}", file=sys.stderr)
+            return 2
+    elif len(args.input) != 1:
+        print("only one input is allowed without --watch", file=sys.stderr)
+        return 2
+
+    # stdout 只用于事件; 日志(包括工作进程的输出)改写到 stderr
+    sys.stdout.flush()
+    events = EventWriter(os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8'))
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    agent = watermark.WaterMarkAgent()
+    if args.memory_budget is not None:
+        agent.memory_budget = memory_budget
+    agent.lossless_jpeg = args.lossless
+    agent.encode_preset = args.preset
+    agent.encode_workers = args.encode_workers
+    agent.tiled_threshold = int(args.tile_threshold * 1e6) if args.tile_threshold > 0 else None
+    agent.scanner = Scanner(args.scan_workers, args.sniff, args.include, args.exclude, args.max_depth)
+    if args.profile:
+        agent.profiler = Profiler(trace_memory=args.trace_memory)
+    if args.watch:
+        return watch(args, agent, events, resolution_key)
+
+    counts = {}
+    def on_job(job: RenderJob):
+        counts[job.status] = counts.get(job.status, 0) + 1
+        events.job(job)
+
+    events.emit('start', input=args.input[0], output=args.output, format=args.format, quality=args.quality, preset=args.preset, resolution=resolution_key, backend=args.backend, workers=args.workers)
+    exit_code, failed = agent.run(args.input[0], args.output, args.format, args.quality, resolution_key, args.backend, args.workers, incremental=args.incremental, callback=on_job)
+    total = sum(counts.values())
+    elapsed = time.perf_counter() - events.start
+    if agent.profiler is not None:
+        events.emit('profile', **agent.profiler.report())
+    memory = {key: value for key, value in agent.memory_report.items() if key != 'summary'}
+    events.emit('done', exit_code=exit_code, total=total, counts=counts, failed=failed, memory=memory, elapsed=round(elapsed, 4), images_per_sec=round(total / elapsed, 3) if elapsed > 0 else 0)
+    return exit_code
+
+
+def watch(args: argparse.Namespace, agent: watermark.WaterMarkAgent, events: EventWriter, resolution_key: str) -> int:
+    service = WatchService(agent, args.input, args.output, args.format, args.quality, resolution_key, args.workers, args.settle, args.poll_interval, not args.poll, callback=events.job)
+    # SIGINT/SIGTERM 时停止接收新文件, 等在途的图片完成后退出
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: service.stop())
+
+    def report_metrics():
+        while not service.stop_event.wait(args.metrics_interval):
+            events.emit('metrics', **service.metrics())
+    if args.metrics_interval > 0:
+        threading.Thread(target=report_metrics, daemon=True).start()
+
+    events.emit('start', input=args.input, output=args.output, format=args.format, quality=args.quality, preset=args.preset, resolution=resolution_key, backend='thread', workers=args.workers, watch=service.watcher.mode)
+    service.run()
+    if agent.profiler is not None:
+        events.emit('profile', **agent.profiler.report())
+    events.emit('done', exit_code=0, metrics=service.metrics())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import io
+import struct
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+import ingest
+
+# Pillow 在第一次编码时才导入
+if TYPE_CHECKING:
+    from PIL import Image
+
+# 输出格式 -> Pillow 的编码器名; 直接指定, 不必为查询扩展名加载全部格式插件
+OUT_FORMAT_CODECS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'avif': 'AVIF', 'heif': 'HEIF'}
+# 写入输出的分辨率
+DPI = (300, 300)
+# JPEG 的 APP1 标记段最长 65535 字节, 去掉长度字段后 exif 不能超过该长度
+MAX_JPEG_EXIF = 65533
+ORIENTATION_TAG = 0x0112
+# 各编码器的速度/压缩率取舍: 'fast' / 'balanced' / 'best' -> 保存参数
+EFFORT_OPTIONS = {
+    'webp': {'fast': {'method': 0}, 'balanced': {'method': 4}, 'best': {'method': 6}},
+    # speed 越小越慢, 2 以下对大图慢到不可用
+    'avif': {'fast': {'speed': 10}, 'balanced': {'speed': 7}, 'best': {'speed': 4}},
+    # x265 的 preset
+    'heif': {'fast': {'enc_params': {'preset': 'ultrafast'}}, 'balanced': {'enc_params': {'preset': 'veryfast'}}, 'best': {'enc_params': {'preset': 'slow'}}},
+}
+# Pillow 的 subsampling 参数 -> AVIF/HEIF 的写法
+_SUBSAMPLING_NAMES = {0: '4:4:4', 1: '4:2:2', 2: '4:2:0'}
+
+
+class EncodePreset(object):
+    '''
+    输出编码参数. quality 为未指定质量时使用的默认值; subsampling: 0=4:4:4, 1=4:2:2, 2=4:2:0, None 为编码器默认;
+    compress_level: PNG 的 zlib 压缩级别, None 为 Pillow 默认(6); effort: WebP/AVIF/HEIF 的速度取舍, 见 EFFORT_OPTIONS;
+    exif/icc: 是否保留原图的 exif 与 ICC 描述文件.
+    '''
+    __slots__ = ('name', 'quality', 'subsampling', 'optimize', 'progressive', 'compress_level', 'effort', 'exif', 'icc')
+
+    def __init__(self, name: str, quality: int, subsampling: int | None=None, optimize: bool=False, progressive: bool=False, compress_level: int | None=None, effort: str='balanced', exif: bool=False, icc: bool=False) -> None:
+        self.name = name
+        self.quality = quality
+        self.subsampling = subsampling
+        self.optimize = optimize
+        self.progressive = progressive
+        self.compress_level = compress_level
+        self.effort = effort
+        self.exif = exif
+        self.icc = icc
+
+    @property
+    def keeps_metadata(self) -> bool:
+        return self.exif or self.icc
+
+    def save_options(self, out_format: str, quality: int, exif: bytes | None=None, icc_profile: bytes | None=None) -> dict:
+        '''
+        返回传给 Image.save 的参数. exif/icc_profile 为原图中的数据, 按预设决定是否写入.
+        '''
+        options = {'format': OUT_FORMAT_CODECS[out_format], 'dpi': DPI, 'quality': quality}
+        if out_format == 'jpg':
+            if self.subsampling is not None:
+                options['subsampling'] = self.subsampling
+            if self.optimize:
+                options['optimize'] = True
+            if self.progressive:
+                options['progressive'] = True
+        elif out_format == 'png':
+            if self.compress_level is not None:
+                options['compress_level'] = self.compress_level
+        else:
+            # pillow_heif 会改写传入的 enc_params, 复制一份
+            options.update({key: dict(value) if isinstance(value, dict) else value for key, value in EFFORT_OPTIONS[out_format][self.effort].items()})
+            if out_format in ('avif', 'heif') and self.subsampling is not None:
+                options['subsampling'] = _SUBSAMPLING_NAMES[self.subsampling]
+        if self.exif and exif:
+            exif = upright_exif(exif)
+            if out_format != 'jpg' or len(exif) <= MAX_JPEG_EXIF:
+                options['exif'] = exif
+        if self.icc and icc_profile:
+            options['icc_profile'] = icc_profile
+        return options
+
+
+# standard 与此前的输出完全相同
+DEFAULT_PRESET = 'standard'
+PRESETS = {
+    'standard': EncodePreset('standard', 100),
+    'fast-preview': EncodePreset('fast-preview', 75, subsampling=2, compress_level=1, effort='fast', icc=True),
+    'web': EncodePreset('web', 85, subsampling=2, optimize=True, progressive=True, compress_level=6, effort='balanced', icc=True),
+    'archive': EncodePreset('archive', 95, subsampling=0, optimize=True, compress_level=9, effort='best', exif=True, icc=True),
+}
+
+
+def get_preset(name: str | None) -> EncodePreset:
+    if name is None:
+        return PRESETS[DEFAULT_PRESET]
+    if name not in PRESETS:
+        raise ValueError(F"Unsupported preset: {name}")
+    return PRESETS[name]
+
+
+def upright_exif(exif: bytes) -> bytes:
+    '''
+    输出已按方向转正, 把 IFD0 中的方向改为 1, 并断开指向 IFD1(缩略图)的链接, 缩略图不含水印.
+    只修改这几个字节, 不重新解析与序列化 exif; 格式不符时原样返回. 返回值带 'Exif' 前缀.
+    '''
+    tiff = exif.removeprefix(b'Exif\x00\x00')
+    if tiff[:4] == b'II*\x00':
+        order = '<'
+    elif tiff[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        return exif
+    try:
+        data = bytearray(tiff)
+        ifd0 = struct.unpack_from(order + 'I', data, 4)[0]
+        count = struct.unpack_from(order + 'H', data, ifd0)[0]
+        for i in range(count):
+            entry = ifd0 + 2 + 12 * i
+            tag, kind = struct.unpack_from(order + 'HH', data, entry)
+            # 方向为 SHORT, 值直接保存在条目中
+            if tag == ORIENTATION_TAG and kind == 3:
+                struct.pack_into(order + 'H', data, entry + 8, 1)
+        struct.pack_into(order + 'I', data, ifd0 + 2 + 12 * count, 0)
+    except struct.error:
+        return exif
+    return b'Exif\x00\x00' + bytes(data)
+
+
+def source_metadata(img: 'Image.Image') -> tuple[bytes | None, bytes | None]:
+    '''
+    原图中未经解析的 exif 与 ICC 描述文件, 由 Pillow 在读取文件头时取出.
+    '''
+    return img.info.get('exif'), img.info.get('icc_profile')
+
+
+def encode(img: 'Image.Image', out_format: str, quality: int, preset: EncodePreset | None=None, exif: bytes | None=None, icc_profile: bytes | None=None) -> bytes:
+    if preset is None:
+        preset = PRESETS[DEFAULT_PRESET]
+    if out_format == 'heif':
+        ingest.register_heif()
+    options = preset.save_options(out_format, quality, exif, icc_profile)
+    buffer = io.BytesIO()
+    try:
+        img.save(buffer, **options)
+    except KeyError:
+        # 当前的 Pillow 没有该格式的编码器
+        raise ValueError(F"{out_format} output is not supported by this Pillow build")
+    return buffer.getvalue()
+
+
+def available_formats() -> list[str]:
+    '''
+    当前的 Pillow(与 pillow_heif)能够编码的输出格式, 按 OUT_FORMAT_CODECS 的顺序; 第一次调用时导入 Pillow, 结果缓存.
+    '''
+    return list(_available_formats())
+
+
+@lru_cache(maxsize=1)
+def _available_formats() -> tuple[str, ...]:
+    from PIL import Image
+    try:
+        ingest.register_heif()
+    except ImportError:
+        pass
+    Image.init()
+    return tuple(out_format for out_format, codec in OUT_FORMAT_CODECS.items() if codec in Image.SAVE)
@@ -1,42 +1,74 @@
 import os
 import sys
 import datetime
-from threading import Thread
+from itertools import islice
 
-from PySide6.QtCore import QObject, Signal
-from PySide6.QtGui import QIcon, QGuiApplication, QTextCursor
-from PySide6.QtWidgets import QMainWindow, QApplication, QWidget, QGridLayout, QLineEdit, QComboBox, QLabel, QFileDialog, QPushButton, QTextEdit, QSpinBox, QDialog, QDialogButtonBox, QMessageBox
+from PySide6.QtCore import Qt, Signal, QTimer
+from PySide6.QtGui import QIcon, QGuiApplication, QImage, QPixmap
+from PySide6.QtWidgets import QMainWindow, QApplication, QWidget, QGridLayout, QLineEdit, QComboBox, QLabel, QFileDialog, QPushButton, QPlainTextEdit, QProgressBar, QSpinBox, QDoubleSpinBox, QDialog, QDialogButtonBox, QMessageBox
 
 import watermark
+from jobs import JobController, BatchRun, CANCELLED
+from logsink import LogSink, LOG_MAX_LINES
+from preview import Preview, PreviewRenderer
+
+# 日志与进度的刷新间隔(毫秒), 约 30 帧每秒
+REFRESH_INTERVAL = 33
+# 设置改变后等待多久再渲染预览(毫秒), 连续调整时只渲染最后一次
+PREVIEW_DELAY = 30
+# 预览下拉框中最多列出的照片数
+PREVIEW_MAX_FILES = 1000
+# 可在界面中调整的比例: 属性 -> (名称, 最小值, 最大值, 步长)
+RATIO_INPUTS = {
+    'margin_ratio': ("边距比例", 0.0, 0.2, 0.005),
+    'watermark_ratio': ("水印高度", 0.02, 0.5, 0.01),
+    'font_1_ratio': ("第一行字号", 0.1, 1.0, 0.02),
+    'font_2_ratio': ("第二行字号", 0.1, 1.0, 0.02),
+}
 
 class MyMainWindow(QMainWindow):
-    stage2_needed = Signal(list)
+    run_finished = Signal(object)
+    preview_ready = Signal(object)
 
     def __init__(self):
         super().__init__()
         screen = QGuiApplication.primaryScreen().geometry()
         self.setWindowTitle('MiLeicaStyleWatermark')
-        self.setFixedSize(int(screen.width()/2.6), int(screen.height()/3))
+        # 右侧为预览区
+        self.setFixedSize(int(screen.width()/1.4), int(screen.height()/2))
         icon = QIcon()
         icon.addFile(os.path.join(watermark.ROOT_PATH, "resources", "icons", "watermark.png"))
         self.setWindowIcon(icon)
         self.central_widget = QWidget(self)
         self.setCentralWidget(self.central_widget)
+        self.agent = watermark.WaterMarkAgent()
+        # 预览在后台线程中以低分辨率渲染, 使用各自的比例, 不影响正在运行的批次
+        self.preview = PreviewRenderer(box=(int(screen.width()/3), int(screen.height()/2.6)))
+        self.preview_files = []
+        self.preview_key = None
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.timeout.connect(self._update_preview_event)
         self._init_ui()
         # self._init_signal()
         self._connect()
-        self.agent = watermark.WaterMarkAgent()
+        # 批次在后台线程中运行, 界面线程只负责提交、暂停与取消
+        self.jobs = JobController(self.agent, backend='thread')
+        self.run = None
+
+        # 工作线程只向 log 写入, 由界面线程中的定时器按固定帧率取出并显示
+        self.log = LogSink()
+        sys.stdout = self.log
+        sys.stderr = self.log
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self._refresh_event)
+        self.refresh_timer.start(REFRESH_INTERVAL)
 
-        self.stream = Stream()
-        self.stream.stream_update.connect(self._write_log_info)
-        sys.stdout = self.stream
-        sys.stderr = self.stream
-
-        self.stream_update_state = 0
         print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] MiLeicaStyleWatermark start!")
 
     def _init_ui(self):
-        cols = 7
+        # 左侧 7 列为原有的设置与日志, 右侧 6 列为预览
+        cols = 13
         self.central_layout = QGridLayout(self.central_widget)
         self.central_widget.setLayout(self.central_layout)
 
@@ -103,22 +135,97 @@ class MyMainWindow(QMainWindow):
         self.central_layout.addWidget(self.start_button, 2, 6, 1, 1)
 
         # log display
-        self.log_display = QTextEdit(self.central_widget)
+        self.log_display = QPlainTextEdit(self.central_widget)
         self.log_display.setReadOnly(True)
-        self.central_layout.addWidget(self.log_display, 3, 0, 6, 7)
+        self.log_display.setMaximumBlockCount(LOG_MAX_LINES)
+        self.central_layout.addWidget(self.log_display, 3, 0, 5, 7)
+
+        # progress bar
+        self.progress_bar = QProgressBar(self.central_widget)
+        self.progress_bar.setFormat("%v/%m")
+        self.progress_bar.setValue(0)
+        self.central_layout.addWidget(self.progress_bar, 8, 0, 1, 3)
+
+        # progress counters
+        self.progress_label = QLabel(self.central_widget)
+        self.central_layout.addWidget(self.progress_label, 8, 3, 1, 2)
+
+        # pause button
+        self.pause_button = QPushButton(self.central_widget)
+        self.pause_button.setText("暂停")
+        self.pause_button.setEnabled(False)
+        self.central_layout.addWidget(self.pause_button, 8, 5, 1, 1)
+
+        # cancel button
+        self.cancel_button = QPushButton(self.central_widget)
+        self.cancel_button.setText("取消")
+        self.cancel_button.setEnabled(False)
+        self.central_layout.addWidget(self.cancel_button, 8, 6, 1, 1)
+
+        # preview file select
+        self.preview_file_select = QComboBox(self.central_widget)
+        self.central_layout.addWidget(self.preview_file_select, 0, 7, 1, 4)
+
+        # preview previous/next buttons
+        self.preview_prev_button = QPushButton(self.central_widget)
+        self.preview_prev_button.setText("上一张")
+        self.central_layout.addWidget(self.preview_prev_button, 0, 11, 1, 1)
+        self.preview_next_button = QPushButton(self.central_widget)
+        self.preview_next_button.setText("下一张")
+        self.central_layout.addWidget(self.preview_next_button, 0, 12, 1, 1)
+
+        # preview display
+        self.preview_display = QLabel(self.central_widget)
+        self.preview_display.setAlignment(Qt.AlignCenter)
+        self.preview_display.setMinimumSize(1, 1)
+        self.central_layout.addWidget(self.preview_display, 1, 7, 6, 6)
+
+        # ratio inputs, 两个一行
+        self.ratio_inputs = {}
+        for i, (name, (text, minimum, maximum, step)) in enumerate(RATIO_INPUTS.items()):
+            row, col = 7 + i // 2, 7 + 2 * (i % 2)
+            label = QLabel(self.central_widget)
+            label.setText(text)
+            self.central_layout.addWidget(label, row, col, 1, 1)
+            ratio_input = QDoubleSpinBox(self.central_widget)
+            ratio_input.setDecimals(3)
+            ratio_input.setRange(minimum, maximum)
+            ratio_input.setSingleStep(step)
+            ratio_input.setValue(getattr(self.agent, name))
+            self.central_layout.addWidget(ratio_input, row, col + 1, 1, 1)
+            self.ratio_inputs[name] = ratio_input
+
+        # preview info: 输出尺寸, 没有 exif/logo 时的提示
+        self.preview_info = QLabel(self.central_widget)
+        self.preview_info.setWordWrap(True)
+        self.central_layout.addWidget(self.preview_info, 7, 11, 2, 2)
     
     def _connect(self):
         self.images_path_select_button.clicked.connect(self._select_images_path_event)
         self.save_path_button.clicked.connect(self._select_save_path_event)
         self.out_format_select.currentTextChanged.connect(self._out_format_change_event)
         self.start_button.clicked.connect(self._start_event)
-
-        self.stage2_needed.connect(self._stage2_event)
+        self.pause_button.clicked.connect(self._pause_event)
+        self.cancel_button.clicked.connect(self._cancel_event)
+
+        self.run_finished.connect(self._finished_event)
+
+        # 图片与影响预览的设置改变后稍等再渲染
+        self.preview_file_select.currentIndexChanged.connect(self._schedule_preview)
+        self.preview_prev_button.clicked.connect(lambda: self._step_preview_event(-1))
+        self.preview_next_button.clicked.connect(lambda: self._step_preview_event(1))
+        self.out_format_select.currentTextChanged.connect(self._schedule_preview)
+        self.out_resolution_input.currentTextChanged.connect(self._schedule_preview)
+        for ratio_input in self.ratio_inputs.values():
+            ratio_input.valueChanged.connect(self._schedule_preview)
+        # 预览在后台线程中完成, 经信号转到界面线程
+        self.preview_ready.connect(self._preview_ready_event)
 
     def _select_images_path_event(self):
         filepath = QFileDialog.getExistingDirectory(self.central_widget, dir=watermark.DESKTOP_PATH)
         if filepath != "":
             self.images_path_display.setText(filepath)
+            self._load_preview_files(filepath)
         
     def _select_save_path_event(self):
         filepath = QFileDialog.getExistingDirectory(self.central_widget, dir=watermark.DESKTOP_PATH)
@@ -128,49 +235,136 @@ class MyMainWindow(QMainWindow):
     def _out_format_change_event(self):
         self.out_quality_input.setValue(100)
 
+    def _ratios(self) -> dict:
+        return {name: ratio_input.value() for name, ratio_input in self.ratio_inputs.items()}
+
+    def _load_preview_files(self, in_dir: str):
+        # 遍历与批次相同, 只取前 PREVIEW_MAX_FILES 张
+        self.preview_files = sorted(islice(self.agent.scanner.scan(in_dir), PREVIEW_MAX_FILES))
+        self.preview_file_select.blockSignals(True)
+        self.preview_file_select.clear()
+        self.preview_file_select.addItems([os.path.relpath(file, in_dir) for file in self.preview_files])
+        self.preview_file_select.blockSignals(False)
+        if not self.preview_files:
+            self.preview_display.clear()
+            self.preview_info.setText("未找到照片!")
+        self._schedule_preview()
+
+    def _step_preview_event(self, step: int):
+        index = self.preview_file_select.currentIndex() + step
+        if 0 <= index < len(self.preview_files):
+            self.preview_file_select.setCurrentIndex(index)
+
+    def _schedule_preview(self):
+        self.preview_timer.start(PREVIEW_DELAY)
+
+    def _update_preview_event(self):
+        index = self.preview_file_select.currentIndex()
+        if not 0 <= index < len(self.preview_files):
+            return
+        image_file = self.preview_files[index]
+        resolution = self.out_resolution_input.currentText()
+        ratios = self._ratios()
+        self.preview_key = self.preview.key(image_file, resolution, ratios)
+        # 已缓存时直接显示, 否则交给后台线程; 期间仍显示上一张预览
+        cached = self.preview.cached(image_file, resolution, ratios)
+        if cached is not None:
+            self._show_preview(cached)
+        else:
+            self.preview.request(image_file, resolution, ratios, self.preview_ready.emit)
+
+    def _preview_ready_event(self, preview: Preview):
+        # 渲染期间图片或设置已改变时丢弃
+        if preview.key == self.preview_key:
+            self._show_preview(preview)
+
+    def _show_preview(self, preview: Preview):
+        if preview.image is None:
+            self.preview_display.clear()
+        else:
+            image = preview.image
+            qimage = QImage(image.tobytes(), image.width, image.height, 3 * image.width, QImage.Format_RGB888).copy()
+            pixmap = QPixmap.fromImage(qimage)
+            self.preview_display.setPixmap(pixmap.scaled(self.preview_display.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        info = []
+        if preview.out_size is not None:
+            info.append(F"{preview.out_size[0]}x{preview.out_size[1]} {self.out_format_select.currentText()}")
+        if preview.message:
+            info.append(preview.message)
+        self.preview_info.setText("\n".join(info))
+
     def _start_event(self):
-        self.start_button.setEnabled(False)
         in_dir = self.images_path_display.text()
         out_dir = self.save_path_display.text()
         out_format = self.out_format_select.currentText()
         out_quality = self.out_quality_input.value()
         resolution = self.out_resolution_input.currentText()
-        mythread = Thread(target=self._start, args=(in_dir, out_dir, out_format, out_quality, resolution), daemon=True)
-        mythread.start()
-    
-    def _change_start_button_event(self):
-        self.start_button.setEnabled(True)
+        # 批次使用开始时的比例, 运行中的调整只影响预览
+        for name, value in self._ratios().items():
+            setattr(self.agent, name, value)
+        self._watch_run(self.jobs.submit(in_dir, out_dir, out_format, out_quality, resolution))
 
-    def _write_log_info(self, text: str):
-        log_cursor = self.log_display.textCursor()
-        log_cursor.movePosition(QTextCursor.End)
-        if text.endswith("\n"):
-            self.stream_update_state = 0
+    def _watch_run(self, run: BatchRun):
+        self.run = run
+        self.start_button.setEnabled(False)
+        self.pause_button.setText("暂停")
+        self.pause_button.setEnabled(True)
+        self.cancel_button.setEnabled(True)
+        # 完成回调在后台线程中调用, 经信号转到界面线程
+        run.add_done_callback(self.run_finished.emit)
+
+    def _pause_event(self):
+        if self.run is None:
+            return
+        if self.run.paused:
+            self.run.resume()
+            self.pause_button.setText("暂停")
         else:
-            if self.stream_update_state == 1:
-                log_cursor.select(QTextCursor.BlockUnderCursor)
-                log_cursor.removeSelectedText()
-            self.stream_update_state = 1
-
-        log_cursor.insertText(text)
-        self.log_display.setTextCursor(log_cursor)
-        self.log_display.ensureCursorVisible()
-    
-    def _start(self, in_dir: str, out_dir: str, out_format: str, out_quality: int | None, artist: str | None):
-        exit_code, ret = self.agent.run(in_dir, out_dir, out_format, out_quality, artist)
-        if exit_code == 0:
+            self.run.pause()
+            self.pause_button.setText("继续")
+
+    def _cancel_event(self):
+        if self.run is not None:
+            self.cancel_button.setEnabled(False)
+            self.pause_button.setEnabled(False)
+            self.run.cancel()
+
+    def _change_start_button_event(self):
+        self.start_button.setEnabled(True)
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+
+    def _refresh_event(self):
+        # 每帧把积累的日志一次性追加, 超过 LOG_MAX_LINES 的旧行由控件丢弃
+        lines = self.log.drain()
+        if lines:
+            self.log_display.appendPlainText("\n".join(lines))
+        if self.run is not None:
+            self.progress_bar.setMaximum(max(self.run.total, 1))
+            self.progress_bar.setValue(min(self.run.done, self.run.total))
+            self.progress_label.setText(self.run.summary())
+
+    def _finished_event(self, run: BatchRun):
+        exit_code, ret = run.result()
+        if exit_code == CANCELLED:
+            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 已取消!")
+            self._change_start_button_event()
+        elif exit_code == 0 or (exit_code == 1 and run.manual):
             print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 添加水印完成!")
             self._change_start_button_event()
         elif exit_code == 1:
-            self.stage2_needed.emit(ret)
+            self.pause_button.setEnabled(False)
+            self.cancel_button.setEnabled(False)
+            self._stage2_event(ret)
         elif exit_code == 2:
             self._change_start_button_event()
-    
-    def _start2(self, files: list, brand: str, model: str, len:str, out_dir: str, out_format: str, out_quality: int | None, artist: str | None):
-        self.agent.run2(files, brand, model, len, out_dir, out_format, out_quality, artist)
-        self._change_start_button_event()
-        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 添加水印完成!")
-    
+
+    def closeEvent(self, event):
+        # 取消正在运行的批次, 并等待正在处理的图片写完
+        self.jobs.shutdown(cancel=True)
+        self.preview.close()
+        super().closeEvent(event)
+
     def _stage2_event(self, files: list):
         filenames=[]
         for file in files:
@@ -188,7 +382,7 @@ class MyMainWindow(QMainWindow):
                 out_format = self.out_format_select.currentText()
                 out_quality = self.out_quality_input.value()
                 resolution = self.out_resolution_input.currentText()
-                self._start2(files, self.dlg_ret[0], self.dlg_ret[1], self.dlg_ret[2], out_dir, out_format, out_quality, resolution)
+                self._watch_run(self.jobs.submit_files(files, self.dlg_ret[0], self.dlg_ret[1], self.dlg_ret[2], out_dir, out_format, out_quality, resolution))
             else:
                 self._change_start_button_event()
         elif dlg == QMessageBox.No:
@@ -197,6 +391,22 @@ class MyMainWindow(QMainWindow):
     def _get_dlg_ret(self, ret: list):
         self.dlg_ret = ret
 
+class LazyComboBox(QComboBox):
+    '''
+    第一次展开时才调用 loader 查询选项.
+    '''
+    def __init__(self, parent, loader):
+        super().__init__(parent)
+        self.loader = loader
+        self.loaded = False
+        self.addItem("")
+
+    def showPopup(self):
+        if not self.loaded:
+            self.loaded = True
+            self.addItems(self.loader())
+        super().showPopup()
+
 class CustomDialog(QDialog):
     ret = Signal(list)
 
@@ -217,9 +427,7 @@ class CustomDialog(QDialog):
         self.brand_label.setText("相机品牌")
         self.layout.addWidget(self.brand_label, 0, 0, 1, 1)
 
-        self.brand = QComboBox(self)
-        self.brand.addItem("")
-        self.brand.addItems(list(self.agent.records['Camera_records'].keys()))
+        self.brand = LazyComboBox(self, self.agent.records.brands)
         self.layout.addWidget(self.brand, 0, 1, 1, 1)
 
         self.model_label = QLabel(self)
@@ -234,9 +442,7 @@ class CustomDialog(QDialog):
         self.len_label.setText("镜头")
         self.layout.addWidget(self.len_label, 1, 0, 1, 1)
 
-        self.len_model = QComboBox(self)
-        self.len_model.addItem("")
-        self.len_model.addItems(list(self.agent.records['Lens_records']))
+        self.len_model = LazyComboBox(self, self.agent.records.lenses)
         self.layout.addWidget(self.len_model, 1, 1, 1, 5)
 
         '''创建一个确认键和取消键'''
@@ -259,7 +465,7 @@ class CustomDialog(QDialog):
         if brand != "":
             self.model.clear()
             self.model.addItem("")
-            self.model.addItems(self.agent.records['Camera_records'][brand])
+            self.model.addItems(self.agent.records.models(brand))
 
     def _ok(self):
         brand = self.brand.currentText()
@@ -274,12 +480,6 @@ class CustomDialog(QDialog):
     def _cancel(self):
         self.done(QDialog.Rejected)
 
-class Stream(QObject):
-    stream_update = Signal(str)
-
-    def write(self, text: str):
-        self.stream_update.emit(text)
-
 if __name__ == "__main__":
     # app = QApplication(sys.argv)
     app = QApplication()
@@ -0,0 +1,154 @@
+import io
+import struct
+from typing import TYPE_CHECKING
+
+# exifread 与 Pillow 在第一次解析/解码时才导入
+if TYPE_CHECKING:
+    from PIL import Image
+
+# 水印只用到 IFD0、EXIF 与 GPS 中的少量标签, LensModel 是 EXIF IFD 中最后一个需要的标签
+EXIF_STOP_TAG = 'LensModel'
+# ISO BMFF 文件头 ftyp 中的品牌, 属于 HEIF 时才需要注册 pillow_heif
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'hevm', b'hevs', b'mif1', b'msf1')
+_heif_registered = False
+# decode_into 使用 Pillow 的内部接口(Image._getdecoder、Image.im、decoderconfig), 版本变化后不可用时置为 False
+_decode_into_supported = True
+
+
+def read_file(image_file: str) -> bytes:
+    # 每个文件只读取一次, 句柄在返回前关闭
+    with open(image_file, 'rb') as f:
+        return f.read()
+
+
+def read_exif_tags(data: bytes) -> dict:
+    import exifread
+    if is_heif(data[:12]):
+        # exifread 不能可靠地解析 HEIF 容器, 由 pillow_heif 取出 exif 后按 TIFF 数据解析
+        with open_image(data) as img:
+            data = exif_bytes(img)
+        if not data:
+            return {}
+    # details=False 跳过 MakerNote 与缩略图
+    return exifread.process_file(io.BytesIO(data), stop_tag=EXIF_STOP_TAG, details=False)
+
+
+def exif_bytes(img: 'Image.Image') -> bytes:
+    '''
+    PIL Image 中的 exif, 去掉 'Exif' 前缀后为 exifread 可以直接解析的 TIFF 数据.
+    '''
+    exif = img.info.get('exif') or img.getexif().tobytes()
+    return exif.removeprefix(b'Exif\x00\x00')
+
+
+def exif_thumbnail(exif: bytes | None) -> bytes | None:
+    '''
+    exif 中 IFD1 内嵌的 JPEG 缩略图, 没有时返回 None. 只读取 IFD0 的下一个 IFD 链接与 IFD1 的偏移/长度两个标签.
+    '''
+    if not exif:
+        return None
+    tiff = exif.removeprefix(b'Exif\x00\x00')
+    if tiff[:4] == b'II*\x00':
+        order = '<'
+    elif tiff[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        return None
+    try:
+        ifd0 = struct.unpack_from(order + 'I', tiff, 4)[0]
+        count = struct.unpack_from(order + 'H', tiff, ifd0)[0]
+        ifd1 = struct.unpack_from(order + 'I', tiff, ifd0 + 2 + 12 * count)[0]
+        if ifd1 == 0:
+            return None
+        fields = {}
+        for i in range(struct.unpack_from(order + 'H', tiff, ifd1)[0]):
+            tag, kind, _, value = struct.unpack_from(order + 'HHII', tiff, ifd1 + 2 + 12 * i)
+            # JPEGInterchangeFormat / JPEGInterchangeFormatLength, 类型为 LONG
+            if tag in (0x0201, 0x0202) and kind == 4:
+                fields[tag] = value
+    except struct.error:
+        return None
+    if len(fields) != 2:
+        return None
+    thumbnail = tiff[fields[0x0201]:fields[0x0201] + fields[0x0202]]
+    return thumbnail if thumbnail[:2] == b'\xff\xd8' else None
+
+
+def is_heif(head: bytes) -> bool:
+    return head[4:8] == b'ftyp' and head[8:12] in HEIF_BRANDS
+
+
+def register_heif() -> None:
+    # 重复注册没有副作用, 不需要加锁
+    global _heif_registered
+    if not _heif_registered:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        _heif_registered = True
+
+
+def open_image(source: bytes | str, check_size: bool=True) -> 'Image.Image':
+    '''
+    source 为文件内容或路径; 只读取文件头, 是 HEIF 文件时先注册 HEIF 解码器.
+    check_size 为 False 时不做 Pillow 的解压炸弹检查(超过 Image.MAX_IMAGE_PIXELS 两倍的图片抛出 DecompressionBombError),
+    用于调用方已按尺寸另行控制内存的超大图片, 只支持 JPEG、PNG 与 HEIF.
+    '''
+    from PIL import Image
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            head = f.read(12)
+        fp = source
+    else:
+        head = source[:12]
+        fp = io.BytesIO(source)
+    if is_heif(head):
+        register_heif()
+    if check_size:
+        return Image.open(fp)
+    # 直接使用格式插件打开, 跳过 Image.open 中的尺寸检查
+    if head[:3] == b'\xff\xd8\xff':
+        from PIL import JpegImagePlugin
+        return JpegImagePlugin.jpeg_factory(fp)
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        from PIL import PngImagePlugin
+        return PngImagePlugin.PngImageFile(fp)
+    if is_heif(head):
+        from pillow_heif.as_plugin import HeifImageFile
+        return HeifImageFile(fp)
+    return Image.open(fp)
+
+
+def can_decode_into(img: 'Image.Image') -> bool:
+    # 尚未解码、整张图只有一个 tile 的 RGB JPEG
+    return _decode_into_supported and img.format in ('JPEG', 'MPO') and img.mode == 'RGB' and len(img.tile) == 1 and img.tile[0][0] == 'jpeg' and img.tile[0][1] == (0, 0) + img.size
+
+
+def decode_into(img: 'Image.Image', canvas: 'Image.Image', data: bytes) -> bool:
+    '''
+    把尚未解码的 img 直接解码到 canvas 的左上角, 省去单独的解码缓冲与整图复制.
+    与 img.load() 使用同一个解码器, 得到的像素完全相同. data 为 img 的文件内容.
+    当前的 Pillow 没有所需的内部接口时返回 False, img 与 canvas 均未改动, 由调用方改为先解码再粘贴; 之后 can_decode_into 也返回 False.
+    '''
+    global _decode_into_supported
+    from PIL import Image
+    try:
+        decoder_name, extents, offset, args = img.tile[0]
+        decoder = Image._getdecoder(img.mode, decoder_name, args, img.decoderconfig)
+    except (AttributeError, TypeError):
+        _decode_into_supported = False
+        return False
+    try:
+        try:
+            decoder.setimage(canvas.im, extents)
+        except (AttributeError, TypeError):
+            _decode_into_supported = False
+            return False
+        n, err_code = decoder.decode(memoryview(data)[offset:])
+    finally:
+        decoder.cleanup()
+    img.close()
+    if n >= 0:
+        raise OSError("image file is truncated")
+    if err_code < 0:
+        raise OSError(F"decoder error {err_code}")
+    return True
@@ -0,0 +1,183 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from typing import Callable, Iterable, Iterator
+
+import watermark
+from pipeline import RenderJob
+
+# 暂停时检查取消的间隔(秒)
+_POLL_INTERVAL = 0.1
+# 被取消的批次的返回码, 0~2 见 WaterMarkAgent.run
+CANCELLED = 3
+# 状态 -> 显示的名称
+STATUS_NAMES = {'ok': '成功', 'skipped': '跳过', 'no_exif': '无exif', 'no_logo': '无logo', 'error': '失败'}
+
+
+class BatchRun(object):
+    '''
+    提交给 JobController 的一个批次. future 结束后 result() 为 (返回码, 失败的文件), 与 WaterMarkAgent.run 相同, 取消时返回码为 CANCELLED.
+    total/done/counts 为进度, 其他线程只读; done/counts 由运行批次的线程更新, 遍历目录时 total 由遍历线程随找到的图片增长.
+    暂停后不再向流水线交出新的图片, 已交出的图片照常完成; 取消后丢弃尚未交出与仍在排队的图片, 正在处理的图片完成当前阶段后停止,
+    输出经原子写入, 不会留下写了一半的文件.
+    '''
+    __slots__ = ('manual', 'callback', 'future', 'total', 'done', 'counts', '_resume', '_cancelled')
+
+    def __init__(self, manual: bool=False, callback: Callable[[RenderJob], None] | None=None) -> None:
+        # manual: 使用给定的相机信息(run2)
+        self.manual = manual
+        self.callback = callback
+        self.future = None
+        self.total = 0
+        self.done = 0
+        self.counts = {}
+        self._resume = threading.Event()
+        self._resume.set()
+        self._cancelled = threading.Event()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resume.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def pause(self) -> None:
+        if not self.cancelled:
+            self._resume.clear()
+
+    def resume(self) -> None:
+        self._resume.set()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        # 唤醒暂停中的批次, 使其尽快结束
+        self._resume.set()
+        self.future.cancel()
+
+    def result(self, timeout: float | None=None) -> tuple[int, list]:
+        try:
+            return self.future.result(timeout)
+        except CancelledError:
+            return CANCELLED, []
+
+    def add_done_callback(self, fn: Callable[['BatchRun'], None]) -> None:
+        '''
+        批次结束(包括在开始前被取消)后以 BatchRun 调用 fn, 调用发生在运行批次的线程中.
+        '''
+        self.future.add_done_callback(lambda _: fn(self))
+
+    def gate(self, files: Iterable) -> Iterator:
+        '''
+        逐个交出 files 中的图片: 暂停时等待, 取消后结束.
+        '''
+        for file in files:
+            while not self._resume.wait(_POLL_INTERVAL):
+                pass
+            if self.cancelled:
+                return
+            yield file
+
+    def counted(self, files: Iterable) -> Iterator:
+        '''
+        在单独的线程中取出 files, 每取出一个 total 加 1, 按原顺序交出. 目录只遍历一次, 遍历的同时即开始处理, total 随遍历增长.
+        '''
+        items = queue.SimpleQueue()
+        stop = threading.Event()
+
+        def collect() -> None:
+            try:
+                for file in files:
+                    if stop.is_set() or self.cancelled:
+                        break
+                    self.total += 1
+                    items.put((True, file))
+            except BaseException as e:
+                items.put((False, e))
+                return
+            items.put((False, None))
+
+        threading.Thread(target=collect, name='watermark-job-scan', daemon=True).start()
+        try:
+            while True:
+                found, item = items.get()
+                if not found:
+                    if item is not None:
+                        raise item
+                    return
+                yield item
+        finally:
+            stop.set()
+
+    def job_done(self, job: RenderJob) -> None:
+        self.counts[job.status] = self.counts.get(job.status, 0) + 1
+        self.done += 1
+        if self.callback is not None:
+            self.callback(job)
+
+    def summary(self) -> str:
+        counts = dict(self.counts)
+        return '  '.join(F"{STATUS_NAMES.get(status, status)} {count}" for status, count in counts.items())
+
+
+class JobController(object):
+    '''
+    在后台线程中依次运行批次, 提交后立即返回 BatchRun, 可暂停、继续与取消; GUI 与其他调用方共用.
+    每个批次内部仍由 backend/workers 指定的流水线或进程池并行处理.
+    '''
+    def __init__(self, agent: watermark.WaterMarkAgent, backend: str='auto', workers: int | None=None) -> None:
+        self.agent = agent
+        self.backend = backend
+        self.workers = workers
+        self._runs = []
+        self._lock = threading.Lock()
+        # 同一时间只运行一个批次, 相机/镜头记录与统计信息不会被两个批次同时修改
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='watermark-job')
+
+    def _submit(self, run: BatchRun, func: Callable, *args) -> BatchRun:
+        with self._lock:
+            self._runs = [item for item in self._runs if not item.future.done()]
+            self._runs.append(run)
+            run.future = self._executor.submit(self._execute, run, func, *args)
+        return run
+
+    def _execute(self, run: BatchRun, func: Callable, *args) -> tuple[int, list]:
+        if run.cancelled:
+            return CANCELLED, []
+        exit_code, failed = func(run, *args)
+        return (CANCELLED, failed) if run.cancelled else (exit_code, failed)
+
+    def submit(self, in_dir: str, out_dir: str=watermark.DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution_key: str='原图分辨率', incremental: bool=False, callback: Callable[[RenderJob], None] | None=None) -> BatchRun:
+        '''
+        处理 in_dir 中的照片, 同 WaterMarkAgent.run. callback: 每张图片处理完成后在运行批次的线程中以 RenderJob 调用.
+        '''
+        return self._submit(BatchRun(callback=callback), self._run, in_dir, out_dir, out_format, out_quality, resolution_key, incremental)
+
+    def submit_files(self, files: list, brand: str, model: str, lens: str, out_dir: str=watermark.DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution_key: str='原图分辨率', callback: Callable[[RenderJob], None] | None=None) -> BatchRun:
+        '''
+        使用给定的品牌、型号与镜头处理 files, 同 WaterMarkAgent.run2; 返回码为 0 或 1.
+        '''
+        return self._submit(BatchRun(manual=True, callback=callback), self._run2, files, brand, model, lens, out_dir, out_format, out_quality, resolution_key)
+
+    def _run(self, run: BatchRun, in_dir: str, out_dir: str, out_format: str, out_quality: int, resolution_key: str, incremental: bool) -> tuple[int, list]:
+        return self.agent.run(in_dir, out_dir, out_format, out_quality, resolution_key, self.backend, self.workers, incremental, run.job_done, control=run)
+
+    def _run2(self, run: BatchRun, files: list, brand: str, model: str, lens: str, out_dir: str, out_format: str, out_quality: int, resolution_key: str) -> tuple[int, list]:
+        run.total = len(files)
+        failed = self.agent.run2(files, brand, model, lens, out_dir, out_format, out_quality, resolution_key, self.backend, self.workers, run.job_done, control=run)
+        return (1 if failed else 0), failed
+
+    def cancel_all(self) -> None:
+        with self._lock:
+            runs = list(self._runs)
+        for run in runs:
+            run.cancel()
+
+    def shutdown(self, cancel: bool=True) -> None:
+        '''
+        等待批次结束后停止后台线程; cancel 为 True 时先取消全部批次.
+        '''
+        if cancel:
+            self.cancel_all()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,385 @@
+import io
+import re
+import math
+import struct
+from functools import lru_cache
+from typing import Callable
+
+from PIL import Image
+
+# 水印条在画面下方; 1、2 时位于原图数据之后, 3、4 时位于原图数据之前, 5~8 需要转置整张图, 不支持
+APPEND_ORIENTATIONS = (1, 2)
+PREPEND_ORIENTATIONS = (3, 4)
+ORIENTATIONS = APPEND_ORIENTATIONS + PREPEND_ORIENTATIONS
+# 各方向下, 把正向的水印条变换为原图存储方向所需的操作
+_BAND_TRANSPOSE = {2: Image.FLIP_LEFT_RIGHT, 3: Image.ROTATE_180, 4: Image.FLIP_TOP_BOTTOM}
+# 亮度与色度的采样因子 -> Pillow 的 subsampling 参数
+_SUBSAMPLING = {((1, 1), (1, 1)): 0, ((2, 1), (1, 1)): 1, ((2, 2), (1, 1)): 2}
+# DRI 中重启间隔为 16 位
+MAX_RESTART_INTERVAL = 0xFFFF
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+# 熵编码数据中 0xFF 之后只会出现 0x00(填充)或 RST0~RST7, 其他标记表示扫描结束
+_SCAN_END = re.compile(rb'\xff[^\x00\xd0-\xd7]')
+_RST = re.compile(rb'\xff[\xd0-\xd7]')
+_ZIGZAG = [
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+]
+
+
+class JpegSource(object):
+    '''
+    基线 JPEG 的结构信息, 只解析标记段, 不解码熵编码数据.
+    components: [(分量 id, 水平采样, 垂直采样, 量化表号)], 按 SOF 中的顺序.
+    scan_tables: [(DC 表号, AC 表号)], 与 components 一一对应.
+    '''
+    __slots__ = ('data', 'width', 'height', 'components', 'qtables', 'htables', 'scan_tables', 'restart_interval', 'segments', 'sof', 'sos', 'scan_start', 'scan_end', 'orientation')
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.width = 0
+        self.height = 0
+        self.components = []
+        # 量化表按 zigzag 顺序保存
+        self.qtables = {}
+        # (类别, 表号) -> 16 个码长计数 + 符号
+        self.htables = {}
+        self.scan_tables = []
+        self.restart_interval = 0
+        # 原样写入输出的 DQT/DHT 与 ICC 标记段
+        self.segments = []
+        self.sof = b''
+        self.sos = b''
+        self.scan_start = 0
+        self.scan_end = 0
+        self.orientation = 1
+
+    @property
+    def mcu_size(self) -> tuple[int, int]:
+        return 8 * max(c[1] for c in self.components), 8 * max(c[2] for c in self.components)
+
+    @property
+    def subsampling(self) -> int | None:
+        luma, cb, cr = self.components
+        if cb[1:3] != cr[1:3]:
+            return None
+        return _SUBSAMPLING.get((luma[1:3], cb[1:3]))
+
+    def mcu_count(self, height: int) -> int:
+        mcu_width, mcu_height = self.mcu_size
+        return math.ceil(self.width / mcu_width) * math.ceil(height / mcu_height)
+
+    def natural_qtables(self) -> list:
+        # 亮度与色度分量使用的量化表, 转为 Pillow 接受的自然顺序
+        ret = []
+        for _, _, _, tq in self.components[:2]:
+            natural = [0] * 64
+            for i, value in enumerate(self.qtables[tq]):
+                natural[_ZIGZAG[i]] = value
+            ret.append(natural)
+        return ret
+
+    def component_tables(self) -> list:
+        # 每个分量实际使用的 (采样因子, 量化表, DC 表, AC 表), 用于判断两段数据能否拼接
+        return [((h, v), self.qtables.get(tq), self.htables.get((0, td)), self.htables.get((1, ta))) for (_, h, v, tq), (td, ta) in zip(self.components, self.scan_tables)]
+
+
+def parse(data: bytes) -> JpegSource | None:
+    '''
+    解析 3 分量、单次扫描、哈夫曼编码的基线 JPEG; 其他类型(渐进式、算术编码、12 位、CMYK、RGB 编码等)返回 None.
+    '''
+    if data[:2] != SOI:
+        return None
+    source = JpegSource(data)
+    pos = 2
+    adobe_transform = None
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # 标记前的填充字节
+            pos += 1
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segment = data[pos:pos + 2 + length]
+        body = segment[4:]
+        if marker == 0xDB:
+            source.segments.append(segment)
+            i = 0
+            while i < len(body):
+                pq, tq = body[i] >> 4, body[i] & 15
+                if pq != 0:
+                    return None
+                source.qtables[tq] = list(body[i + 1:i + 65])
+                i += 65
+        elif marker == 0xC4:
+            source.segments.append(segment)
+            i = 0
+            while i < len(body):
+                tc, th = body[i] >> 4, body[i] & 15
+                count = sum(body[i + 1:i + 17])
+                source.htables[(tc, th)] = bytes(body[i + 1:i + 17 + count])
+                i += 17 + count
+        elif marker == 0xC0:
+            precision, height, width, count = struct.unpack('>BHHB', body[:6])
+            if precision != 8 or count != 3:
+                return None
+            source.width, source.height = width, height
+            source.components = [(body[6 + 3 * k], body[7 + 3 * k] >> 4, body[7 + 3 * k] & 15, body[8 + 3 * k]) for k in range(count)]
+            source.sof = segment
+        elif 0xC1 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # 扩展、渐进、无损、算术编码等
+            return None
+        elif marker == 0xDD:
+            source.restart_interval = struct.unpack('>H', body[:2])[0]
+        elif marker == 0xE2 and body.startswith(b'ICC_PROFILE\x00'):
+            source.segments.append(segment)
+        elif marker == 0xEE and body.startswith(b'Adobe') and len(body) >= 12:
+            adobe_transform = body[11]
+        elif marker == 0xDA:
+            if not source.sof:
+                return None
+            count = body[0]
+            ids = [body[1 + 2 * k] for k in range(count)]
+            if ids != [c[0] for c in source.components]:
+                return None
+            source.scan_tables = [(body[2 + 2 * k] >> 4, body[2 + 2 * k] & 15) for k in range(count)]
+            source.sos = segment
+            source.scan_start = pos + 2 + length
+            match = _SCAN_END.search(data, source.scan_start)
+            if match is None:
+                return None
+            source.scan_end = match.start()
+            # 只允许一次扫描
+            if data[source.scan_end:source.scan_end + 2] != EOI:
+                return None
+            break
+        elif marker in (0xD8, 0xD9) or 0xD0 <= marker <= 0xD7:
+            return None
+        pos += 2 + length
+    else:
+        return None
+
+    if adobe_transform == 0:
+        # Adobe 标记声明分量为 RGB 而非 YCbCr
+        return None
+    if any(table is None for table in source.component_tables()) or source.subsampling is None:
+        return None
+    return source
+
+
+@lru_cache(maxsize=1)
+def standard_huffman_tables() -> tuple:
+    # libjpeg 在不优化时使用的标准哈夫曼表, 亮度在前、色度在后
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16)).save(buffer, format='JPEG', subsampling=0)
+    tables = parse(buffer.getvalue()).component_tables()
+    return tables[0][2:], tables[1][2:]
+
+
+def restart_interval(source: JpegSource, band_height: int) -> int | None:
+    '''
+    返回拼接时使用的重启间隔(以 MCU 计), 不能无损拼接时返回 None.
+    水印条与原图之间插入 RST 标记, 解码器在此重置 DC 预测值, 因此原图(追加)或水印条(前置)必须恰好结束于
+    一个 MCU 行与一个重启间隔的边界. 原图没有重启间隔时, 整张原图作为一个间隔, 受 16 位上限限制.
+    '''
+    if source.orientation not in ORIENTATIONS or source.height + band_height > 0xFFFF:
+        return None
+    luma_tables, chroma_tables = standard_huffman_tables()
+    tables = source.component_tables()
+    # 水印条由 Pillow 按标准哈夫曼表编码, 原图必须使用相同的表
+    if tables[0][2:] != luma_tables or tables[1][2:] != chroma_tables or tables[2][2:] != chroma_tables:
+        return None
+    # Pillow 对两个色度分量使用同一张量化表
+    if tables[1][1] != tables[2][1]:
+        return None
+
+    mcu_height = source.mcu_size[1]
+    interval = source.restart_interval
+    if source.orientation in APPEND_ORIENTATIONS:
+        if source.height % mcu_height:
+            return None
+        photo_mcus = source.mcu_count(source.height)
+        if interval:
+            return interval if photo_mcus % interval == 0 else None
+        return photo_mcus if photo_mcus <= MAX_RESTART_INTERVAL else None
+    if band_height % mcu_height or not interval:
+        return None
+    return interval if source.mcu_count(band_height) % interval == 0 else None
+
+
+def _renumber_rst(scan: bytes, offset: int) -> bytes:
+    if offset % 8 == 0:
+        return scan
+    return _RST.sub(lambda m: bytes((0xFF, 0xD0 + (m.group()[1] - 0xD0 + offset) % 8)), scan)
+
+
+def _exif_segment(orientation: int) -> bytes:
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    body = b'Exif\x00\x00' + exif.tobytes()
+    return b'\xff\xe1' + struct.pack('>H', len(body) + 2) + body
+
+
+def append_band(source: JpegSource, band: Image.Image, interval: int, dpi: tuple[int, int]) -> bytes:
+    '''
+    把正向的水印条 band 按原图的量化表与采样方式编码, 与原图的熵编码数据在 MCU 行边界拼接.
+    原图部分的 DCT 系数不变; 方向为 2~4 时水印条按原图的存储方向变换, 并写入方向标记.
+    '''
+    if source.orientation in _BAND_TRANSPOSE:
+        band = band.transpose(_BAND_TRANSPOSE[source.orientation])
+    buffer = io.BytesIO()
+    band.save(buffer, format='JPEG', qtables=source.natural_qtables(), subsampling=source.subsampling, restart_marker_blocks=interval, dpi=dpi)
+    encoded = buffer.getvalue()
+    band_source = parse(encoded)
+    if band_source is None or band_source.component_tables() != source.component_tables() or band_source.restart_interval != interval or band_source.width != source.width:
+        raise ValueError("watermark band is not compatible with the source JPEG")
+
+    photo_scan = source.data[source.scan_start:source.scan_end]
+    band_scan = encoded[band_source.scan_start:band_source.scan_end]
+    # 第一段以 RST 结束并重置 DC 预测值, 第二段中的 RST 编号顺延
+    if source.orientation in APPEND_ORIENTATIONS:
+        first_mcus, first, second = source.mcu_count(source.height), photo_scan, band_scan
+    else:
+        first_mcus, first, second = band_source.mcu_count(band_source.height), band_scan, photo_scan
+    intervals = first_mcus // interval
+    joint = bytes((0xFF, 0xD0 + (intervals - 1) % 8))
+    second = _renumber_rst(second, intervals)
+
+    sof = bytearray(source.sof)
+    struct.pack_into('>H', sof, 5, source.height + band_source.height)
+    # JFIF 段取自 Pillow 编码的水印条, 与常规输出一致
+    jfif = encoded[2:2 + 2 + struct.unpack('>H', encoded[4:6])[0]] if encoded[2:4] == b'\xff\xe0' else b''
+    exif = _exif_segment(source.orientation) if source.orientation != 1 else b''
+    dri = b'\xff\xdd\x00\x04' + struct.pack('>H', interval)
+    return b''.join([SOI, jfif, exif] + source.segments + [bytes(sof), dri, source.sos, first, joint, second, EOI])
+
+
+def header_restart_interval(head: bytes) -> int:
+    '''
+    只读取文件头中扫描开始之前的标记段, 返回重启间隔; 没有 DRI 或文件头不完整时返回 0.
+    '''
+    pos = 2
+    while pos + 4 <= len(head) and head[:2] == SOI:
+        if head[pos] != 0xFF:
+            return 0
+        marker = head[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        length = struct.unpack('>H', head[pos + 2:pos + 4])[0]
+        if marker == 0xDD and pos + 6 <= len(head):
+            return struct.unpack('>H', head[pos + 4:pos + 6])[0]
+        if marker == 0xDA:
+            return 0
+        pos += 2 + length
+    return 0
+
+
+class RowSplitter(object):
+    '''
+    按重启间隔切分基线 JPEG, 用于逐段解码超大图片. 重启标记处 DC 预测值重置, 同时对齐 MCU 行与重启间隔的位置
+    可以作为一段的起点, 相邻两个这样的位置之间为一个单元(unit_rows 个像素行).
+    extract 取出若干单元组成独立的 JPEG; 色度上采样会用到相邻的行, 调用方应多解码上下各一个单元后裁剪.
+    '''
+    __slots__ = ('source', 'unit_rows', 'units', '_unit_intervals', '_starts', '_ends')
+
+    def __init__(self, source: JpegSource, unit_rows: int, starts: list, ends: list) -> None:
+        self.source = source
+        mcu_height = source.mcu_size[1]
+        self.unit_rows = unit_rows * mcu_height
+        self.units = math.ceil(source.height / self.unit_rows)
+        self._unit_intervals = unit_rows * math.ceil(source.width / source.mcu_size[0]) // source.restart_interval
+        # 各重启间隔的熵编码数据在文件中的起止位置
+        self._starts = starts
+        self._ends = ends
+
+    def extract(self, u0: int, u1: int) -> bytes:
+        '''
+        第 u0 到 u1 个单元(不含 u1)组成的 JPEG, 高度为这些单元在原图中的行数.
+        '''
+        source = self.source
+        i0 = u0 * self._unit_intervals
+        i1 = min(u1 * self._unit_intervals, len(self._starts))
+        height = min(u1 * self.unit_rows, source.height) - u0 * self.unit_rows
+        sof = bytearray(source.sof)
+        struct.pack_into('>H', sof, 5, height)
+        dri = b'\xff\xdd\x00\x04' + struct.pack('>H', source.restart_interval)
+        # 第一个间隔在新文件中的编号为 0, 其后的 RST 编号相应前移
+        scan = _renumber_rst(source.data[self._starts[i0]:self._ends[i1 - 1]], -i0 % 8)
+        return b''.join([SOI] + source.segments + [bytes(sof), dri, source.sos, scan, EOI])
+
+
+def row_splitter(source: JpegSource, max_rows: int) -> RowSplitter | None:
+    '''
+    source 有重启间隔且一个单元不超过 max_rows 行时返回 RowSplitter, 否则返回 None.
+    只处理分量编号为 1、2、3 的文件, 单独取出的数据与原图按同样的色彩空间解码.
+    '''
+    interval = source.restart_interval
+    if not interval or [c[0] for c in source.components] != [1, 2, 3]:
+        return None
+    mcu_width, mcu_height = source.mcu_size
+    per_row = math.ceil(source.width / mcu_width)
+    unit_rows = interval // math.gcd(interval, per_row)
+    if unit_rows * mcu_height > max_rows:
+        return None
+    starts = [source.scan_start]
+    ends = []
+    for match in _RST.finditer(source.data, source.scan_start, source.scan_end):
+        ends.append(match.start())
+        starts.append(match.end())
+    ends.append(source.scan_end)
+    if len(starts) != math.ceil(source.mcu_count(source.height) / interval):
+        return None
+    return RowSplitter(source, unit_rows, starts, ends)
+
+
+class StripWriter(object):
+    '''
+    把自上而下的若干条图像逐条编码为一个 JPEG 并写出, 每条结束于 MCU 行与重启间隔的边界, 扫描数据之间插入 RST 标记,
+    解码结果与整张图片一次编码相同. 除最后一条外, 每条的高度应为 STRIP_ALIGN 的整数倍.
+    subsampling 同 Pillow, 默认 4:2:0; options 为只用于第一条(文件头)的其他保存参数, 例如 exif 与 icc_profile.
+    各条必须使用相同的哈夫曼表, 因此不支持 optimize 与 progressive.
+    '''
+    # MCU 高度最大为 16
+    STRIP_ALIGN = 16
+
+    def __init__(self, write: Callable[[bytes], None], width: int, height: int, quality: int, dpi: tuple[int, int], subsampling: int=2, options: dict | None=None) -> None:
+        if height > 0xFFFF or width > 0xFFFF:
+            raise ValueError(F"image size {width}x{height} exceeds the JPEG limit")
+        self.write = write
+        self.height = height
+        self.quality = quality
+        self.dpi = dpi
+        self.subsampling = subsampling
+        self.options = options or {}
+        # 每个 MCU 行为一个重启间隔; 4:4:4 时 MCU 宽 8, 其余为 16
+        self.interval = math.ceil(width / (8 if subsampling == 0 else 16))
+        self.intervals = 0
+
+    def add(self, strip: Image.Image) -> None:
+        buffer = io.BytesIO()
+        options = self.options if self.intervals == 0 else {}
+        strip.save(buffer, format='JPEG', quality=self.quality, subsampling=self.subsampling, restart_marker_blocks=self.interval, dpi=self.dpi, **options)
+        encoded = buffer.getvalue()
+        source = parse(encoded)
+        if source is None or source.restart_interval != self.interval:
+            raise ValueError("strip is not encoded with the expected restart interval")
+        scan = encoded[source.scan_start:source.scan_end]
+        if self.intervals == 0:
+            header = bytearray(encoded[:source.scan_start])
+            struct.pack_into('>H', header, header.index(source.sof) + 5, self.height)
+            self.write(bytes(header))
+            self.write(scan)
+        else:
+            self.write(bytes((0xFF, 0xD0 + (self.intervals - 1) % 8)))
+            self.write(_renumber_rst(scan, self.intervals))
+        self.intervals += source.mcu_count(source.height) // self.interval
+
+    def close(self) -> None:
+        self.write(EOI)
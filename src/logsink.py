@@ -0,0 +1,43 @@
+import threading
+from collections import deque
+
+# 日志最多保留的行数, 界面中的日志同样只保留这么多行
+LOG_MAX_LINES = 5000
+
+
+class LogSink(object):
+    '''
+    线程安全的日志通道, 用于替换 sys.stdout/sys.stderr: 任意线程写入, 界面线程定时取出.
+    写入方只在 deque 上追加完整的行(append/extend 为原子操作), 不加锁也不等待界面; 界面来不及取出时丢弃最旧的行.
+    每个线程未写完的行(例如 print 分两次写入的内容与换行)先留在线程自己的缓冲中, 不同线程的输出不会混在同一行.
+    '''
+    encoding = 'utf-8'
+
+    def __init__(self, maxlen: int=LOG_MAX_LINES) -> None:
+        self.lines = deque(maxlen=maxlen)
+        self._local = threading.local()
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self._local, 'buffer', '') + text
+        *lines, self._local.buffer = buffer.split('\n')
+        if lines:
+            self.lines.extend(lines)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+    def drain(self) -> list[str]:
+        '''
+        取出目前为止写入的全部完整行.
+        '''
+        ret = []
+        try:
+            while True:
+                ret.append(self.lines.popleft())
+        except IndexError:
+            pass
+        return ret
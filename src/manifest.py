@@ -0,0 +1,135 @@
+import os
+import json
+import secrets
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+
+MANIFEST_NAME = '.watermark_manifest.jsonl'
+# 临时文件以 0666 创建, 由内核按进程的 umask 设置权限, 与直接创建输出文件相同
+_TMP_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+
+
+def _create_temp(out_dir: str) -> tuple[int, str]:
+    # 同名文件已存在(极少见)时换一个名字重试
+    while True:
+        tmp_file = os.path.join(out_dir, F".Mark_{secrets.token_hex(8)}.tmp")
+        try:
+            return os.open(tmp_file, _TMP_FLAGS, 0o666), tmp_file
+        except FileExistsError:
+            continue
+
+
+@contextmanager
+def open_atomic(out_filename: str) -> Iterator[BinaryIO]:
+    '''
+    打开同目录下的临时文件用于写入, 正常结束时重命名为 out_filename, 出错时删除, 中途崩溃不会留下写了一半的输出.
+    '''
+    fd, tmp_file = _create_temp(os.path.dirname(out_filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_file, out_filename)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def write_atomic(out_filename: str, data: bytes) -> None:
+    with open_atomic(out_filename) as f:
+        f.write(data)
+
+
+class DigestWriter(object):
+    '''
+    分段写入 fp, 同时计算 sha256 与总长度; hexdigest 与对全部内容调用 digest 的结果相同.
+    '''
+    def __init__(self, fp: BinaryIO) -> None:
+        self.fp = fp
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> None:
+        self.fp.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_fingerprint(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class OutputManifest(object):
+    '''
+    输出目录下的清单, 每行记录一个输出文件: 源文件指纹、渲染参数、输出文件指纹与 sha256.
+    只追加写入, 同一输出以最后一行为准; 载入时记录明显多于输出数量则压缩重写.
+    '''
+    def __init__(self, out_dir: str) -> None:
+        self.path = os.path.join(out_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.entries = {}
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 崩溃时可能留下不完整的最后一行
+                        continue
+                    self.entries[entry['output']] = entry
+                    lines += 1
+        if lines > 2 * len(self.entries) + 64:
+            self._compact()
+
+    def _compact(self) -> None:
+        data = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in self.entries.values())
+        write_atomic(self.path, data.encode('utf-8'))
+
+    def is_current(self, out_filename: str, source: str, source_fp: tuple[int, int] | None, settings: dict) -> bool:
+        '''
+        out_filename 是否由同一源文件(路径与指纹)以相同参数生成且未被修改; 没有源文件指纹的记录(旧版本写入)不算.
+        '''
+        entry = self.entries.get(os.path.basename(out_filename))
+        if entry is None or source_fp is None or entry['source_fp'] is None:
+            return False
+        # 不同子目录中的同名文件输出到同一文件名, 以源文件路径区分
+        if entry['source'] != os.path.abspath(source):
+            return False
+        if tuple(entry['source_fp']) != tuple(source_fp) or entry['settings'] != settings:
+            return False
+        out_fp = _file_fingerprint(out_filename)
+        if out_fp is None or out_fp[0] != entry['output_fp'][0]:
+            return False
+        if out_fp[1] == entry['output_fp'][1]:
+            return True
+        # 大小一致但修改时间不同(例如被复制过), 以内容哈希为准
+        with open(out_filename, 'rb') as f:
+            return digest(f.read()) == entry['sha256']
+
+    def record(self, source: str, source_fp: tuple[int, int] | None, settings: dict, out_filename: str, sha256: str) -> None:
+        entry = {
+            'output': os.path.basename(out_filename),
+            'source': os.path.abspath(source),
+            'source_fp': list(source_fp) if source_fp else None,
+            'settings': settings,
+            'output_fp': list(_file_fingerprint(out_filename) or (0, 0)),
+            'sha256': sha256,
+        }
+        with self._lock:
+            self.entries[entry['output']] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import sqlite3
+import datetime
+import threading
+from typing import Iterable
+
+ROOT_PATH = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+INDEX_PATH = os.path.join(ROOT_PATH, 'resources', 'data', 'metadata.sqlite3')
+# 每次查询的路径数量, 低于 sqlite 的变量个数上限
+QUERY_BATCH = 500
+
+
+def fingerprint(image_file: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(image_file)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class MetadataIndex(object):
+    '''
+    exif 解析结果的持久化索引, 以 (绝对路径, 文件大小, 修改时间) 判断是否失效.
+    没有 exif 的文件同样记录(空字典), 再次处理时无需读取文件.
+    多个线程共用一个连接, 写入先缓存再批量提交; 多个进程之间依靠 sqlite 的 WAL 与锁等待.
+    '''
+    def __init__(self, path: str=INDEX_PATH, flush_size: int=64) -> None:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.flush_size = flush_size
+        self._lock = threading.Lock()
+        self._pending = []
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS exif (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, data TEXT)")
+        self._conn.commit()
+
+    def get_many(self, files: Iterable[tuple[str, tuple[int, int] | None]]) -> dict:
+        '''
+        files 为 (路径, fingerprint) 序列, 返回指纹仍然匹配的 {路径: exif_data}.
+        '''
+        expected = {os.path.abspath(image_file): (image_file, fp) for image_file, fp in files if fp is not None}
+        keys = list(expected.keys())
+        ret = {}
+        with self._lock:
+            for i in range(0, len(keys), QUERY_BATCH):
+                chunk = keys[i:i + QUERY_BATCH]
+                rows = self._conn.execute(F"SELECT path, size, mtime_ns, data FROM exif WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+                for path, size, mtime_ns, data in rows:
+                    image_file, fp = expected[path]
+                    if fp == (size, mtime_ns):
+                        ret[image_file] = json.loads(data)
+        return ret
+
+    def put(self, image_file: str, fp: tuple[int, int] | None, exif_data: dict) -> None:
+        if fp is None:
+            return
+        with self._lock:
+            self._pending.append((os.path.abspath(image_file), fp[0], fp[1], json.dumps(exif_data, ensure_ascii=False)))
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self._pending:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO exif (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)", self._pending)
+            self._pending = []
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def prune(self) -> int:
+        '''
+        删除文件已不存在或已被修改的记录, 返回删除的条数.
+        '''
+        with self._lock:
+            self._flush()
+            stale = []
+            for path, size, mtime_ns in self._conn.execute("SELECT path, size, mtime_ns FROM exif"):
+                if fingerprint(path) != (size, mtime_ns):
+                    stale.append((path,))
+            with self._conn:
+                self._conn.executemany("DELETE FROM exif WHERE path = ?", stale)
+            return len(stale)
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    # python src/metaindex.py prune
+    if sys.argv[1:] == ['prune']:
+        index = MetadataIndex()
+        count = index.prune()
+        index.close()
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 已清理 {count} 条失效记录")
+    else:
+        print("usage: python src/metaindex.py prune")
+        sys.exit(2)
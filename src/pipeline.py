@@ -0,0 +1,357 @@
+import os
+import time
+import queue
+import datetime
+import threading
+from typing import Callable, Iterable, Iterator
+
+from profiling import NULL_TIMER
+
+# 流水线结束标记, 依次穿过每一级队列
+_STOP = object()
+_POLL_INTERVAL = 0.1
+
+
+class RenderSettings(object):
+    # out_dir 为 None 时输出不写入文件, 编码结果保存在 RenderJob.output 中; out_format 也为 None 时保存合成后的 PIL Image
+    __slots__ = ('out_dir', 'out_format', 'out_quality', 'resolution')
+
+    def __init__(self, out_dir: str, out_format: str, out_quality: int, resolution: int) -> None:
+        self.out_dir = out_dir
+        self.out_format = out_format
+        self.out_quality = out_quality
+        self.resolution = resolution
+
+    def out_file_for(self, image_file: str) -> str:
+        image_name = os.path.splitext(os.path.basename(image_file))
+        return os.path.join(self.out_dir, F"Mark_{image_name[0]}.{self.out_format}")
+
+
+class RenderJob(object):
+    # status: None 表示仍在处理, 结束后为 'ok' / 'skipped' / 'no_exif' / 'no_logo' / 'error'
+    # skipped: 增量模式下输出已是最新, 未重新渲染
+    __slots__ = ('index', 'image_file', 'settings', 'exif_data', 'manual', 'indexed', 'fingerprint', 'data', 'img', 'canvas', 'out_file', 'out_digest', 'status', 'error', 'elapsed', 'timer', 'reserved', 'jpeg', 'encoded', 'tiled', 'metadata', 'scaled', 'output', 'in_memory')
+
+    def __init__(self, index: int, image_file: str, settings: RenderSettings, exif_data: dict | None=None) -> None:
+        self.index = index
+        self.image_file = image_file
+        self.settings = settings
+        # manual: exif 信息由调用方提供(run2), 不再解析文件
+        self.manual = exif_data is not None
+        self.exif_data = exif_data
+        # indexed: exif_data 来自元数据索引; fingerprint: (文件大小, 修改时间)
+        self.indexed = False
+        self.fingerprint = None
+        # 文件内容, 解析 exif 与解码共用, 解码后释放
+        self.data = None
+        self.img = None
+        self.canvas = None
+        self.out_file = None
+        self.out_digest = ""
+        self.status = None
+        self.error = ""
+        # 各阶段累计耗时(秒), 不含排队等待
+        self.elapsed = 0.0
+        # 开启统计时为 profiling.StageTimer
+        self.timer = NULL_TIMER
+        # 预估的峰值内存(字节), 用于 scheduler.MemoryBudget 准入
+        self.reserved = 0
+        # 无损模式: 可直接拼接水印条的原图结构(jpegtools.JpegSource)与拼接后的 JPEG 数据
+        self.jpeg = None
+        self.encoded = None
+        # 超大图片的分条渲染(tiled.TiledImage), 由编码阶段逐条生成输出
+        self.tiled = None
+        # 需要写入输出的原图 (exif, ICC 描述文件), 见 encoder.EncodePreset
+        self.metadata = None
+        # 解码时已缩小照片: (原图转正后的尺寸, 输出尺寸), 合成时按原图排版后缩放到输出尺寸, 见 WaterMarkAgent._draw_watermark
+        self.scaled = None
+        # 不写入文件时的输出数据, 处理完成后保留
+        self.output = None
+        # 图片由调用方以 bytes、文件对象或 PIL Image 给出, image_file 只是用于日志的名字
+        self.in_memory = False
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ('ok', 'skipped')
+
+    def done(self, out_file: str, out_digest: str="") -> None:
+        self.out_file = out_file
+        self.out_digest = out_digest
+        self.status = 'ok'
+        self.release()
+
+    def skip(self, out_file: str) -> None:
+        self.out_file = out_file
+        self.status = 'skipped'
+        self.release()
+
+    def fail(self, status: str, error: str="") -> None:
+        self.status = status
+        self.error = error
+        self.release()
+
+    def release(self) -> None:
+        self.data = None
+        self.img = None
+        self.canvas = None
+        self.jpeg = None
+        self.encoded = None
+        self.metadata = None
+        if self.tiled is not None:
+            self.tiled.photo.close()
+            self.tiled = None
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _STOP
+
+
+def run_stage(func: Callable, job: RenderJob) -> None:
+    trace_memory = job.timer.trace_memory
+    if trace_memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        func(job)
+    finally:
+        job.elapsed += time.perf_counter() - start
+        if trace_memory:
+            job.timer.peak_bytes = max(job.timer.peak_bytes, tracemalloc.get_traced_memory()[1])
+
+
+def _run_stage(func: Callable, job: RenderJob) -> None:
+    try:
+        run_stage(func, job)
+    except Exception as e:
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {os.path.basename(job.image_file)} 处理失败: {e}\n", end='')
+        job.fail('error', F"{type(e).__name__}: {e}")
+
+
+def run_pipeline(source: Iterable[RenderJob], stages: list[tuple[Callable, int]], maxsize: int=8, budget=None) -> Iterator[RenderJob]:
+    '''
+    多级流水线: source 在独立线程中逐个产生任务, 每一级由若干线程处理, 级与级之间为有界队列.
+    任务按完成顺序产出; 某一级失败的任务直接流向出口, 不再经过后续各级.
+    budget: scheduler.MemoryBudget, 任务进入流水线前按 job.reserved 准入, 到达出口后释放.
+    '''
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize) for _ in range(len(stages) + 1)]
+    errors = []
+    threads = []
+
+    def feed():
+        try:
+            for job in source:
+                if budget is not None and not budget.acquire(job.reserved, stop):
+                    return
+                if not _put(queues[0], job, stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        _put(queues[0], _STOP, stop)
+
+    def work(func: Callable, in_q: queue.Queue, out_q: queue.Queue, remaining: list, lock: threading.Lock):
+        while True:
+            job = _get(in_q, stop)
+            if job is _STOP:
+                # 通知同一级的其他线程, 最后一个退出的线程把结束标记交给下一级
+                try:
+                    in_q.put_nowait(_STOP)
+                except queue.Full:
+                    pass
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    _put(out_q, _STOP, stop)
+                return
+            if job.status is None:
+                _run_stage(func, job)
+            if not _put(out_q, job, stop):
+                return
+
+    threads.append(threading.Thread(target=feed, daemon=True))
+    for i, (func, workers) in enumerate(stages):
+        remaining = [workers]
+        lock = threading.Lock()
+        for _ in range(workers):
+            threads.append(threading.Thread(target=work, args=(func, queues[i], queues[i + 1], remaining, lock), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            job = queues[-1].get()
+            if job is _STOP:
+                break
+            if budget is not None:
+                budget.release(job.reserved)
+            yield job
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def run_process_pool(source: Iterable[RenderJob], task: Callable, workers: int, initializer: Callable, initargs: tuple, max_pending: int, budget=None) -> Iterator[tuple]:
+    '''
+    多进程版本: 最多 max_pending 个任务同时在途, 每完成一个产出 task(job) 的返回值.
+    task 在工作进程中执行, 返回值的第一项应为处理后的 job.
+    budget: 同 run_pipeline, 预算不足时先等待在途任务完成.
+    '''
+    # concurrent.futures 连同 multiprocessing 只在使用多进程时导入
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    pool = ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs)
+    pending = {}
+    source = iter(source)
+    job = None
+    exhausted = False
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                if job is None:
+                    job = next(source, None)
+                if job is None:
+                    exhausted = True
+                    break
+                # 没有在途任务时总能准入, 不会死等
+                if budget is not None and not budget.acquire(job.reserved, blocking=False):
+                    break
+                pending[pool.submit(task, job)] = job.reserved
+                job = None
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                reserved = pending.pop(future)
+                if budget is not None:
+                    budget.release(reserved)
+                yield future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class WorkerPool(object):
+    '''
+    常驻的工作池, 逐个提交任务并等待结果, 用于按请求渲染(见 server).
+    最多 workers 个任务同时处理, 另外最多 queue_size 个排队; 已满或 budget 不足时 render 立即返回 None, 由调用方拒绝.
+    backend 为 'process' 时 task 在工作进程中执行, 工作进程启动时由 initializer 预热; finish 把 task 的返回值转换为 job.
+    estimate: 按 job 估计峰值内存, 用于 budget 准入.
+    '''
+    def __init__(self, task: Callable, workers: int, backend: str='thread', queue_size: int=0, initializer: Callable | None=None, initargs: tuple=(), finish: Callable | None=None, budget=None, estimate: Callable | None=None) -> None:
+        self.task = task
+        self.workers = workers
+        self.backend = backend
+        self.capacity = workers + queue_size
+        self.finish = finish
+        self.budget = budget
+        self.estimate = estimate
+        self.in_flight = 0
+        self.peak = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        if backend == 'process':
+            self._executor = ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs)
+        else:
+            self._executor = ThreadPoolExecutor(workers, initializer=initializer, initargs=initargs)
+        # 提前启动全部工作线程/进程, 第一个请求不再等待进程启动与预热
+        for future in [self._executor.submit(time.sleep, 0.05) for _ in range(workers)]:
+            future.result()
+
+    def accepting(self) -> bool:
+        '''
+        工作池是否还能接收任务; 已满时计为一次拒绝, 调用方可以在读取请求内容前先行拒绝.
+        '''
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                return False
+            return True
+
+    def _admit(self, job: RenderJob) -> bool:
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+        if self.budget is not None:
+            if self.estimate is not None:
+                job.reserved = self.estimate(job)
+            if not self.budget.acquire(job.reserved, blocking=False):
+                with self._lock:
+                    self.in_flight -= 1
+                    self.rejected += 1
+                return False
+        with self._lock:
+            self.submitted += 1
+            self.peak = max(self.peak, self.in_flight)
+        return True
+
+    def render(self, job: RenderJob) -> RenderJob | None:
+        '''
+        阻塞直到 job 处理完成, 返回处理后的 job(process 后端为工作进程返回的副本); 被拒绝时返回 None.
+        '''
+        if not self._admit(job):
+            return None
+        start = time.perf_counter()
+        try:
+            result = self._executor.submit(self.task, job).result()
+            job = self.finish(result) if self.finish is not None else result
+        except Exception as e:
+            # 例如工作进程意外退出
+            job.fail('error', F"{type(e).__name__}: {e}")
+            job.elapsed = time.perf_counter() - start
+        finally:
+            if self.budget is not None:
+                self.budget.release(job.reserved)
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+                if not job.ok:
+                    self.failed += 1
+        return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            busy = min(self.in_flight, self.workers)
+            return {
+                'backend': self.backend,
+                'workers': self.workers,
+                'capacity': self.capacity,
+                'busy': busy,
+                'queued': self.in_flight - busy,
+                'utilization': busy / self.workers,
+                'peak_in_flight': self.peak,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'memory_budget': self.budget.limit if self.budget is not None else None,
+                'memory_in_use': self.budget.in_use if self.budget is not None else 0,
+            }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,195 @@
+import io
+import time
+import threading
+from typing import Callable
+
+from PIL import Image
+
+import ingest
+import assets
+import metaindex
+import watermark
+
+# 预览框的默认大小(像素), 预览图缩放到不超过它
+PREVIEW_BOX = (960, 720)
+# 缓存的预览图数量, 每张约为预览框大小, 来回切换图片与设置时直接取出
+PREVIEW_CACHE = 32
+# 缓存的已解码照片数量, 只改变比例或分辨率时不再解码
+SOURCE_CACHE = 8
+# exif 方向 -> 转正的方法
+_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class Preview(object):
+    '''
+    一张图片的预览. image 为缩小后的合成结果(没有 exif 或 logo 时为照片本身), out_size 为实际输出的尺寸;
+    error 为 None 或 'no_exif' / 'no_logo' / 'error', message 为说明; source 为照片的来源: 'thumbnail' 或 'draft'.
+    '''
+    __slots__ = ('key', 'image_file', 'image', 'out_size', 'source', 'error', 'message', 'elapsed')
+
+    def __init__(self, key: tuple, image_file: str) -> None:
+        self.key = key
+        self.image_file = image_file
+        self.image = None
+        self.out_size = None
+        self.source = None
+        self.error = None
+        self.message = ""
+        self.elapsed = 0.0
+
+
+class _Source(object):
+    # 缩小解码后转正的照片, 以及原图转正后的尺寸与 exif
+    __slots__ = ('photo', 'size', 'exif_data', 'origin')
+
+    def __init__(self, photo: Image.Image, size: tuple[int, int], exif_data: dict, origin: str) -> None:
+        self.photo = photo
+        self.size = size
+        self.exif_data = exif_data
+        self.origin = origin
+
+
+class PreviewRenderer(object):
+    '''
+    以低分辨率渲染单张图片的预览, 排版与水印条的绘制与批量处理使用同一套代码(WaterMarkAgent._draw_watermark),
+    只是照片先缩小到预览框的大小: 内嵌的 exif 缩略图足够大时直接使用, 否则按预览尺寸 draft 解码.
+    预览图按 (文件, 大小与修改时间, 分辨率, 比例, 预览框) 缓存; 解码后的照片另按文件缓存, 只改变设置时不再解码.
+    request 在后台线程中渲染, 只处理最新的一次请求; render 在当前线程中渲染.
+    '''
+    def __init__(self, box: tuple[int, int]=PREVIEW_BOX, cache_size: int=PREVIEW_CACHE, source_cache_size: int=SOURCE_CACHE) -> None:
+        self.box = box
+        self.previews = assets.LRUCache(cache_size)
+        self.sources = assets.LRUCache(source_cache_size)
+        # 渲染使用独立的 agent, 比例在渲染前设置, 不影响正在运行的批次
+        self._agent = watermark.WaterMarkAgent()
+        self._agent_lock = threading.Lock()
+        self._pending = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def key(self, image_file: str, resolution_key: str, ratios: dict) -> tuple:
+        return (image_file, metaindex.fingerprint(image_file), watermark.OUT_RESOLUTION[resolution_key], tuple(sorted(ratios.items())), self.box)
+
+    def cached(self, image_file: str, resolution_key: str, ratios: dict) -> Preview | None:
+        '''
+        已缓存的预览, 没有时返回 None 且不渲染.
+        '''
+        return self.previews.peek(self.key(image_file, resolution_key, ratios))
+
+    def render(self, image_file: str, resolution_key: str, ratios: dict) -> Preview:
+        key = self.key(image_file, resolution_key, ratios)
+        return self.previews.get(key, lambda: self._render(key, image_file, ratios))
+
+    def request(self, image_file: str, resolution_key: str, ratios: dict, callback: Callable[[Preview], None]) -> None:
+        '''
+        在后台线程中渲染, 完成后在该线程中以 Preview 调用 callback. 尚未开始的上一次请求被替换, 不再渲染.
+        '''
+        with self._cond:
+            if self._closed:
+                return
+            self._pending = (image_file, resolution_key, dict(ratios), callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name='watermark-preview', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._pending = None
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                image_file, resolution_key, ratios, callback = self._pending
+                self._pending = None
+            callback(self.render(image_file, resolution_key, ratios))
+
+    def _render(self, key: tuple, image_file: str, ratios: dict) -> Preview:
+        start = time.perf_counter()
+        preview = Preview(key, image_file)
+        resolution = key[2]
+        try:
+            source = self.sources.get((image_file, key[1], self.box), lambda: self._load(image_file))
+            with self._agent_lock:
+                agent = self._agent
+                for name, value in ratios.items():
+                    setattr(agent, name, value)
+                # 与批量处理相同的输出尺寸, 照片按同一比例缩小后排版
+                width, height = source.size
+                canvas_width, canvas_height = agent._canvas_size(width, height)
+                preview.out_size = agent._output_size(canvas_width, canvas_height, resolution)
+                out_width, out_height = preview.out_size
+                scale = min(out_width / canvas_width, self.box[0] / canvas_width, self.box[1] / canvas_height)
+                size = (max(round(width * scale), 1), max(round(height * scale), 1))
+                photo = source.photo if source.photo.size == size else source.photo.resize(size, Image.BICUBIC, reducing_gap=3.0)
+                preview.source = source.origin
+                if not source.exif_data:
+                    preview.error = 'no_exif'
+                    preview.message = "没有exif数据"
+                    preview.image = photo
+                else:
+                    preview.image = agent._draw_watermark(photo, source.exif_data)
+                    if preview.image is None:
+                        preview.error = 'no_logo'
+                        preview.message = F"没有 {source.exif_data['CameraMaker']} 的logo"
+                        preview.image = photo
+        except Exception as e:
+            preview.error = 'error'
+            preview.message = F"{type(e).__name__}: {e}"
+        preview.elapsed = time.perf_counter() - start
+        return preview
+
+    def _load(self, image_file: str) -> _Source:
+        data = ingest.read_file(image_file)
+        exif_data = self._agent._get_exif(image_file, data)
+        img = self._agent._open_image(data)
+        orientation = img.getexif().get(watermark.ORIENTATION_TAG, 1)
+        rotated = orientation in (5, 6, 7, 8)
+        # 转正后的原图尺寸与预览框中照片的最大尺寸, 比例变化时照片只会更小
+        width, height = (img.height, img.width) if rotated else img.size
+        scale = min(self.box[0] / width, self.box[1] / height, 1)
+        target = (max(round(width * scale), 1), max(round(height * scale), 1))
+        stored = (target[1], target[0]) if rotated else target
+        photo = None
+        origin = 'draft'
+        thumbnail = ingest.exif_thumbnail(img.info.get('exif'))
+        if thumbnail is not None:
+            try:
+                thumb = Image.open(io.BytesIO(thumbnail))
+                # 缩略图与原图方向相同; 比例不同(带黑边)或太小时不使用
+                if thumb.width >= stored[0] and thumb.height >= stored[1] and abs(thumb.width * img.height - thumb.height * img.width) <= max(img.width, img.height):
+                    thumb.load()
+                    photo = thumb
+                    origin = 'thumbnail'
+            except Exception:
+                photo = None
+        if photo is None:
+            img.draft('RGB', stored)
+            img.load()
+            photo = img
+        if photo.mode != 'RGB':
+            photo = photo.convert('RGB')
+        if orientation in _TRANSPOSE:
+            # 缩略图没有自己的方向, 与照片一样按原图的方向转正
+            photo = photo.transpose(_TRANSPOSE[orientation])
+        if photo.size != target:
+            photo = photo.resize(target, Image.BICUBIC, reducing_gap=3.0)
+        return _Source(photo, (width, height), exif_data, origin)
+
@@ -0,0 +1,154 @@
+import time
+import datetime
+import threading
+from contextlib import nullcontext
+from typing import Callable
+
+_NULL_CONTEXT = nullcontext()
+
+
+class NullTimer(object):
+    '''
+    未开启统计时使用, 所有操作都是空操作.
+    '''
+    trace_memory = False
+
+    def __call__(self, name: str):
+        return _NULL_CONTEXT
+
+    def count(self, name: str, value: int) -> None:
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class _Span(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer: 'StageTimer', name: str) -> None:
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stages = self.timer.stages
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class StageTimer(object):
+    '''
+    单张图片的各阶段耗时(秒)与计数(字节数/像素数).
+    trace_memory 时额外记录 tracemalloc 统计到的峰值, 只包含 Python 分配器上的内存
+    (文件内容、编码结果等), 不含 Pillow 自行分配的像素缓冲; 多线程并发时各图片的峰值会互相叠加.
+    '''
+    def __init__(self, trace_memory: bool=False) -> None:
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.counters = {}
+        self.peak_bytes = 0
+
+    def __call__(self, name: str) -> _Span:
+        return _Span(self, name)
+
+    def count(self, name: str, value: int) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class Profiler(object):
+    '''
+    汇总每张图片的 StageTimer, 并把结果交给注册的回调 hook(job, timer).
+    '''
+    def __init__(self, trace_memory: bool=False) -> None:
+        self.trace_memory = trace_memory
+        self.hooks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples = {}
+            self.counters = {}
+            self.statuses = {}
+            self.images = 0
+            self.peak_bytes = 0
+            self.start = time.perf_counter()
+            self.end = None
+
+    def add_hook(self, hook: Callable) -> None:
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable) -> None:
+        self.hooks.remove(hook)
+
+    def new_timer(self) -> StageTimer:
+        return StageTimer(self.trace_memory)
+
+    def begin(self) -> None:
+        self.reset()
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+
+    def collect(self, job) -> None:
+        timer = job.timer
+        if not isinstance(timer, StageTimer):
+            return
+        with self._lock:
+            self.images += 1
+            self.statuses[job.status] = self.statuses.get(job.status, 0) + 1
+            for name, seconds in timer.stages.items():
+                self.samples.setdefault(name, []).append(seconds)
+            for name, value in timer.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.peak_bytes = max(self.peak_bytes, timer.peak_bytes)
+        for hook in self.hooks:
+            hook(job, timer)
+
+    def report(self) -> dict:
+        with self._lock:
+            elapsed = (self.end or time.perf_counter()) - self.start
+            stages = {}
+            for name, values in self.samples.items():
+                stages[name] = {
+                    'count': len(values),
+                    'total': sum(values),
+                    'p50': percentile(values, 0.5),
+                    'p95': percentile(values, 0.95),
+                }
+            return {
+                'images': self.images,
+                'statuses': dict(self.statuses),
+                'elapsed': elapsed,
+                'images_per_sec': self.images / elapsed if elapsed > 0 else 0.0,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'peak_bytes': self.peak_bytes,
+            }
+
+    def format_report(self) -> str:
+        report = self.report()
+        lines = [F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {report['images']} 张, {report['elapsed']:.2f}s, {report['images_per_sec']:.2f} 张/s"]
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append(F"    {name:<10} p50 {stage['p50'] * 1000:8.1f}ms  p95 {stage['p95'] * 1000:8.1f}ms  total {stage['total']:8.2f}s")
+        for name, value in report['counters'].items():
+            lines.append(F"    {name:<10} {value}")
+        if self.trace_memory:
+            lines.append(F"    {'peak':<10} {report['peak_bytes'] / 1024 / 1024:.1f}MB (tracemalloc)")
+        return '\n'.join(lines)
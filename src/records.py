@@ -0,0 +1,265 @@
+import os
+import json
+import threading
+from typing import Iterable
+
+from manifest import write_atomic
+
+ROOT_PATH = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+RECORDS_PATH = os.path.join(ROOT_PATH, 'resources', 'data', 'records.json')
+# 日志中积累的记录超过该数量时合并回 records.json
+COMPACT_SIZE = 256
+
+
+class FileLock(object):
+    '''
+    进程间的排他文件锁, 锁文件不存在时创建. 同一进程中的多个线程应另外加锁.
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = None
+
+    def __enter__(self) -> 'FileLock':
+        self._file = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            self._file.seek(0)
+            while True:
+                # LK_LOCK 重试 10 秒后仍失败时抛出 OSError, 继续等待
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+
+class RecordStore(object):
+    '''
+    出现过的相机与镜头, 供手动输入相机信息时选择.
+    records.json 为快照(格式不变), 新增的记录以 JSON 行追加到日志 records.journal, 日志过长时在文件锁内合并回快照,
+    多个进程(例如 GUI 与命令行)同时运行不会丢失记录. 内存中以集合判断是否已有, 第一次使用时才读取文件.
+    path 为 None 时只在内存中记录(多进程的工作进程), 由 take_new 取出新增的记录交给主进程.
+    '''
+    def __init__(self, path: str | None=RECORDS_PATH, flush_size: int=64, compact_size: int=COMPACT_SIZE) -> None:
+        self.path = path
+        self.flush_size = flush_size
+        self.compact_size = compact_size
+        self._lock = threading.Lock()
+        self._loaded = path is None
+        # 品牌 -> 型号列表(按出现顺序), 以及用于判断的集合
+        self._cameras = {}
+        self._camera_set = set()
+        self._lenses = []
+        self._lens_set = set()
+        # 尚未写入日志的记录
+        self._pending = []
+        # 日志中已读取到的位置与行数, 快照的 (修改时间, 大小)
+        self._offset = 0
+        self._journal_lines = 0
+        self._snapshot_fp = None
+
+    @property
+    def journal_path(self) -> str:
+        return os.path.splitext(self.path)[0] + '.journal'
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.splitext(self.path)[0] + '.lock'
+
+    def _insert(self, entry: tuple[str, str, str]) -> bool:
+        # 返回是否有新的相机或镜头
+        brand, model, lens = entry
+        new = False
+        if brand != '':
+            models = self._cameras.get(brand)
+            if models is None:
+                models = self._cameras[brand] = []
+                new = True
+            if model != '' and (brand, model) not in self._camera_set:
+                self._camera_set.add((brand, model))
+                models.append(model)
+                new = True
+        if lens != '' and lens not in self._lens_set:
+            self._lens_set.add(lens)
+            self._lenses.append(lens)
+            new = True
+        return new
+
+    def _read_snapshot(self) -> None:
+        self._cameras = {}
+        self._camera_set = set()
+        self._lenses = []
+        self._lens_set = set()
+        try:
+            st = os.stat(self.path)
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            self._snapshot_fp = None
+            data = {}
+        else:
+            self._snapshot_fp = (st.st_mtime_ns, st.st_size)
+        for brand, models in data.get('Camera_records', {}).items():
+            self._insert((brand, '', ''))
+            for model in models:
+                self._insert((brand, model, ''))
+        for lens in data.get('Lens_records', []):
+            self._insert(('', '', lens))
+        self._offset = 0
+        self._journal_lines = 0
+
+    def _read_journal(self) -> None:
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return
+        # 只处理完整的行, 崩溃时可能留下不完整的最后一行
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                self._insert(tuple(json.loads(line)))
+            except (ValueError, TypeError):
+                continue
+            self._journal_lines += 1
+        self._offset += end
+
+    def _refresh(self) -> None:
+        # 读取其他进程写入的记录; 快照被合并重写后重新读取
+        if self.path is None:
+            return
+        try:
+            st = os.stat(self.path)
+            snapshot_fp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            snapshot_fp = None
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except OSError:
+            journal_size = 0
+        if not self._loaded or snapshot_fp != self._snapshot_fp or journal_size < self._offset:
+            self._read_snapshot()
+            self._loaded = True
+        if journal_size > self._offset:
+            self._read_journal()
+        for entry in self._pending:
+            self._insert(entry)
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with FileLock(self.lock_path):
+                self._refresh()
+
+    def add(self, brand: str, model: str, lens: str) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            entry = (brand, model if brand != '' else '', lens)
+            if self._insert(entry):
+                self._pending.append(entry)
+                if self.path is not None and len(self._pending) >= self.flush_size:
+                    self._flush()
+
+    def add_exif(self, exif_data: dict) -> None:
+        brand = exif_data['CameraMaker'].split(" ")[0].title()
+        self.add(brand, exif_data['Camera'], exif_data.get('LenModel', ''))
+
+    def merge(self, entries: Iterable[tuple[str, str, str]]) -> None:
+        for entry in entries:
+            self.add(*entry)
+
+    def take_new(self) -> list:
+        '''
+        取出并清空尚未写入的记录, 用于工作进程把本张图片新增的记录交给主进程.
+        '''
+        with self._lock:
+            ret = self._pending
+            self._pending = []
+        return ret
+
+    def brands(self) -> list[str]:
+        with self._lock:
+            self._query()
+            return list(self._cameras)
+
+    def models(self, brand: str) -> list[str]:
+        with self._lock:
+            self._query()
+            return list(self._cameras.get(brand, []))
+
+    def lenses(self) -> list[str]:
+        with self._lock:
+            self._query()
+            return list(self._lenses)
+
+    def _query(self) -> None:
+        if self.path is None:
+            return
+        if not self._loaded:
+            self._ensure_loaded()
+        else:
+            with FileLock(self.lock_path):
+                self._refresh()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        data = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in self._pending).encode('utf-8')
+        with FileLock(self.lock_path):
+            # 先读取其他进程追加的记录, 本进程写入的内容随后跳过
+            self._refresh()
+            with open(self.journal_path, 'ab') as f:
+                if f.tell() > self._offset:
+                    # 日志以不完整的行结束, 先换行, 不与本次写入的第一行连在一起
+                    data = b'\n' + data
+                f.write(data)
+                self._offset = f.tell()
+            self._journal_lines += len(self._pending)
+            self._pending = []
+            if self._journal_lines >= self.compact_size:
+                self._compact()
+
+    def _compact(self) -> None:
+        # 调用方持有文件锁, 内存中已包含快照与日志中的全部记录
+        data = {'Camera_records': {brand: list(models) for brand, models in self._cameras.items()}, 'Lens_records': list(self._lenses)}
+        write_atomic(self.path, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        with open(self.journal_path, 'wb'):
+            pass
+        st = os.stat(self.path)
+        self._snapshot_fp = (st.st_mtime_ns, st.st_size)
+        self._offset = 0
+        self._journal_lines = 0
+
+    def save(self, compact: bool=False) -> None:
+        '''
+        把新增的记录追加到日志; compact 为 True 时同时合并回快照.
+        '''
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._pending and not compact:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._flush()
+            if compact:
+                with FileLock(self.lock_path):
+                    self._refresh()
+                    self._compact()
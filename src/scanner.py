@@ -0,0 +1,149 @@
+import os
+import queue
+import fnmatch
+import threading
+from typing import Callable, Iterator
+
+import ingest
+
+# 按扩展名识别时支持的格式, 不区分大小写
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.heic', '.heif')
+# 识别格式需要读取的文件头长度
+SNIFF_SIZE = 12
+# 默认的遍历线程数; 目录遍历主要等待文件系统(尤其是网络存储), 线程数可以多于 CPU 核数
+DEFAULT_WORKERS = 8
+_POLL_INTERVAL = 0.1
+
+
+def sniff(head: bytes) -> str | None:
+    '''
+    由文件头识别图片格式, 返回 'jpeg' / 'png' / 'heif', 不是支持的格式时返回 None.
+    '''
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if ingest.is_heif(head):
+        return 'heif'
+    return None
+
+
+def has_image_extension(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+class Scanner(object):
+    '''
+    基于 os.scandir 的目录扫描: 多个线程同时列出不同的子目录, 找到的图片边扫描边产出(顺序不固定).
+    sniff: 读取文件头识别格式, 不看扩展名. include/exclude: glob 模式, 与文件名或相对于根目录的路径(以 / 分隔)匹配,
+    include 只作用于文件, exclude 同时跳过匹配的目录. max_depth: 0 只扫描根目录本身, None 不限制.
+    无法读取的目录与文件直接跳过, 与 os.walk 相同.
+    '''
+    def __init__(self, workers: int=DEFAULT_WORKERS, sniff: bool=False, include: list | None=None, exclude: list | None=None, max_depth: int | None=None, follow_symlinks: bool=False) -> None:
+        self.workers = max(workers, 1)
+        self.sniff = sniff
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+
+    def _match(self, patterns: list, name: str, rel_path: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+    def _is_image(self, path: str, name: str, rel_path: str) -> bool:
+        if self.include and not self._match(self.include, name, rel_path):
+            return False
+        if not self.sniff:
+            return has_image_extension(name)
+        try:
+            with open(path, 'rb') as f:
+                return sniff(f.read(SNIFF_SIZE)) is not None
+        except OSError:
+            return False
+
+    def _scan_dir(self, path: str, rel_dir: str, depth: int, add_dir: Callable, out: queue.Queue) -> None:
+        # 子目录交给 add_dir; 同一目录中的图片一次交给调用方
+        found = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    rel_path = F"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    if self.exclude and self._match(self.exclude, entry.name, rel_path):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                            if self.max_depth is None or depth < self.max_depth:
+                                add_dir((entry.path, rel_path, depth + 1))
+                        elif entry.is_file() and self._is_image(entry.path, entry.name, rel_path):
+                            found.append(entry.path.replace('\\', '/') if os.sep == '\\' else entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        if found:
+            out.put(found)
+
+    def accepts(self, root: str, path: str) -> bool:
+        '''
+        scan(root) 是否会进入目录 path 或产出文件 path, 规则与扫描相同; 用于监视模式中逐个出现的文件与目录.
+        '''
+        rel_path = os.path.relpath(path, root).replace(os.sep, '/')
+        parts = rel_path.split('/')
+        # 扫描时被排除的目录中的文件不会被找到
+        if self.exclude and any(self._match(self.exclude, parts[i], '/'.join(parts[:i + 1])) for i in range(len(parts))):
+            return False
+        depth = len(parts) - 1
+        if os.path.isdir(path):
+            return self.max_depth is None or depth < self.max_depth
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        return self._is_image(path, parts[-1], rel_path)
+
+    def scan(self, root: str) -> Iterator[str]:
+        '''
+        产出 root 下的图片路径; root 为文件时只产出它本身. 提前关闭迭代器时遍历线程随即退出.
+        '''
+        if not os.path.isdir(root):
+            yield root
+            return
+        dirs = queue.Queue()
+        out = queue.Queue()
+        stop = threading.Event()
+        # 尚未扫描完的目录数, 降为 0 时全部线程退出; 子目录在放入队列前计入,
+        # 否则其他线程可能先扫描完子目录, 在父目录的图片交出之前就判断为结束
+        remaining = [1]
+        lock = threading.Lock()
+        dirs.put((root, '', 0))
+
+        def add_dir(item: tuple) -> None:
+            with lock:
+                remaining[0] += 1
+            dirs.put(item)
+
+        def work():
+            while not stop.is_set():
+                try:
+                    path, rel_dir, depth = dirs.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                self._scan_dir(path, rel_dir, depth, add_dir, out)
+                with lock:
+                    remaining[0] -= 1
+                    finished = remaining[0] == 0
+                if finished:
+                    stop.set()
+                    out.put(None)
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                found = out.get()
+                if found is None:
+                    break
+                yield from found
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,120 @@
+import os
+import sys
+import math
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Pillow 中 RGB/RGBA 图像每像素占 4 字节
+PIXEL_BYTES = 4
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+_POLL_INTERVAL = 0.1
+
+
+def parse_size(text: str) -> int | None:
+    '''
+    '512M'、'16G'、'1.5g' 或字节数; '0' 表示不限制, 返回 None.
+    '''
+    text = text.strip().upper().removesuffix('B').removesuffix('I')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    value = float(text[:len(text) - len(unit)])
+    if value < 0:
+        raise ValueError(F"Invalid size: {text}")
+    size = int(value * SIZE_UNITS[unit])
+    return size if size > 0 else None
+
+
+def format_size(size: int | None) -> str:
+    if size is None:
+        return "不限"
+    return F"{size / 1024 / 1024:.0f}MB"
+
+
+def physical_memory() -> int | None:
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_budget() -> int | None:
+    # 默认使用物理内存的一半, 其余留给解释器、工作进程本身与系统; 无法获取时不限制
+    memory = physical_memory()
+    return memory // 2 if memory else None
+
+
+def peak_rss() -> int | None:
+    '''
+    本进程与已结束子进程的最大常驻内存(字节), 不支持的平台返回 None.
+    '''
+    if resource is None:
+        return None
+    # Linux 以 KB 为单位, macOS 以字节为单位
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def draft_pixels(width: int, height: int, target: tuple[int, int]) -> int:
+    '''
+    JPEG draft 以 1/2、1/4、1/8 缩小解码, 取仍不小于目标尺寸的最小比例.
+    '''
+    for scale in (8, 4, 2):
+        w, h = math.ceil(width / scale), math.ceil(height / scale)
+        if w >= target[0] and h >= target[1]:
+            return w * h
+    return width * height
+
+
+class MemoryBudget(object):
+    '''
+    按预估的单张峰值内存准入任务: 在途任务的预估总和不超过 limit.
+    小图可以同时处理多张, 大图只能等前面的任务释放; 单张超过 limit 时等到没有其他任务再单独处理.
+    limit 为 None 时不限制, 只统计峰值.
+    '''
+    def __init__(self, limit: int | None=None) -> None:
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.admitted = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, cost: int) -> bool:
+        return self.limit is None or self.in_use == 0 or self.in_use + cost <= self.limit
+
+    def acquire(self, cost: int, stop: threading.Event | None=None, blocking: bool=True) -> bool:
+        '''
+        占用 cost 字节; 不够时阻塞等待, stop 被设置或 blocking 为 False 时返回 False.
+        '''
+        with self._cond:
+            if not self._fits(cost):
+                if not blocking:
+                    return False
+                while not self._fits(cost):
+                    if stop is not None and stop.is_set():
+                        return False
+                    self._cond.wait(_POLL_INTERVAL)
+            self.in_use += cost
+            self.admitted += 1
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self, cost: int) -> None:
+        with self._cond:
+            self.in_use -= cost
+            self._cond.notify_all()
+
+    def report(self) -> dict:
+        return {
+            'budget': self.limit,
+            'peak_estimated': self.peak,
+            'peak_rss': peak_rss(),
+            'admitted': self.admitted,
+        }
+
+    def format_report(self) -> str:
+        report = self.report()
+        rss = format_size(report['peak_rss']) if report['peak_rss'] is not None else "未知"
+        return F"内存预算 {format_size(self.limit)}, 预估峰值 {format_size(self.peak)}, 进程峰值 {rss}"
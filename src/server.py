@@ -0,0 +1,232 @@
+import sys
+import json
+import time
+import signal
+import argparse
+import datetime
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import ingest
+import encoder
+import watermark
+import scheduler
+from pipeline import RenderJob, RenderSettings
+from profiling import percentile
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# 单个请求体的上限(字节)
+MAX_BODY = 256 * 1024 * 1024
+# 延迟统计保留最近的样本数
+LATENCY_WINDOW = 1000
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp', 'avif': 'image/avif', 'heif': 'image/heif'}
+# 渲染结果 -> HTTP 状态码
+STATUS_CODES = {'ok': 200, 'no_exif': 422, 'no_logo': 422, 'error': 500}
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    '''
+    POST /render: 请求体为图片内容, 返回加水印后的图片.
+        参数(query string): format=jpg|png|webp|avif|heif, quality=1-100(默认取决于编码预设), resolution=original|1080P|2k, name=文件名(仅用于日志),
+        brand/model/lens: 指定后不再读取 exif, 与 run2 相同.
+    GET /health: 工作池使用情况与延迟.
+    '''
+    server: 'RenderServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format: str, *args) -> None:
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {self.address_string()} {format % args}\n", end='')
+
+    def _send(self, code: int, body: bytes, content_type: str, headers: dict | None=None) -> None:
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code: int, fields: dict, headers: dict | None=None) -> None:
+        self._send(code, json.dumps(fields, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8', headers)
+
+    def _error(self, code: int, message: str, headers: dict | None=None) -> None:
+        self._send_json(code, {'error': message}, headers)
+
+    def do_GET(self) -> None:
+        if urlsplit(self.path).path == '/health':
+            self._send_json(200, self.server.health())
+        else:
+            self._error(404, "not found")
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != '/render':
+            self.close_connection = True
+            self._error(404, "not found")
+            return
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.close_connection = True
+            self._error(411, "Content-Length is required")
+            return
+        length = int(length)
+        if length > self.server.max_body:
+            self.close_connection = True
+            self._error(413, F"request body is larger than {self.server.max_body} bytes")
+            return
+        if not self.server.pool.accepting():
+            # 工作池已满时不再读取请求体, 直接拒绝
+            self.close_connection = True
+            self._error(503, "server is busy", {'Retry-After': '1'})
+            return
+
+        # 工作池启动时已导入 Pillow, 这里的导入不增加开销
+        from PIL import Image, UnidentifiedImageError
+        data = self.rfile.read(length)
+        try:
+            job = self.server.new_job(parse_qs(url.query), data)
+        except ValueError as e:
+            self._error(400, str(e))
+            return
+        except UnidentifiedImageError:
+            self._error(415, "unsupported image format")
+            return
+        except Image.DecompressionBombError as e:
+            self._error(413, str(e))
+            return
+        except (OSError, SyntaxError) as e:
+            # 图片头损坏或被截断
+            self._error(400, F"invalid image: {e}")
+            return
+        except Exception as e:
+            self.log_error("failed to create job: %s: %s", type(e).__name__, e)
+            self._error(500, "internal error")
+            return
+
+        start = time.perf_counter()
+        job = self.server.pool.render(job)
+        if job is None:
+            self._error(503, "server is busy", {'Retry-After': '1'})
+            return
+        self.server.record_latency(time.perf_counter() - start)
+        if job.status != 'ok':
+            self._error(STATUS_CODES.get(job.status, 500), job.error or job.status)
+            return
+        self._send(200, job.output, CONTENT_TYPES[job.settings.out_format], {'X-Render-Time': F"{job.elapsed:.4f}"})
+
+
+class RenderServer(ThreadingHTTPServer):
+    '''
+    可嵌入的渲染服务: 图片在内存中处理, 不写临时文件. 工作池在启动时预热, 已满时以 503 拒绝请求.
+    serve_forever 在当前线程运行, 用 shutdown 停止, server_close 关闭工作池. 上传的图片不加入相机/镜头记录.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], agent: 'watermark.WaterMarkAgent', workers: int | None=None, backend: str='thread', queue_size: int | None=None, max_body: int=MAX_BODY) -> None:
+        self.agent = agent
+        self.max_body = max_body
+        self.pool = agent.worker_pool(workers, backend, queue_size)
+        # 当前环境能够编码的输出格式, 其他格式在渲染前以 400 拒绝
+        self.out_formats = watermark.SUPPORT_OUT_FORMAT
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        try:
+            super().__init__(address, RenderHandler)
+        except Exception:
+            self.pool.close()
+            raise
+
+    def new_job(self, query: dict, data: bytes) -> RenderJob:
+        '''
+        由请求参数与请求体创建任务, 参数无效时抛出 ValueError; 只读取图片头, 无法识别的图片抛出 UnidentifiedImageError, 像素数超过 Pillow 上限时抛出 DecompressionBombError, 头部损坏时抛出 OSError 或 SyntaxError.
+        '''
+        params = {key: values[-1] for key, values in query.items()}
+        out_format = params.get('format', 'jpg')
+        if out_format not in self.out_formats:
+            raise ValueError(F"unsupported format: {out_format}, available: {', '.join(self.out_formats)}")
+        quality = params.get('quality', str(encoder.get_preset(self.agent.encode_preset).quality))
+        if not quality.isdigit() or not 1 <= int(quality) <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        resolution_key = watermark.RESOLUTION_ALIASES.get(params.get('resolution', 'original'), params.get('resolution'))
+        if resolution_key not in watermark.OUT_RESOLUTION:
+            raise ValueError(F"unsupported resolution: {params['resolution']}")
+        exif_data = None
+        if any(key in params for key in ('brand', 'model', 'lens')):
+            exif_data = watermark.manual_exif(params.get('brand', ''), params.get('model', ''), params.get('lens', ''))
+        # 只读取文件头
+        ingest.open_image(data).close()
+
+        settings = RenderSettings(None, out_format, int(quality), watermark.OUT_RESOLUTION[resolution_key])
+        job = RenderJob(0, params.get('name', 'upload'), settings, exif_data)
+        job.data = data
+        job.in_memory = True
+        return job
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def health(self) -> dict:
+        with self._lock:
+            latencies = list(self._latencies)
+        return {
+            'status': 'ok',
+            'uptime': time.monotonic() - self._start,
+            'pool': self.pool.stats(),
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p95': percentile(latencies, 0.95),
+            'latency_max': max(latencies) if latencies else 0.0,
+        }
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='server.py', description='Serve Mi&Leica style watermark rendering over HTTP.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int)
+    parser.add_argument('-j', '--workers', default=None, type=int, help='photos rendered at the same time, defaults to the CPU count')
+    parser.add_argument('-b', '--backend', default='thread', choices=['thread', 'process'], help='execution backend')
+    parser.add_argument('--queue', default=None, type=int, help='requests allowed to wait for a worker before new ones are rejected with 503, defaults to the worker count')
+    parser.add_argument('--max-body', default='256M', help='largest accepted upload, e.g. 64M')
+    parser.add_argument('--memory-budget', default=None, help='memory allowed for photos in flight, e.g. 8G; 0 for no limit; defaults to half of the physical memory')
+    parser.add_argument('--lossless', action='store_true', help='for jpg at original resolution, keep the photo\'s JPEG data and only encode the watermark band')
+    parser.add_argument('-p', '--preset', default=encoder.DEFAULT_PRESET, choices=list(encoder.PRESETS), help='encoder settings: standard, fast-preview, web or archive')
+    return parser
+
+
+def main(argv: list | None=None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        max_body = scheduler.parse_size(args.max_body) or MAX_BODY
+        memory_budget = scheduler.parse_size(args.memory_budget) if args.memory_budget is not None else None
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    agent = watermark.WaterMarkAgent()
+    if args.memory_budget is not None:
+        agent.memory_budget = memory_budget
+    agent.lossless_jpeg = args.lossless
+    agent.encode_preset = args.preset
+    server = RenderServer((args.host, args.port), agent, args.workers, args.backend, args.queue, max_body)
+    # shutdown 需要在 serve_forever 之外的线程中调用
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 服务已启动: http://{server.server_address[0]}:{server.server_address[1]} ({args.backend} x {server.pool.workers})\n", end='')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
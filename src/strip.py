@@ -0,0 +1,187 @@
+import os
+import time
+import datetime
+from typing import Callable
+
+from PIL import Image, ImageDraw
+
+import assets
+from profiling import NULL_TIMER, NullTimer, StageTimer
+
+FONT_FILE_1 = os.path.join(assets.FONTS_PATH, 'MiSans-Demibold.ttf')
+FONT_FILE_2 = os.path.join(assets.FONTS_PATH, 'MiSans-Regular.ttf')
+GUIDELINE_COLOR = "#D0D0D0"
+
+# 水印条不变部分的缓存, 单张可达数十 MB, 因此只保留少量
+STRIP_CACHE = assets.LRUCache(4)
+
+
+class StripLayout(object):
+    '''
+    水印条几何参数, 坐标均相对于水印条左上角.
+    '''
+    __slots__ = ('width', 'height', 'margin', 'content_height', 'guideline_logo_margin', 'guideline_width', 'font_pt_1', 'font_pt_2')
+
+    def __init__(self, width: int, height: int, margin: int, content_height: int, guideline_logo_margin: int, guideline_width: int, font_pt_1: int, font_pt_2: int) -> None:
+        self.width = width
+        self.height = height
+        self.margin = margin
+        self.content_height = content_height
+        self.guideline_logo_margin = guideline_logo_margin
+        self.guideline_width = guideline_width
+        self.font_pt_1 = font_pt_1
+        self.font_pt_2 = font_pt_2
+
+    def key(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+def logo_brand(camera_maker: str) -> str:
+    brand = camera_maker.split(' ')[0]
+    brand = brand.title()
+    if brand == 'Xiaomi':
+        brand = 'Leica'
+    return brand
+
+
+def _get_logo(brand: str, content_height: int) -> tuple[Image.Image, Image.Image] | None:
+    logo = assets.get_logo(brand, content_height)
+    if logo is None:
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {brand}'s logo doesn't exist.\n", end='')
+    return logo
+
+
+def _render_base(layout: StripLayout, left_text_1: str, left_text_2: str) -> Image.Image:
+    band = Image.new("RGB", (layout.width, layout.height), 'white')
+    _draw_base(band, layout, left_text_1, left_text_2)
+    return band
+
+
+# 以下 _draw_* 在 band 上绘制水印条, dy 为水印条第 0 行在 band 中的纵坐标; 只绘制水印条的一部分行时 dy 为负
+def _draw_base(band: Image.Image, layout: StripLayout, left_text_1: str, left_text_2: str, dy: int=0) -> None:
+    draw = ImageDraw.Draw(band)
+    font_1 = assets.get_font(FONT_FILE_1, layout.font_pt_1)
+    font_2 = assets.get_font(FONT_FILE_2, layout.font_pt_2)
+    draw.text((layout.margin, layout.margin + dy), left_text_1, fill='black', anchor="lt", font=font_1)
+    draw.text((layout.margin, layout.height - layout.margin + dy), left_text_2, fill='#888888', anchor="ls", font=font_2)
+
+
+def render_strip(layout: StripLayout, exif_data: dict, timer: NullTimer | StageTimer=NULL_TIMER) -> Image.Image | None:
+    '''
+    左侧机型/镜头, 右侧拍摄参数/时间. 白底与左侧文字按 (布局, 机型, 镜头) 缓存,
+    每张图片只绘制右侧文字、分隔线和 logo.
+    '''
+    with timer('logo'):
+        logo = _get_logo(logo_brand(exif_data['CameraMaker']), layout.content_height)
+    if logo is None:
+        return None
+
+    with timer('text'):
+        return _render_strip(layout, exif_data, logo)
+
+
+def _render_strip(layout: StripLayout, exif_data: dict, logo: tuple[Image.Image, Image.Image]) -> Image.Image:
+    left_text_1 = exif_data['Camera']
+    left_text_2 = exif_data['LenModel']
+    base = STRIP_CACHE.get((1, layout.key(), left_text_1, left_text_2), lambda: _render_base(layout, left_text_1, left_text_2))
+    band = base.copy()
+    _draw_right(band, layout, exif_data, logo)
+    return band
+
+
+def _draw_right(band: Image.Image, layout: StripLayout, exif_data: dict, logo: tuple[Image.Image, Image.Image], dy: int=0) -> None:
+    # 等效焦距
+    right_text_1 = F"{exif_data['35mmFilm']}mm f/{exif_data['FNumber']} {exif_data['ExposureTime']}s ISO{exif_data['ISO']}"
+    right_text_2 = exif_data['DateTime']
+
+    draw = ImageDraw.Draw(band)
+    font_1 = assets.get_font(FONT_FILE_1, layout.font_pt_1)
+    font_2 = assets.get_font(FONT_FILE_2, layout.font_pt_2)
+
+    text_1_top = layout.margin + dy
+    text_2_baseline = layout.height - layout.margin + dy
+    draw.text((layout.width - layout.margin, text_1_top), right_text_1, fill='black', anchor="rt", font=font_1)
+    r_text_1_width = int(font_1.getlength(right_text_1))
+    draw.text((layout.width - layout.margin - r_text_1_width, text_2_baseline), right_text_2, fill='#888888', anchor="ls", font=font_2)
+
+    # draw guideline
+    guideline = Image.new("RGB", (layout.guideline_width, layout.content_height), GUIDELINE_COLOR)
+    guideline_left = layout.width - layout.margin - r_text_1_width - layout.guideline_logo_margin
+    band.paste(guideline, (guideline_left, text_1_top))
+
+    # draw logo
+    logo_img, logo_mask = logo
+    logo_left = layout.width - layout.margin - r_text_1_width - 2 * layout.guideline_logo_margin - layout.content_height
+    band.paste(logo_img, (logo_left, text_1_top), mask=logo_mask)
+
+
+def _render_strip2(layout: StripLayout, logo: tuple[Image.Image, Image.Image], right_text_1: str, right_text_2: str) -> Image.Image:
+    band = Image.new("RGB", (layout.width, layout.height), 'white')
+    _draw_strip2(band, layout, logo, right_text_1, right_text_2)
+    return band
+
+
+def _draw_strip2(band: Image.Image, layout: StripLayout, logo: tuple[Image.Image, Image.Image], right_text_1: str, right_text_2: str, dy: int=0) -> None:
+    # draw guideline
+    guideline = Image.new("RGB", (layout.guideline_width, layout.content_height), GUIDELINE_COLOR)
+    guideline_left = int(layout.width / 2)
+    guideline_top = layout.margin + dy
+    band.paste(guideline, (guideline_left, guideline_top))
+
+    # draw logo
+    logo_img, logo_mask = logo
+    logo_left = guideline_left - layout.guideline_logo_margin - layout.content_height
+    band.paste(logo_img, (logo_left, guideline_top), mask=logo_mask)
+
+    # draw text
+    draw = ImageDraw.Draw(band)
+    font_1 = assets.get_font(FONT_FILE_1, layout.font_pt_1)
+    font_2 = assets.get_font(FONT_FILE_2, layout.font_pt_2)
+    text_1_left = guideline_left + layout.guideline_logo_margin
+    draw.text((text_1_left, guideline_top), right_text_1, fill='black', anchor="lt", font=font_1)
+    draw.text((text_1_left, layout.height - layout.margin + dy), right_text_2, fill='#888888', anchor="ls", font=font_2)
+
+
+def render_strip2(layout: StripLayout, exif_data: dict, timer: NullTimer | StageTimer=NULL_TIMER) -> Image.Image | None:
+    '''
+    手动输入信息的居中样式, 整条水印都不随图片变化, 直接返回缓存(只读).
+    '''
+    brand = logo_brand(exif_data['CameraMaker'])
+    with timer('logo'):
+        logo = _get_logo(brand, layout.content_height)
+    if logo is None:
+        return None
+
+    right_text_1, right_text_2 = _strip2_texts(exif_data)
+    with timer('text'):
+        return STRIP_CACHE.get((2, layout.key(), brand, right_text_1, right_text_2), lambda: _render_strip2(layout, logo, right_text_1, right_text_2))
+
+
+def _strip2_texts(exif_data: dict) -> tuple[str, str]:
+    right_text_2 = exif_data['LenModel']
+    if not right_text_2:
+        right_text_2 = time.strftime("%Y.%m.%d", time.localtime())
+    return exif_data['Camera'], right_text_2
+
+
+def band_painter(layout: StripLayout, exif_data: dict, manual: bool=False, timer: NullTimer | StageTimer=NULL_TIMER) -> Callable[[int, int], Image.Image] | None:
+    '''
+    分段绘制水印条, 用于超大图片: 返回 paint(y0, y1), 得到水印条第 y0 到 y1 行, 与整条绘制后裁剪的结果相同.
+    整条水印条不会同时存在于内存中, 也不进入缓存. 没有 logo 时返回 None.
+    '''
+    with timer('logo'):
+        logo = _get_logo(logo_brand(exif_data['CameraMaker']), layout.content_height)
+    if logo is None:
+        return None
+
+    texts = _strip2_texts(exif_data) if manual else None
+
+    def paint(y0: int, y1: int) -> Image.Image:
+        band = Image.new("RGB", (layout.width, y1 - y0), 'white')
+        if manual:
+            _draw_strip2(band, layout, logo, *texts, dy=-y0)
+        else:
+            _draw_base(band, layout, exif_data['Camera'], exif_data['LenModel'], dy=-y0)
+            _draw_right(band, layout, exif_data, logo, dy=-y0)
+        return band
+    return paint
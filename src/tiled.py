@@ -0,0 +1,182 @@
+import io
+import zlib
+import struct
+from typing import Callable, Iterator
+
+from PIL import Image, ImageChops
+
+import jpegtools
+from strip import StripLayout
+from encoder import EncodePreset
+from profiling import NULL_TIMER, NullTimer, StageTimer
+
+# 每条输出的像素数, 分条处理时的峰值内存由它决定, 与图片面积无关
+STRIP_PIXELS = 16 * 1024 * 1024
+# 支持分条编码的输出格式
+OUT_FORMATS = ('jpg', 'png')
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def strip_rows(width: int, strip_pixels: int=STRIP_PIXELS) -> int:
+    # 每条的行数, 对齐到 JPEG 的 MCU 高度
+    align = jpegtools.StripWriter.STRIP_ALIGN
+    return max(strip_pixels // max(width, 1) // align, 1) * align
+
+
+class PhotoRows(object):
+    '''
+    自上而下逐段读取照片的像素行. 有重启间隔的基线 JPEG 每次只解码一段(见 jpegtools.RowSplitter),
+    其他图片第一次读取时整张解码. img 为尚未解码的图片, data 为其文件内容.
+    '''
+    def __init__(self, img: Image.Image, data: bytes, strip_pixels: int=STRIP_PIXELS) -> None:
+        self.width, self.height = img.size
+        self.splitter = None
+        if img.format in ('JPEG', 'MPO'):
+            source = jpegtools.parse(data)
+            if source is not None and (source.width, source.height) == img.size:
+                self.splitter = jpegtools.row_splitter(source, strip_rows(self.width, strip_pixels))
+        if self.splitter is not None:
+            img.close()
+            self._chunks = self._split_chunks(strip_rows(self.width, strip_pixels))
+        else:
+            self._chunks = self._image_chunks(img)
+        # 当前一段: (图像, 下一行在图像中的位置, 结束行)
+        self._chunk = None
+
+    @property
+    def streamed(self) -> bool:
+        return self.splitter is not None
+
+    def _split_chunks(self, rows: int) -> Iterator[tuple[Image.Image, int, int]]:
+        splitter = self.splitter
+        step = max(rows // splitter.unit_rows, 1)
+        for u0 in range(0, splitter.units, step):
+            u1 = min(u0 + step, splitter.units)
+            # 上下各多解码一个单元, 边界处的色度上采样与整张解码相同
+            a, b = max(u0 - 1, 0), min(u1 + 1, splitter.units)
+            img = Image.open(io.BytesIO(splitter.extract(a, b)))
+            img.load()
+            top = (u0 - a) * splitter.unit_rows
+            yield img, top, top + min(u1 * splitter.unit_rows, self.height) - u0 * splitter.unit_rows
+
+    def _image_chunks(self, img: Image.Image) -> Iterator[tuple[Image.Image, int, int]]:
+        img.load()
+        # 非 RGB 的图片与常规方式一样在粘贴时转换
+        yield img, 0, self.height
+
+    def paste_into(self, dst: Image.Image, x: int, y: int, rows: int, timer: NullTimer | StageTimer=NULL_TIMER) -> None:
+        '''
+        读取接下来的 rows 行, 粘贴到 dst 的 (x, y) 处.
+        '''
+        while rows > 0:
+            if self._chunk is None or self._chunk[1] >= self._chunk[2]:
+                with timer('decode'):
+                    self._chunk = next(self._chunks)
+                timer.count('pixels_in', self.width * (self._chunk[2] - self._chunk[1]))
+            img, top, bottom = self._chunk
+            n = min(rows, bottom - top)
+            with timer('compose'):
+                dst.paste(img.crop((0, top, self.width, top + n)), (x, y))
+            self._chunk = (img, top + n, bottom)
+            y += n
+            rows -= n
+        if self._chunk[1] >= self._chunk[2]:
+            self._chunk = None
+
+    def close(self) -> None:
+        self._chunk = None
+        self._chunks.close()
+
+
+def _png_chunk(kind: bytes, body: bytes) -> bytes:
+    return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+
+class PngStripWriter(object):
+    '''
+    逐条写出 RGB 的 PNG: 每行使用 Sub 过滤, IDAT 数据由同一个 zlib 流连续压缩.
+    '''
+    def __init__(self, write: Callable[[bytes], None], width: int, height: int, dpi: tuple[int, int], compress_level: int=6, exif: bytes | None=None, icc_profile: bytes | None=None) -> None:
+        self.write = write
+        # pHYs 以每米像素数记录分辨率, 换算方式与 Pillow 相同
+        ppm = tuple(int(d / 0.0254 + 0.5) for d in dpi)
+        header = [_PNG_SIGNATURE, _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))]
+        if icc_profile:
+            header.append(_png_chunk(b'iCCP', b'ICC Profile\x00\x00' + zlib.compress(icc_profile)))
+        header.append(_png_chunk(b'pHYs', struct.pack('>IIB', ppm[0], ppm[1], 1)))
+        if exif:
+            header.append(_png_chunk(b'eXIf', exif.removeprefix(b'Exif\x00\x00')))
+        write(b''.join(header))
+        self._compressor = zlib.compressobj(compress_level)
+
+    def add(self, strip: Image.Image) -> None:
+        width, height = strip.size
+        # Sub 过滤: 每个字节减去左侧像素的同一通道
+        shifted = Image.new('RGB', strip.size, 0)
+        shifted.paste(strip.crop((0, 0, width - 1, height)), (1, 0))
+        filtered = ImageChops.subtract_modulo(strip, shifted).tobytes()
+        stride = 3 * width
+        raw = b''.join(b'\x01' + filtered[i:i + stride] for i in range(0, len(filtered), stride))
+        data = self._compressor.compress(raw)
+        if data:
+            self.write(_png_chunk(b'IDAT', data))
+
+    def close(self) -> None:
+        self.write(_png_chunk(b'IDAT', self._compressor.flush()) + _png_chunk(b'IEND', b''))
+
+
+class TiledImage(object):
+    '''
+    超大图片的分条渲染: 输出按条自上而下生成, 每条依次填入白底、照片的对应行与水印条的对应行后立即编码写出.
+    不生成整张画布与整条水印条, 照片能逐段解码时也不保留整张照片, 峰值内存由每条的高度决定.
+    输出与常规方式的像素完全相同(见 WaterMarkAgent._draw_watermark).
+    '''
+    __slots__ = ('photo', 'margin', 'layout', 'paint')
+
+    def __init__(self, photo: PhotoRows, margin: int, layout: StripLayout) -> None:
+        self.photo = photo
+        self.margin = margin
+        self.layout = layout
+        # 水印条的分段绘制, 见 strip.band_painter
+        self.paint = None
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.layout.width, self.margin + self.photo.height + self.layout.height
+
+    def write(self, write: Callable[[bytes], None], out_format: str, out_quality: int, preset: EncodePreset, metadata: tuple | None=None, timer: NullTimer | StageTimer=NULL_TIMER, strip_pixels: int=STRIP_PIXELS) -> None:
+        '''
+        preset 中的采样方式、压缩级别与 exif/ICC 照常生效; JPEG 的 optimize 与 progressive 不适用于分条编码, 忽略.
+        metadata 为原图的 (exif, ICC 描述文件).
+        '''
+        width, height = self.size
+        options = preset.save_options(out_format, out_quality, *(metadata or ()))
+        if out_format == 'jpg':
+            extra = {key: options[key] for key in ('exif', 'icc_profile') if key in options}
+            writer = jpegtools.StripWriter(write, width, height, out_quality, options['dpi'], options.get('subsampling', 2), extra)
+        elif out_format == 'png':
+            writer = PngStripWriter(write, width, height, options['dpi'], options.get('compress_level', 6), options.get('exif'), options.get('icc_profile'))
+        else:
+            raise ValueError(F"unsupported output format for tiled rendering: {out_format}")
+        photo_top = self.margin
+        photo_bottom = self.margin + self.photo.height
+        rows = strip_rows(width, strip_pixels)
+        try:
+            for y0 in range(0, height, rows):
+                y1 = min(y0 + rows, height)
+                with timer('compose'):
+                    strip = Image.new('RGB', (width, y1 - y0), 'white')
+                top, bottom = max(y0, photo_top), min(y1, photo_bottom)
+                if top < bottom:
+                    self.photo.paste_into(strip, self.margin, top - y0, bottom - top, timer)
+                top = max(y0, photo_bottom)
+                if top < y1:
+                    with timer('compose'):
+                        strip.paste(self.paint(top - photo_bottom, y1 - photo_bottom), (0, top - y0))
+                with timer('encode'):
+                    writer.add(strip)
+            with timer('encode'):
+                writer.close()
+        finally:
+            self.photo.close()
@@ -0,0 +1,326 @@
+import os
+import time
+import queue
+import select
+import struct
+import datetime
+import threading
+from collections import deque
+from typing import Callable, Iterable, Iterator
+
+import watermark
+from pipeline import RenderJob, RenderSettings
+from profiling import percentile
+
+# 文件在该时间内大小与修改时间都不再变化, 才视为写入完成
+SETTLE_TIME = 1.0
+POLL_INTERVAL = 1.0
+# 延迟统计保留最近的样本数
+LATENCY_WINDOW = 1000
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _fingerprint(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Inotify(object):
+    '''
+    通过 ctypes 调用 libc 的 inotify, 不可用时(非 Linux)构造时抛出 OSError.
+    '''
+    def __init__(self) -> None:
+        # ctypes 只在监视模式下导入
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def add_watch(self, path: str) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(self._ctypes.get_errno(), F"inotify_add_watch failed: {path}")
+        self.paths[wd] = path
+
+    def read(self, timeout: float) -> list[tuple[str, int]]:
+        '''
+        等待最多 timeout 秒, 返回 [(路径, mask)]; 事件队列溢出时返回 [('', IN_Q_OVERFLOW)].
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        ret = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                ret.append(('', IN_Q_OVERFLOW))
+            elif wd in self.paths:
+                ret.append((os.path.join(self.paths[wd], os.fsdecode(name)), mask))
+        return ret
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class FolderWatcher(object):
+    '''
+    监视若干目录(含子目录), 逐个产出写入完成的新文件或被修改的文件. 启动时已有的文件同样产出一次.
+    优先使用 inotify, 不可用时每 poll_interval 秒扫描一次目录.
+    accept(path) 为 False 的文件与目录被忽略.
+    '''
+    def __init__(self, dirs: Iterable[str], accept: Callable[[str], bool], settle: float=SETTLE_TIME, poll_interval: float=POLL_INTERVAL, use_inotify: bool=True) -> None:
+        self.dirs = [os.path.abspath(d) for d in dirs]
+        self.accept = accept
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.inotify = None
+        self.mode = 'polling'
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+                self.mode = 'inotify'
+            except OSError as e:
+                print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] inotify 不可用, 改为定时扫描: {e}\n", end='')
+        # 等待写入完成的文件: 路径 -> (fingerprint, 最近一次变化的时间)
+        self.pending = {}
+        # 定时扫描模式下已知文件的 fingerprint
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def _scan(self, root: str) -> Iterator[str]:
+        for path, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if self.accept(os.path.join(path, d))]
+            if self.inotify is not None:
+                try:
+                    self.inotify.add_watch(path)
+                except OSError as e:
+                    print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 无法监视 {path}: {e}\n", end='')
+            for file in files:
+                image_file = os.path.join(path, file)
+                if self.accept(image_file):
+                    yield image_file
+
+    def _touch(self, path: str, now: float) -> None:
+        fp = _fingerprint(path)
+        if fp is None:
+            return
+        with self._lock:
+            self.pending[path] = (fp, now)
+
+    def _settled(self, now: float) -> list[str]:
+        ret = []
+        with self._lock:
+            for path, (fp, changed) in list(self.pending.items()):
+                if now - changed < self.settle:
+                    continue
+                new_fp = _fingerprint(path)
+                if new_fp is None:
+                    del self.pending[path]
+                elif new_fp != fp:
+                    self.pending[path] = (new_fp, now)
+                else:
+                    del self.pending[path]
+                    ret.append(path)
+        return ret
+
+    def _poll(self, now: float) -> None:
+        seen = {}
+        for root in self.dirs:
+            for path in self._scan(root):
+                fp = _fingerprint(path)
+                if fp is not None:
+                    seen[path] = fp
+                    if self._known.get(path) != fp:
+                        self._touch(path, now)
+        self._known = seen
+
+    def _handle_events(self, events: list, now: float) -> None:
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                # 丢失了事件, 重新扫描全部目录
+                for root in self.dirs:
+                    for image_file in self._scan(root):
+                        self._touch(image_file, now)
+            elif mask & IN_ISDIR:
+                # 新建或移入的子目录: 加入监视, 并处理监视建立前已写入的文件
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.accept(path):
+                    for image_file in self._scan(path):
+                        self._touch(image_file, now)
+            elif self.accept(path):
+                self._touch(path, now)
+
+    def events(self, stop: threading.Event) -> Iterator[str]:
+        '''
+        直到 stop 被设置前不断产出写入完成的文件路径.
+        '''
+        now = time.monotonic()
+        for root in self.dirs:
+            for image_file in self._scan(root):
+                self._touch(image_file, now)
+                self._known[image_file] = _fingerprint(image_file)
+        last_poll = now
+        try:
+            while not stop.is_set():
+                # 有等待中的文件时缩短等待, 以便及时判断是否写入完成
+                timeout = min(self.settle, self.poll_interval) / 2 if self.pending else self.poll_interval
+                if self.inotify is not None:
+                    self._handle_events(self.inotify.read(timeout), time.monotonic())
+                else:
+                    stop.wait(timeout)
+                    if time.monotonic() - last_poll >= self.poll_interval:
+                        last_poll = time.monotonic()
+                        self._poll(last_poll)
+                yield from self._settled(time.monotonic())
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+
+class WatchService(object):
+    '''
+    常驻服务: 监视输入目录, 把写入完成的新图片或修改过的图片交给常驻的多线程流水线处理.
+    字体、logo、元数据索引与输出清单在整个运行期间保持加载; 输出已是最新的图片直接跳过.
+    图片按 agent.scanner 的规则(include/exclude、sniff、max_depth)识别, 与批量处理相同.
+    相机/镜头记录在停止时保存.
+    '''
+    def __init__(self, agent: 'watermark.WaterMarkAgent', in_dirs: Iterable[str], out_dir: str=watermark.DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution_key: str='原图分辨率', workers: int | None=None, settle: float=SETTLE_TIME, poll_interval: float=POLL_INTERVAL, use_inotify: bool=True, callback: Callable[[RenderJob], None] | None=None) -> None:
+        self.agent = agent
+        self.out_dir = os.path.abspath(out_dir)
+        self.settings = RenderSettings(out_dir, out_format, out_quality, watermark.OUT_RESOLUTION[resolution_key])
+        self.workers = workers
+        self.callback = callback
+        self.watcher = FolderWatcher(in_dirs, self._accept, settle, poll_interval, use_inotify)
+        self.stop_event = threading.Event()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # 入队时间, 同一文件可能多次入队
+        self._enqueued = {}
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._render_times = deque(maxlen=LATENCY_WINDOW)
+        self._statuses = {}
+        self._detected = 0
+        self._completed = 0
+        self._start = time.monotonic()
+
+    def _accept(self, path: str) -> bool:
+        # 输出目录位于输入目录中时, 不能把输出再当作输入
+        path = os.path.abspath(path)
+        if path == self.out_dir or path.startswith(self.out_dir + os.sep):
+            return False
+        name = os.path.basename(path)
+        if name.startswith('.'):
+            return False
+        # 与批量处理相同的 include/exclude、sniff 与 max_depth 规则, 相对于所在的(最内层)监视目录
+        root = max((d for d in self.watcher.dirs if path.startswith(d + os.sep)), key=len, default=None)
+        if root is None:
+            return False
+        return self.agent.scanner.accepts(root, path)
+
+    def _watch(self) -> None:
+        try:
+            for image_file in self.watcher.events(self.stop_event):
+                with self._lock:
+                    self._detected += 1
+                    self._enqueued.setdefault(image_file, deque()).append(time.monotonic())
+                self._queue.put(image_file)
+        except Exception as e:
+            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 监视目录失败: {e}\n", end='')
+            self.stop_event.set()
+
+    def _files(self) -> Iterator[str]:
+        while not self.stop_event.is_set():
+            try:
+                yield self._queue.get(timeout=0.2)
+            except queue.Empty:
+                pass
+
+    def _on_job(self, job: RenderJob) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._completed += 1
+            self._statuses[job.status] = self._statuses.get(job.status, 0) + 1
+            enqueued = self._enqueued.get(job.image_file)
+            if enqueued:
+                self._latencies.append(now - enqueued.popleft())
+                if not enqueued:
+                    del self._enqueued[job.image_file]
+            if job.status != 'skipped':
+                self._render_times.append(job.elapsed)
+
+    def metrics(self) -> dict:
+        '''
+        queued: 已写入完成、等待进入流水线的文件数; in_flight: 流水线中的文件数; settling: 仍在写入的文件数.
+        latency: 从写入完成到输出完成的秒数; render: 单张处理耗时(不含排队), 均为最近 LATENCY_WINDOW 张.
+        '''
+        with self._lock:
+            latencies = list(self._latencies)
+            render_times = list(self._render_times)
+            queued = self._queue.qsize()
+            return {
+                'mode': self.watcher.mode,
+                'uptime': time.monotonic() - self._start,
+                'settling': len(self.watcher.pending),
+                'queued': queued,
+                'in_flight': self._detected - self._completed - queued,
+                'detected': self._detected,
+                'completed': self._completed,
+                'statuses': dict(self._statuses),
+                'latency_p50': percentile(latencies, 0.5),
+                'latency_p95': percentile(latencies, 0.95),
+                'latency_max': max(latencies) if latencies else 0.0,
+                'render_p50': percentile(render_times, 0.5),
+                'render_p95': percentile(render_times, 0.95),
+            }
+
+    def run(self) -> None:
+        '''
+        阻塞运行, 直到调用 stop.
+        '''
+        if not os.path.exists(self.settings.out_dir):
+            os.makedirs(self.settings.out_dir)
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 开始监视({self.watcher.mode}): {', '.join(self.watcher.dirs)}\n", end='')
+        watch_thread = threading.Thread(target=self._watch, daemon=True)
+        watch_thread.start()
+        try:
+            for job in self.agent.iter_files(self._files(), self.settings, 'thread', self.workers, incremental=True, index_batch=1):
+                self._on_job(job)
+                if self.callback is not None:
+                    self.callback(job)
+        finally:
+            self.stop_event.set()
+            watch_thread.join()
+
+    def stop(self) -> None:
+        self.stop_event.set()
@@ -1,31 +1,109 @@
 import os
-import time
-import json
+import io
+import math
 import datetime
-from multiprocessing.pool import ThreadPool
-import numpy as np
-from PIL import Image, ImageOps, ImageDraw, ImageFont
-import exifread
-
-from pillow_heif import register_heif_opener
-
-register_heif_opener()
+from itertools import chain, islice
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+import ingest
+import encoder
+import metaindex
+import manifest
+import pipeline
+import scheduler
+from pipeline import RenderJob, RenderSettings
+from metaindex import MetadataIndex
+from manifest import OutputManifest
+from records import RecordStore
+from scanner import Scanner, IMAGE_EXTENSIONS
+from profiling import NULL_TIMER, NullTimer, StageTimer, Profiler
+from scheduler import MemoryBudget
+
+# Pillow 以及依赖它的 assets、strip、jpegtools 在第一次渲染时才导入, 只遍历目录、命中增量或查看帮助时不加载;
+# HEIF 解码器只在遇到 HEIF 文件时注册, 见 ingest.open_image
+if TYPE_CHECKING:
+    from PIL import Image
+    import jobs
+    from strip import StripLayout
+    from jpegtools import JpegSource
+    from tiled import TiledImage
 
 PATH = os.path.abspath(os.path.dirname(__file__))
 USER_PATH = os.path.expanduser('~')
 DESKTOP_PATH = os.path.join(USER_PATH, 'Desktop')
 ROOT_PATH = os.path.dirname(PATH)
 DEFAULT_OUT_DIR = os.path.join(USER_PATH, 'Desktop', 'Output')
-RECORDS_PATH = os.path.join(ROOT_PATH, 'resources', 'data', 'records.json')
-if not os.path.exists(os.path.dirname(RECORDS_PATH)):
-    os.makedirs(os.path.dirname(RECORDS_PATH))
-SUPPORT_IN_FORMAT = ['.jpg', '.png', '.JPG', '.PNG']
-SUPPORT_OUT_FORMAT = ['jpg', 'png']
+# 扩展名不区分大小写, 见 scanner
+SUPPORT_IN_FORMAT = list(IMAGE_EXTENSIONS)
+# webp/avif/heif 需要 Pillow(或 pillow_heif)带有相应的编码器; SUPPORT_OUT_FORMAT 只含当前环境能够编码的格式, 见 __getattr__
+OUT_FORMAT_CODECS = encoder.OUT_FORMAT_CODECS
 OUT_RESOLUTION = {'1080P':1080, '2k':2160, '原图分辨率':0}
+# 命令行与 HTTP 参数中不便输入中文, 提供英文别名
+RESOLUTION_ALIASES = {'original': '原图分辨率'}
+ORIENTATION_TAG = 0x0112
+# auto: 图片数量足够摊薄进程启动开销时使用多进程, 否则使用多线程
+SUPPORT_BACKEND = ['auto', 'thread', 'process']
+# 每批向元数据索引查询的文件数
+INDEX_BATCH = 64
+RATIO_ATTRS = ['margin_ratio', 'watermark_ratio', 'font_1_ratio', 'font_2_ratio', 'guideline_logo_margin_ratio']
+# 像素数达到该值的图片默认分条渲染, 见 WaterMarkAgent.tiled_threshold
+TILED_THRESHOLD = 100 * 1000 * 1000
+# 估计内存时查找重启间隔所读取的文件头长度
+TILED_HEAD_SIZE = 256 * 1024
+# 传给工作进程的 agent 属性
+WORKER_ATTRS = RATIO_ATTRS + ['compose_in_place', 'lossless_jpeg', 'tiled_threshold', 'encode_preset']
+
+def __getattr__(name: str):
+    # SUPPORT_OUT_FORMAT 需要导入 Pillow 查询编码器, 第一次访问时才计算, 导入本模块时不加载 Pillow
+    if name == 'SUPPORT_OUT_FORMAT':
+        return encoder.available_formats()
+    raise AttributeError(F"module {__name__!r} has no attribute {name!r}")
+
+
+def is_image_file(image_file: str) -> bool:
+    return os.path.splitext(image_file)[-1].lower() in SUPPORT_IN_FORMAT
+
+# 多进程渲染时每个工作进程持有一个 agent, 由 _init_worker 初始化一次
+_worker_agent = None
+
+def _init_worker(attrs: dict):
+    global _worker_agent
+    import assets
+    assets.preload()
+    _worker_agent = WaterMarkAgent()
+    # 工作进程不读写记录文件, 新增的记录随结果交给主进程
+    _worker_agent.records = RecordStore(None)
+    for key, value in attrs.items():
+        setattr(_worker_agent, key, value)
+
+def _process_job(job: RenderJob) -> tuple[RenderJob, list]:
+    # 只回传处理后的 job 与本张图片新增的相机/镜头记录
+    try:
+        _worker_agent._render_job(job)
+    except Exception as e:
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {os.path.basename(job.image_file)} 处理失败: {e}\n", end='')
+        job.fail('error', F"{type(e).__name__}: {e}")
+    job.release()
+    return job, _worker_agent.records.take_new()
+
+class RenderError(Exception):
+    '''
+    render 处理失败(没有 exif、没有对应的 logo)时抛出, job 为处理后的 RenderJob.
+    '''
+    def __init__(self, job: RenderJob) -> None:
+        super().__init__(F"{job.image_file}: {job.error or job.status}")
+        self.job = job
+
+def manual_exif(brand: str, model: str, lens: str) -> dict:
+    # 没有 exif 的图片由用户指定品牌、型号与镜头, 见 run2
+    return {'CameraMaker': brand, 'Camera': model, 'LenModel': lens}
 
 class WaterMarkAgent(object):
     def __init__(self) -> None:
-        self._init_record()
+        # 第一次使用时才读取
+        self.records = RecordStore()
+        # 遍历输入目录的方式: 线程数、按文件头识别格式、include/exclude、最大深度
+        self.scanner = Scanner()
 
         # 加水印后 从上到下 margin + img_height + watermark
         # 加水印后 从左到右 margin + img_width + margin
@@ -39,35 +117,35 @@ class WaterMarkAgent(object):
         self.font_2_ratio = 0.36
 
         self.guideline_logo_margin_ratio = 0.35
-    
-    def _init_record(self):
-        if os.path.exists(RECORDS_PATH):
-            with open(RECORDS_PATH, 'r') as f:
-                ret = json.load(f)
-            self.records = ret
-        else:
-            self.records = {}
-            self.records['Camera_records'] = {}
-            self.records['Lens_records'] = []
-    
-    def _update_record(self, exif_data: dict):
-        brand = exif_data['CameraMaker'].split(" ")[0].title()
-        if brand != '' and brand not in self.records['Camera_records'].keys():
-            self.records['Camera_records'][brand] = []
-
-        model = exif_data['Camera']
-        if model != '' and model not in self.records['Camera_records'][brand]:
-            self.records['Camera_records'][brand].append(model)
-
-        lenmodel = exif_data.get('LenModel', '')
-        if lenmodel != '' and lenmodel not in self.records['Lens_records']:
-            self.records['Lens_records'].append(lenmodel)
-        
-    def _save_record(self):
-        with open(RECORDS_PATH, 'w') as f:
-            json.dump(self.records, f)
 
-    def run(self, in_dir: str, out_dir: str=DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution_key: str='原图分辨率') -> tuple[int, list]:
+        # 没有外边距的 JPEG 直接解码到画布上, 输出与先解码再粘贴完全一致
+        self.compose_in_place = True
+        # 原图分辨率的 JPEG 输出保留原图的压缩数据, 只编码水印条; 条件不满足的图片仍按常规方式处理
+        self.lossless_jpeg = False
+        # 像素数不小于该值、原图分辨率输出的图片分条解码、合成与编码, 内存占用取决于每条的高度而非图片面积(见 tiled);
+        # 这些图片也不受 Pillow 解压炸弹上限的限制. None 表示全部按常规方式处理
+        self.tiled_threshold: int | None = TILED_THRESHOLD
+        # 输出的编码参数(采样、优化、压缩级别、速度取舍、是否保留 exif/ICC), 见 encoder.PRESETS
+        self.encode_preset = encoder.DEFAULT_PRESET
+        # 多线程流水线中编码阶段的线程数, None 时与其他阶段相同; AVIF/HEIF 等编码较慢的格式可以多于解码线程
+        self.encode_workers: int | None = None
+
+        # 设置为 Profiler 后统计每张图片各阶段耗时, run 结束时输出汇总
+        self.profiler: Profiler | None = None
+        # 同时处理的图片预估内存之和的上限(字节), None 表示不限制
+        self.memory_budget: int | None = scheduler.default_budget()
+        # 最近一次运行的内存统计, 见 MemoryBudget.report
+        self.memory_report: dict = {}
+    
+    def _get_ratios(self) -> dict:
+        return {key: getattr(self, key) for key in RATIO_ATTRS}
+
+    def run(self, in_dir: str, out_dir: str=DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution_key: str='原图分辨率', backend: str='auto', workers: int | None=None, incremental: bool=False, callback: Callable[[RenderJob], None] | None=None, use_index: bool=True, control: 'jobs.BatchRun | None'=None) -> tuple[int, list]:
+        '''
+        返回 (0, []) 全部成功; (1, 失败的文件) 部分图片没有 exif 或处理失败; (2, []) 输入无效或没有找到照片.
+        callback: 每张图片处理完成后以 RenderJob 调用.
+        control: 用于暂停与取消(见 jobs.JobController), 取消后返回已完成部分的结果.
+        '''
         if in_dir == "":
             print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 照片文件夹不可为空!")
             return 2, []
@@ -77,51 +155,278 @@ class WaterMarkAgent(object):
         else:
             if not os.path.exists(out_dir):
                 os.makedirs(out_dir)
-            img_list = self._load_images(in_dir)
-            if img_list:
-                args = [(img, out_dir, out_format, out_quality, OUT_RESOLUTION[resolution_key]) for img in img_list]
-                with ThreadPool(10) as threadpool:
-                    pool_ret = threadpool.starmap(self._add_watermark, args)
-                self._save_record()
-                img_list = np.array(img_list)
-                ret = img_list[~np.array(pool_ret)].tolist()
-                if ret:
-                    return 1, ret
-                else:
-                    return 0, ret
-            else:
+            if self.profiler is not None:
+                self.profiler.begin()
+            images = self._iter_images(in_dir)
+            if control is not None:
+                # total 随目录遍历增长, 不需要预先遍历一次
+                images = control.gate(control.counted(images))
+            settings = RenderSettings(out_dir, out_format, out_quality, OUT_RESOLUTION[resolution_key])
+            count, ret = self._consume(self.iter_files(images, settings, backend, workers, use_index, incremental), callback, control)
+            if self.profiler is not None:
+                self.profiler.finish()
+                print(self.profiler.format_report())
+            if self.memory_report:
+                print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {self.memory_report['summary']}")
+            if count == 0 and not (control is not None and control.cancelled):
                 print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 未找到照片!")
                 return 2, []
-    
-    def run2(self, files: list, brand: str, model: str, len: str, out_dir: str=DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution: str='原图分辨率'):
-        exif_data = {}
-        exif_data['CameraMaker'] = brand
-        exif_data['Camera'] = model
-        exif_data['LenModel'] = len
-        for file in files:
-            self._add_watermark2(exif_data, file, out_dir, out_format, out_quality, OUT_RESOLUTION[resolution])
-
-    def _load_images(self, in_path: str) -> list:
-        if os.path.isdir(in_path):
-            img_list =  self._get_all_imagefiles(in_path)
+            if ret:
+                return 1, ret
+            else:
+                return 0, ret
+
+    def iter_run(self, in_dir: str, out_dir: str=DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution_key: str='原图分辨率', backend: str='auto', workers: int | None=None, use_index: bool=True, incremental: bool=False) -> Iterator[RenderJob]:
+        '''
+        边遍历目录边处理, 按完成顺序逐张产出 RenderJob.
+        use_index: 使用元数据索引, 未修改过的文件不再解析 exif.
+        incremental: 跳过输出清单中源文件、渲染参数与输出文件都未变化的图片.
+        '''
+        settings = RenderSettings(out_dir, out_format, out_quality, OUT_RESOLUTION[resolution_key])
+        yield from self.iter_files(self._iter_images(in_dir), settings, backend, workers, use_index, incremental)
+
+    def iter_files(self, files: Iterable, settings: RenderSettings, backend: str='auto', workers: int | None=None, use_index: bool=True, incremental: bool=False, index_batch: int=INDEX_BATCH, exif_data: dict | None=None) -> Iterator[RenderJob]:
+        '''
+        处理 files 中的图片, 按完成顺序逐张产出 RenderJob, job.index 为在 files 中的位置.
+        files 中每一项见 _new_job, 也可以是 (图片, exif_data); exif_data 应用于其余各项, 与 run2 相同.
+        files 可以是不会结束的迭代器(见 watcher), 此时应使用 thread 后端并把 index_batch 设为 1, 避免等待凑满一批.
+        索引、增量与输出清单只用于文件; settings.out_dir 为 None 时不写入任何文件, 相机/镜头记录也不保存.
+        '''
+        jobs = (self._new_job(index, file, settings, exif_data) for index, file in enumerate(files))
+        index = MetadataIndex() if use_index else None
+        out_manifest = OutputManifest(settings.out_dir) if settings.out_dir is not None else None
+        manifest_settings = self._manifest_settings(settings)
+        # 不限制内存时不估计, 省去逐个读取文件头
+        budget = MemoryBudget(self.memory_budget) if self.memory_budget else None
+        self.memory_report = {}
+        try:
+            if index is not None:
+                jobs = self._lookup_index(jobs, index, index_batch)
+            if incremental and out_manifest is not None:
+                jobs = self._skip_current(jobs, out_manifest, manifest_settings)
+            for job in self._iter_jobs(jobs, backend, workers, budget):
+                if index is not None and not job.in_memory and not job.manual and not job.indexed and job.exif_data is not None:
+                    index.put(job.image_file, job.fingerprint, job.exif_data)
+                if job.status == 'ok' and out_manifest is not None and not job.in_memory:
+                    if job.fingerprint is None:
+                        # run2 与不使用索引时没有预先取得指纹
+                        job.fingerprint = metaindex.fingerprint(job.image_file)
+                    out_manifest.record(job.image_file, job.fingerprint, manifest_settings, job.out_file, job.out_digest)
+                if self.profiler is not None:
+                    self.profiler.collect(job)
+                yield job
+        finally:
+            if settings.out_dir is not None:
+                self.records.save()
+            if index is not None:
+                index.close()
+            if budget is not None and budget.admitted:
+                self.memory_report = budget.report()
+                self.memory_report['summary'] = budget.format_report()
+
+    def render(self, image, exif_data: dict | None=None, out_format: str | None='jpg', out_quality: int=100, resolution_key: str='原图分辨率') -> 'bytes | Image.Image':
+        '''
+        在当前线程中处理一张图片, 不写入任何文件.
+        image: bytes、文件对象、PIL Image 或文件路径. exif_data: 为 None 时从图片中读取(见 read_exif), 否则直接使用.
+        返回编码后的图片; out_format 为 None 时返回合成后的 PIL Image.
+        没有 exif 或没有对应的 logo 时抛出 RenderError, 无法解码等错误原样抛出.
+        '''
+        job = self._new_job(0, image, RenderSettings(None, out_format, out_quality, OUT_RESOLUTION[resolution_key]), exif_data)
+        self._render_job(job)
+        if job.status != 'ok':
+            raise RenderError(job)
+        return job.output
+
+    def render_many(self, images: Iterable, exif_data: dict | None=None, out_format: str | None='jpg', out_quality: int=100, resolution_key: str='原图分辨率', backend: str='thread', workers: int | None=None) -> Iterator[RenderJob]:
+        '''
+        render 的批量版本: 边读取 images 边并行处理, 按输入顺序逐张产出 RenderJob, 不写入任何文件.
+        结果在 job.output, 使用的 exif 在 job.exif_data; job.status 不为 'ok' 时处理失败, 原因见 job.error.
+        images 中每一项同 render, 也可以是 (图片, exif_data); exif_data 应用于其余各项.
+        '''
+        settings = RenderSettings(None, out_format, out_quality, OUT_RESOLUTION[resolution_key])
+        done = {}
+        next_index = 0
+        for job in self.iter_files(images, settings, backend, workers, use_index=False, exif_data=exif_data):
+            done[job.index] = job
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+
+    def read_exif(self, image) -> dict:
+        '''
+        读取 image(同 render)中的 exif, 结果可以修改后作为 exif_data 传给 render. 没有 exif 时返回空字典.
+        '''
+        job = self._new_job(0, image, None)
+        if job.img is not None:
+            return self._get_exif(job.image_file, ingest.exif_bytes(job.img))
+        return self._get_exif(job.image_file, job.data)
+
+    def _new_job(self, index: int, image_file, settings: RenderSettings, exif_data: dict | None=None) -> RenderJob:
+        '''
+        image_file 为文件路径, 或在内存中处理的 bytes、文件对象、PIL Image; 也可以是 (图片, exif_data).
+        '''
+        if isinstance(image_file, tuple):
+            image_file, exif_data = image_file
+        if isinstance(image_file, (str, os.PathLike)):
+            job = RenderJob(index, os.fspath(image_file), settings, exif_data)
         else:
-            img_list = [in_path]
-        return img_list
-    
-    def _get_all_imagefiles(self, dir: str) -> list:
-        files_list = []
-        for root, _, files in os.walk(dir):
-            for file in files:
-                if os.path.splitext(file)[-1] in SUPPORT_IN_FORMAT:
-                    new_file = os.path.join(root, file)
-                    new_file = new_file.replace('\\', '/')
-                    files_list.append(new_file)
-        return files_list
+            job = RenderJob(index, F"image_{index}", settings, exif_data)
+            job.in_memory = True
+            from PIL import Image
+            if isinstance(image_file, Image.Image):
+                job.img = image_file
+            elif isinstance(image_file, (bytes, bytearray, memoryview)):
+                job.data = bytes(image_file)
+            else:
+                job.data = image_file.read()
+        if self.profiler is not None:
+            job.timer = self.profiler.new_timer()
+        return job
+
+    def _manifest_settings(self, settings: RenderSettings) -> dict:
+        ret = {'format': settings.out_format, 'quality': settings.out_quality, 'resolution': settings.resolution}
+        ret.update(self._get_ratios())
+        if self.lossless_jpeg:
+            ret['lossless'] = True
+        if self.encode_preset != encoder.DEFAULT_PRESET:
+            ret['preset'] = self.encode_preset
+        return ret
+
+    def _skip_current(self, jobs: Iterable[RenderJob], out_manifest: OutputManifest, manifest_settings: dict) -> Iterator[RenderJob]:
+        for job in jobs:
+            if job.in_memory:
+                yield job
+                continue
+            if job.fingerprint is None:
+                job.fingerprint = metaindex.fingerprint(job.image_file)
+            out_file = job.settings.out_file_for(job.image_file)
+            if out_manifest.is_current(out_file, job.image_file, job.fingerprint, manifest_settings):
+                job.skip(out_file)
+            yield job
+
+    def _lookup_index(self, jobs: Iterable[RenderJob], index: MetadataIndex, batch_size: int=INDEX_BATCH) -> Iterator[RenderJob]:
+        jobs = iter(jobs)
+        while True:
+            batch = list(islice(jobs, batch_size))
+            if not batch:
+                return
+            files = [job for job in batch if not job.in_memory]
+            for job in files:
+                job.fingerprint = metaindex.fingerprint(job.image_file)
+            cached = index.get_many((job.image_file, job.fingerprint) for job in files)
+            for job in files:
+                if not job.manual and job.image_file in cached:
+                    job.exif_data = cached[job.image_file]
+                    job.indexed = True
+            yield from batch
+
+    def _estimate_jobs(self, jobs: Iterable[RenderJob]) -> Iterator[RenderJob]:
+        for job in jobs:
+            job.reserved = self._estimate_memory(job)
+            yield job
+
+    def _iter_jobs(self, jobs: Iterable[RenderJob], backend: str='auto', workers: int | None=None, budget: MemoryBudget | None=None) -> Iterator[RenderJob]:
+        '''
+        budget: 按预估内存准入, 小图并行处理, 大图等待前面的任务完成.
+        '''
+        if backend not in SUPPORT_BACKEND:
+            raise ValueError(F"Unsupported backend: {backend}")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if budget is not None:
+            jobs = self._estimate_jobs(jobs)
+        jobs = iter(jobs)
+        if backend == 'auto':
+            head = list(islice(jobs, 2 * workers))
+            backend = 'process' if workers > 1 and len(head) >= 2 * workers else 'thread'
+            jobs = chain(head, jobs)
+
+        if backend == 'process':
+            results = pipeline.run_process_pool(jobs, _process_job, workers, _init_worker, ({key: getattr(self, key) for key in WORKER_ATTRS},), 2 * workers, budget)
+            for job, records in results:
+                self.records.merge(records)
+                yield job
+        else:
+            import assets
+            assets.preload()
+            stages = [(stage, workers) for stage in self._stages()]
+            if self.encode_workers is not None:
+                stages[-1] = (stages[-1][0], self.encode_workers)
+            yield from pipeline.run_pipeline(jobs, stages, maxsize=workers, budget=budget)
+
+    def worker_pool(self, workers: int | None=None, backend: str='thread', queue_size: int | None=None) -> pipeline.WorkerPool:
+        '''
+        返回常驻的工作池, 用 pool.render(job) 逐个处理 job, 字体与 logo 在启动时加载.
+        job 的 settings.out_dir 为 None 时输出保存在 job.output 中. queue_size 默认为 workers.
+        相机/镜头记录在 pool.close() 后由调用方通过 save_records 保存.
+        '''
+        if backend not in ('thread', 'process'):
+            raise ValueError(F"Unsupported backend: {backend}")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if queue_size is None:
+            queue_size = workers
+        budget = MemoryBudget(self.memory_budget) if self.memory_budget else None
+        if backend == 'process':
+            return pipeline.WorkerPool(_process_job, workers, backend, queue_size, _init_worker, ({key: getattr(self, key) for key in WORKER_ATTRS},), self._finish_process_job, budget, self._estimate_memory)
+        import assets
+        assets.preload()
+        return pipeline.WorkerPool(self._render_pool_job, workers, backend, queue_size, budget=budget, estimate=self._estimate_memory)
+
+    def _render_pool_job(self, job: RenderJob) -> RenderJob:
+        self._render_job(job)
+        job.release()
+        return job
+
+    def _finish_process_job(self, result: tuple[RenderJob, list]) -> RenderJob:
+        job, records = result
+        self.records.merge(records)
+        return job
+
+    def save_records(self) -> None:
+        self.records.save()
+
+    def run2(self, files: list, brand: str, model: str, len: str, out_dir: str=DEFAULT_OUT_DIR, out_format: str='jpg', out_quality: int=100, resolution: str='原图分辨率', backend: str='auto', workers: int | None=None, callback: Callable[[RenderJob], None] | None=None, control: 'jobs.BatchRun | None'=None) -> list:
+        '''
+        files 中的图片不读取 exif, 使用给定的品牌、型号与镜头. 返回处理失败的文件.
+        callback、control: 与 run 相同.
+        '''
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        settings = RenderSettings(out_dir, out_format, out_quality, OUT_RESOLUTION[resolution])
+        if control is not None:
+            files = control.gate(files)
+        _, failed = self._consume(self.iter_files(files, settings, backend, workers, use_index=False, exif_data=manual_exif(brand, model, len)), callback, control)
+        return failed
+
+    def _consume(self, jobs: Iterator[RenderJob], callback: Callable[[RenderJob], None] | None, control: 'jobs.BatchRun | None') -> tuple[int, list]:
+        '''
+        取出 jobs 的全部结果, 返回 (图片数, 失败的文件); 失败的文件与输入顺序一致. control 被取消后不再等待其余图片.
+        '''
+        count = 0
+        failed = []
+        try:
+            for job in jobs:
+                count += 1
+                if not job.ok:
+                    failed.append((job.index, job.image_file))
+                if callback is not None:
+                    callback(job)
+                if control is not None and control.cancelled:
+                    break
+        finally:
+            # 停止流水线或进程池: 正在处理的图片完成当前阶段后退出, 输出经原子写入, 不会留下不完整的文件
+            jobs.close()
+        return count, [image_file for _, image_file in sorted(failed)]
+
+    def _iter_images(self, in_path: str) -> Iterator[str]:
+        return self.scanner.scan(in_path)
         
-    def _get_exif(self, image_file: str) -> dict:
+    def _get_exif(self, image_file: str, data: bytes | None=None) -> dict:
         ret = {}
-        f = open(image_file, 'rb')
-        tags = exifread.process_file(f)
+        if data is None:
+            data = ingest.read_file(image_file)
+        tags = ingest.read_exif_tags(data)
 
         tmp = str(tags.get("Image Make", ""))
         if tmp == "":
@@ -172,190 +477,481 @@ class WaterMarkAgent(object):
         ret["Artist"] = str(tags.get("Image Artist", ""))
         return ret
 
-    def _add_watermark(self, image_file: str, out_dir: str, out_format: str, out_quality: int, resolution: int) -> bool:
-        image_name = os.path.splitext(os.path.basename(image_file))
-        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 正在处理:{image_name[0]}{image_name[1]}\n", end='')
-
-        exif_data = self._get_exif(image_file)
+    def _stages(self) -> list:
+        # 解析 exif -> 解码 -> 合成 -> 编码
+        return [self._stage_exif, self._stage_decode, self._stage_compose, self._stage_encode]
 
-        if not exif_data:
-            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {image_name[0]}{image_name[1]} 没有exif数据!\n", end='')
-            return False
-
-        img = Image.open(image_file)
-        img = ImageOps.exif_transpose(img)
-        img_width, img_height = img.size
-        # if resolution != 0 and img_width <= img_height and img_width != resolution:
-        #     img = img.resize((resolution, int(img_height / img_width * resolution)))
-        # elif resolution != 0 and img_width >= img_height and img_height != resolution:
-        #     img = img.resize((int(img_width / img_height * resolution), resolution))
-        # img_width, img_height = img.size
+    def _render_job(self, job: RenderJob) -> None:
+        for stage in self._stages():
+            if job.status is not None:
+                break
+            pipeline.run_stage(stage, job)
 
+    def _add_watermark(self, image_file: str, out_dir: str, out_format: str, out_quality: int, resolution: int) -> bool:
+        job = RenderJob(0, image_file, RenderSettings(out_dir, out_format, out_quality, resolution))
+        self._render_job(job)
+        return job.ok
+
+    def _add_watermark2(self, exif_data: dict, image_file: str, out_dir: str, out_format: str, out_quality: int, resolution: int) -> bool:
+        job = RenderJob(0, image_file, RenderSettings(out_dir, out_format, out_quality, resolution), exif_data)
+        self._render_job(job)
+        return job.ok
+
+    def _stage_exif(self, job: RenderJob) -> None:
+        image_name = os.path.basename(job.image_file)
+        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 正在处理:{image_name}\n", end='')
+        timer = job.timer
+        # exif_data 可能由调用方提供或来自元数据索引, 此时不再解析
+        if job.exif_data is None:
+            if job.img is not None:
+                # 调用方给出的 PIL Image, exif 取自图像本身
+                with timer('exif'):
+                    job.exif_data = self._get_exif(job.image_file, ingest.exif_bytes(job.img))
+            else:
+                self._read_source(job)
+                with timer('exif'):
+                    job.exif_data = self._get_exif(job.image_file, job.data)
+        if not job.exif_data:
+            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {image_name} 没有exif数据!\n", end='')
+            job.fail('no_exif')
+        elif job.data is None and job.img is None:
+            self._read_source(job)
+
+    def _read_source(self, job: RenderJob) -> None:
+        # 内存中的图片在创建 job 时已给出内容
+        if job.data is None:
+            with job.timer('read'):
+                job.data = ingest.read_file(job.image_file)
+        job.timer.count('bytes_in', len(job.data))
+
+    def _stage_decode(self, job: RenderJob, lossless: bool=True) -> None:
+        from PIL import Image, ImageOps
+        timer = job.timer
+        # 调用方给出的 PIL Image 不做原地修改, 也不使用 draft、无损拼接与直接解码
+        given = job.img is not None
+        img = job.img if given else self._open_image(job.data)
+        orientation = img.getexif().get(ORIENTATION_TAG, 1)
+        if encoder.get_preset(self.encode_preset).keeps_metadata:
+            # Pillow 读取文件头时已取出, 直接保留原始数据
+            job.metadata = encoder.source_metadata(img)
+        if not given and lossless and self.lossless_jpeg:
+            job.jpeg = self._lossless_source(job, img, orientation)
+            if job.jpeg is not None:
+                # 照片不解码, 合成阶段只编码水印条并拼接
+                job.img = img
+                return
+        if not given and self._use_tiled(job.settings, img, orientation):
+            # 照片在编码阶段逐段解码
+            with timer('decode'):
+                job.tiled = self._tiled_image(img, job.data)
+            job.img = None
+            job.data = None
+            return
+        rotated = orientation in (5, 6, 7, 8)
+        target = None
+        if job.settings.resolution != 0:
+            # 根据文件头中的尺寸与方向, 先算出照片在输出图中的尺寸
+            img_width, img_height = img.size
+            if rotated:
+                img_width, img_height = img_height, img_width
+            target = self._scaled_size(img_width, img_height, job.settings.resolution)
+            if target is not None:
+                job.scaled = ((img_width, img_height), self._output_size(*self._canvas_size(img_width, img_height), job.settings.resolution))
+
+        if not given and target is None and orientation == 1 and self._can_compose_in_place(img):
+            # 照片由合成阶段直接解码到画布上, 这里只保留未解码的图片与文件内容
+            job.img = img
+            return
+
+        if target is not None and not given:
+            # JPEG 在 DCT 域直接缩小解码, 再 reduce + 重采样到目标尺寸, 水印按目标尺寸排版
+            img.draft('RGB', (target[1], target[0]) if rotated else target)
+        with timer('decode'):
+            img.load()
+        timer.count('pixels_in', img.width * img.height)
+        with timer('transpose'):
+            # 不需要旋转时原样保留, 不再复制整张图片
+            if not given:
+                ImageOps.exif_transpose(img, in_place=True)
+            elif orientation != 1:
+                img = ImageOps.exif_transpose(img)
+        if target is not None:
+            with timer('scale'):
+                img = img.resize(target, Image.BICUBIC, reducing_gap=3.0)
+        job.img = img
+        job.data = None
+
+    def _open_image(self, source: bytes | str) -> 'Image.Image':
+        from PIL import Image
+        try:
+            return ingest.open_image(source)
+        except Image.DecompressionBombError:
+            if self.tiled_threshold is None:
+                raise
+            # 超过 Pillow 上限的图片达到分条阈值时照常打开, 由内存预算控制并发
+            img = ingest.open_image(source, check_size=False)
+            if img.width * img.height < self.tiled_threshold:
+                img.close()
+                raise
+            return img
+
+    def _use_tiled(self, settings: RenderSettings, img: 'Image.Image', orientation: int) -> bool:
+        # 只处理原图分辨率、不需要旋转的图片, 输出为 jpg 或 png
+        import tiled
+        return self.tiled_threshold is not None and img.width * img.height >= self.tiled_threshold and settings.resolution == 0 and orientation == 1 and settings.out_format in tiled.OUT_FORMATS
+
+    def _tiled_image(self, img: 'Image.Image', data: bytes) -> 'TiledImage':
+        import tiled
+        margin, layout = self._strip_layout(img.width, img.height)
+        return tiled.TiledImage(tiled.PhotoRows(img, data), margin, layout)
+
+    def _lossless_source(self, job: RenderJob, img: 'Image.Image', orientation: int) -> 'JpegSource | None':
+        import jpegtools
+        # 原图分辨率的 JPEG 输出且没有外边距时, 照片区域可以直接使用原图的压缩数据
+        settings = job.settings
+        if settings.out_format != 'jpg' or settings.resolution != 0 or img.format not in ('JPEG', 'MPO') or orientation not in jpegtools.ORIENTATIONS:
+            return None
+        margin, layout = self._strip_layout(img.width, img.height)
+        if margin != 0:
+            return None
+        source = jpegtools.parse(job.data)
+        if source is None or (source.width, source.height) != img.size:
+            return None
+        source.orientation = orientation
+        if jpegtools.restart_interval(source, layout.height) is None:
+            return None
+        return source
+
+    def _compose_lossless(self, job: RenderJob) -> None:
+        import jpegtools
+        source = job.jpeg
+        _, layout = self._strip_layout(source.width, source.height)
+        band = self._render_band(layout, job.exif_data, job.manual, job.timer)
+        if band is None:
+            job.fail('no_logo')
+            return
+        try:
+            with job.timer('compose'):
+                job.encoded = jpegtools.append_band(source, band, jpegtools.restart_interval(source, layout.height), (300, 300))
+        except ValueError as e:
+            # 例如 Pillow 不支持写入重启标记, 改为常规方式处理
+            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {os.path.basename(job.image_file)} 无法无损拼接: {e}\n", end='')
+            job.jpeg = None
+            job.img = None
+            self._stage_decode(job, lossless=False)
+            self._stage_compose(job)
+            return
+        job.timer.count('pixels_out', layout.width * (source.height + layout.height))
+        job.jpeg = None
+        job.img = None
+        job.data = None
+
+    def _stage_compose(self, job: RenderJob) -> None:
+        if job.jpeg is not None:
+            self._compose_lossless(job)
+            return
+        if job.tiled is not None:
+            # 只准备水印条的分段绘制, 合成与编码逐条进行
+            import strip
+            job.tiled.paint = strip.band_painter(job.tiled.layout, job.exif_data, job.manual, job.timer)
+            if job.tiled.paint is None:
+                job.fail('no_logo')
+            return
+        # job.data 仍在时照片尚未解码, 见 _can_compose_in_place
+        canvas = self._draw_watermark(job.img, job.exif_data, job.manual, job.timer, job.data, job.scaled)
+        job.img = None
+        job.data = None
+        if canvas is None:
+            job.fail('no_logo')
+            return
+
+        # 解码阶段已缩小时尺寸一般已符合输出要求; 放大或原图分辨率仍在这里处理
+        out_size = self._output_size(canvas.width, canvas.height, job.settings.resolution)
+        if out_size != canvas.size:
+            with job.timer('resize'):
+                canvas = canvas.resize(out_size)
+        job.canvas = canvas
+
+    def _stage_encode(self, job: RenderJob) -> None:
+        # 保存修改后的图片: 先在内存中编码, 再原子地写入输出目录
+        timer = job.timer
+        settings = job.settings
+        if settings.out_format is None:
+            # 不编码, 直接交出合成后的图像
+            job.output = job.canvas
+            job.canvas = None
+            self._add_records(job)
+            job.done(None)
+            return
+        if job.tiled is not None:
+            self._encode_tiled(job)
+            return
+        if job.encoded is not None:
+            # 无损模式在合成阶段已得到完整的 JPEG 数据
+            data = job.encoded
+            job.encoded = None
+        else:
+            timer.count('pixels_out', job.canvas.width * job.canvas.height)
+            with timer('encode'):
+                data = encoder.encode(job.canvas, settings.out_format, settings.out_quality, encoder.get_preset(self.encode_preset), *(job.metadata or ()))
+            job.canvas = None
+        timer.count('bytes_out', len(data))
+        if settings.out_dir is None:
+            job.output = data
+            out_filename = None
+        else:
+            out_filename = settings.out_file_for(job.image_file)
+            with timer('write'):
+                manifest.write_atomic(out_filename, data)
+        self._add_records(job)
+        job.done(out_filename, manifest.digest(data))
+
+    def _add_records(self, job: RenderJob) -> None:
+        # 不写入文件(out_dir 为 None)时不记录, 记录积累后会追加到磁盘上的日志
+        if not job.manual and job.settings.out_dir is not None:
+            self.records.add_exif(job.exif_data)
+
+    def _encode_tiled(self, job: RenderJob) -> None:
+        # 逐条编码并写出, 不写入文件时写入内存
+        timer = job.timer
+        settings = job.settings
+        image = job.tiled
+        job.tiled = None
+        width, height = image.size
+        timer.count('pixels_out', width * height)
+        if settings.out_dir is None:
+            buffer = io.BytesIO()
+            writer = manifest.DigestWriter(buffer)
+            image.write(writer.write, settings.out_format, settings.out_quality, encoder.get_preset(self.encode_preset), job.metadata, timer)
+            job.output = buffer.getvalue()
+            out_filename = None
+        else:
+            out_filename = settings.out_file_for(job.image_file)
+            with manifest.open_atomic(out_filename) as f:
+                writer = manifest.DigestWriter(f)
+                image.write(writer.write, settings.out_format, settings.out_quality, encoder.get_preset(self.encode_preset), job.metadata, timer)
+        timer.count('bytes_out', writer.size)
+        self._add_records(job)
+        job.done(out_filename, writer.hexdigest())
+
+    def _estimate_memory(self, job: RenderJob) -> int:
+        '''
+        只读取文件头, 按各阶段同时存在的数据估计单张图片的峰值内存(字节):
+        解码结果与旋转后的副本, 转正结果与缩小结果, 照片、水印条与画布, 画布与输出尺寸的图像, 输出图像与编码结果.
+        '''
+        if job.status is not None:
+            return 0
+        try:
+            if job.img is not None:
+                # 调用方给出的 PIL Image, 见 _stage_decode
+                width, height = job.img.size
+                can_draft = in_place = False
+                orientation = job.img.getexif().get(ORIENTATION_TAG, 1)
+            else:
+                with self._open_image(job.data if job.data is not None else job.image_file) as img:
+                    width, height = img.size
+                    can_draft = img.format == 'JPEG'
+                    orientation = img.getexif().get(ORIENTATION_TAG, 1)
+                    in_place = orientation == 1 and self._can_compose_in_place(img)
+                    if self._use_tiled(job.settings, img, orientation):
+                        return self._estimate_tiled(job, img)
+        except Exception:
+            # 无法识别的文件会在解码阶段失败, 不占用预算
+            return 0
+        rotated = orientation in (5, 6, 7, 8)
+        if rotated:
+            width, height = height, width
+        if job.in_memory:
+            data = len(job.data) if job.data is not None else 0
+        else:
+            data = job.fingerprint[0] if job.fingerprint else os.path.getsize(job.image_file)
+
+        decoded = width * height
+        # 需要旋转或翻转时 exif_transpose 会生成一份副本
+        transposed = decoded if orientation != 1 else 0
+        photo_width, photo_height = width, height
+        scaled = 0
+        target = self._scaled_size(width, height, job.settings.resolution) if job.settings.resolution != 0 else None
+        if target is not None:
+            if can_draft:
+                decoded = scheduler.draft_pixels(width, height, target)
+                transposed = decoded if orientation != 1 else 0
+            photo_width, photo_height = target
+            scaled = photo_width * photo_height
+        margin, layout = self._strip_layout(photo_width, photo_height)
+        canvas_height = margin + photo_height + layout.height
+        canvas = layout.width * canvas_height
+        band = layout.width * layout.height
+        if target is not None:
+            # 水印条先按原图尺寸绘制再缩小
+            source_layout = self._strip_layout(width, height)[1]
+            band += source_layout.width * source_layout.height
+        out_width, out_height = self._output_size(layout.width, canvas_height, job.settings.resolution)
+        out = out_width * out_height
+        resized = out if out != canvas else 0
+        # 编码结果按每像素 3 字节估计, BytesIO 与 getvalue 各一份
+        encoded = 2 * 3 * out
+
+        pixel_bytes = scheduler.PIXEL_BYTES
+        if in_place and target is None:
+            # 照片直接解码到画布上, 只有画布与水印条
+            decode_peak = data + (canvas + band) * pixel_bytes
+        else:
+            decode_peak = max(
+                data + (decoded + transposed) * pixel_bytes,
+                data + (decoded + scaled) * pixel_bytes,
+                (photo_width * photo_height + band + canvas) * pixel_bytes,
+            )
+        return max(
+            decode_peak,
+            (canvas + resized) * pixel_bytes,
+            out * pixel_bytes + encoded,
+        )
+
+    def _estimate_tiled(self, job: RenderJob, img: 'Image.Image') -> int:
+        # 分条渲染: 文件内容与若干条输出大小的缓冲; 不能逐段解码时另有整张照片
+        import tiled
+        import jpegtools
+        if job.data is not None:
+            data = len(job.data)
+            head = job.data[:TILED_HEAD_SIZE]
+        else:
+            data = job.fingerprint[0] if job.fingerprint else os.path.getsize(job.image_file)
+            with open(job.image_file, 'rb') as f:
+                head = f.read(TILED_HEAD_SIZE)
+        streamed = img.format in ('JPEG', 'MPO') and jpegtools.header_restart_interval(head) != 0
+        decoded = 0 if streamed else img.width * img.height
+        width = self._strip_layout(img.width, img.height)[1].width
+        strip = tiled.strip_rows(width) * width
+        # 输出条、照片段(含上下重叠)、水印条段、编码中的副本
+        return data + (decoded + 6 * strip) * scheduler.PIXEL_BYTES
+
+    def _output_size(self, width: int, height: int, resolution: int) -> tuple[int, int]:
+        # 短边缩放到 resolution
+        if resolution != 0 and width <= height and width != resolution:
+            return resolution, int(height / width * resolution)
+        elif resolution != 0 and width >= height and height != resolution:
+            return int(width / height * resolution), resolution
+        return width, height
+
+    def _canvas_size(self, img_width: int, img_height: int) -> tuple[int, int]:
+        margin, layout = self._strip_layout(img_width, img_height)
+        return layout.width, margin + img_height + layout.height
+
+    def _scaled_size(self, img_width: int, img_height: int, resolution: int) -> tuple[int, int] | None:
+        '''
+        返回先缩小照片再排版时照片应有的尺寸, 见 _scaled_layout. 不需要缩小时返回 None.
+        '''
+        canvas_width, canvas_height = self._canvas_size(img_width, img_height)
+        out_width, out_height = self._output_size(canvas_width, canvas_height, resolution)
+        if out_width >= canvas_width:
+            return None
+        return self._scaled_layout(img_width, img_height, out_width, out_height)[1]
+
+    def _scaled_layout(self, img_width: int, img_height: int, out_width: int, out_height: int) -> tuple[tuple[int, int], tuple[int, int], int]:
+        '''
+        按原图尺寸排版的画布整体缩放到 out_width x out_height 时各部分的位置: 返回 (照片左上角, 照片尺寸, 水印条的起始行).
+        边界取最接近的整数行/列, 与整图缩放后的位置相差不到半个像素.
+        '''
+        margin, layout = self._strip_layout(img_width, img_height)
+        scale_x = out_width / layout.width
+        scale_y = out_height / (margin + img_height + layout.height)
+        left, top = round(margin * scale_x), round(margin * scale_y)
+        band_top = round((margin + img_height) * scale_y)
+        photo_size = (max(round((margin + img_width) * scale_x) - left, 1), max(band_top - top, 1))
+        return (left, top), photo_size, band_top
+
+    def _strip_layout(self, img_width: int, img_height: int) -> 'tuple[int, StripLayout]':
+        from strip import StripLayout
         margin = int(self.margin_ratio * max(img_width, img_height))
         watermark_height = int(self.watermark_ratio * max(img_width, img_height))
         watermark_margin = int(watermark_height * 0.3)
         if watermark_margin < margin:
             watermark_margin = margin
         content_height = watermark_height - watermark_margin * 2
-        guideline_logo_margin = int(self.guideline_logo_margin_ratio * content_height)
-
-        new_height = margin + img_height + watermark_height
-        new_width = margin + img_width + margin
-        background_img = Image.new("RGB", (new_width, new_height), 'white')
-
-        # draw img
-        background_img.paste(img, (margin, margin))
-
-        # judge logo
-        brand = exif_data['CameraMaker'].split(' ')[0]
-        brand = brand.title()
-        if brand == 'Xiaomi':
-            brand = 'Leica'
-        logo_file = os.path.join(ROOT_PATH, 'resources', 'logos', F"{brand}.png")
-        if not os.path.exists(logo_file):
-            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {brand}'s logo doesn't exist.\n", end='')
-            return False
-
-        # draw text
-        left_text_1 = exif_data['Camera']
-        left_text_2 = exif_data['LenModel']
-
-        # 等效焦距
-        right_text_1 = F"{exif_data['35mmFilm']}mm f/{exif_data['FNumber']} {exif_data['ExposureTime']}s ISO{exif_data['ISO']}"
-        right_text_2 = exif_data['DateTime']
-
-        draw = ImageDraw.Draw(background_img)
-
-        font_file_1 = os.path.join(ROOT_PATH, 'resources', 'fonts', 'MiSans-Demibold.ttf')
-        font_pt_1 = int(content_height * self.font_1_ratio)
-        font_1 = ImageFont.truetype(font_file_1, font_pt_1)
-
-        font_file_2 = os.path.join(ROOT_PATH, 'resources', 'fonts', 'MiSans-Regular.ttf')
-        font_pt_2 = int(content_height * self.font_2_ratio)
-        font_2 = ImageFont.truetype(font_file_2, font_pt_2)
-        
-        text_1_top = new_height - watermark_height + watermark_margin
-        text_2_baseline = new_height - watermark_margin
-        draw.text((watermark_margin, text_1_top), left_text_1, fill='black', anchor="lt", font=font_1)
-        draw.text((watermark_margin, text_2_baseline), left_text_2, fill='#888888', anchor="ls", font=font_2)
-
-        draw.text((new_width - watermark_margin, text_1_top), right_text_1, fill='black', anchor="rt", font=font_1)
-        r_text_1_width = int(font_1.getlength(right_text_1))
-        draw.text((new_width - watermark_margin - r_text_1_width, text_2_baseline), right_text_2, fill='#888888', anchor="ls", font=font_2)
-
-        # draw guideline
-        guideline_width = int(0.0012 * max(img_width, img_height))
-        guideline = Image.new("RGB", (guideline_width, content_height), "#D0D0D0")
-        guideline_left = new_width - watermark_margin - r_text_1_width - guideline_logo_margin
-        guideline_top = text_1_top
-        background_img.paste(guideline, (guideline_left, guideline_top))
-
-        # draw logo
-        logo_img = Image.open(logo_file)
-        logo_img = logo_img.convert("RGBA")
-        logo_img = logo_img.resize((content_height, content_height), Image.LANCZOS)
-
-        logo_left = new_width - watermark_margin - r_text_1_width - 2 * guideline_logo_margin - content_height
-        logo_top = text_1_top
-        r, g, b, a = logo_img.split()
-        background_img.paste(logo_img, (logo_left, logo_top), mask=a)
-
-        img_width, img_height = background_img.size
-        if resolution != 0 and img_width <= img_height and img_width != resolution:
-            background_img = background_img.resize((resolution, int(img_height / img_width * resolution)))
-        elif resolution != 0 and img_width >= img_height and img_height != resolution:
-            background_img = background_img.resize((int(img_width / img_height * resolution), resolution))
-
-        # 保存修改后的图片
-        out_filename = os.path.join(out_dir, F"Mark_{image_name[0]}.{out_format}")
-        background_img.save(out_filename, dpi=(300, 300), quality=out_quality)
-        self._update_record(exif_data)
-        return True
-
-    def _add_watermark2(self, exif_data: dict, image_file: str, out_dir: str, out_format: str, out_quality: int, resolution: str) -> None:
-        image_name = os.path.splitext(os.path.basename(image_file))
-        print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 正在处理:{image_name[0]}{image_name[1]}")
-
-        img = Image.open(image_file)
-        img = ImageOps.exif_transpose(img) 
+        layout = StripLayout(
+            width=margin + img_width + margin,
+            height=watermark_height,
+            margin=watermark_margin,
+            content_height=content_height,
+            guideline_logo_margin=int(self.guideline_logo_margin_ratio * content_height),
+            guideline_width=int(0.0012 * max(img_width, img_height)),
+            font_pt_1=int(content_height * self.font_1_ratio),
+            font_pt_2=int(content_height * self.font_2_ratio),
+        )
+        return margin, layout
+
+    def _render_band(self, layout: 'StripLayout', exif_data: dict, manual: bool=False, timer: NullTimer | StageTimer=NULL_TIMER) -> 'Image.Image | None':
+        import strip
+        if manual:
+            return strip.render_strip2(layout, exif_data, timer)
+        return strip.render_strip(layout, exif_data, timer)
+
+    def _can_compose_in_place(self, img: 'Image.Image') -> bool:
+        # 没有外边距时画布上半部分就是照片本身, 可以直接解码到画布上
+        return self.compose_in_place and ingest.can_decode_into(img) and self._strip_layout(img.width, img.height)[0] == 0
+
+    def _draw_watermark(self, img: 'Image.Image', exif_data: dict, manual: bool=False, timer: NullTimer | StageTimer=NULL_TIMER, data: bytes | None=None, scaled: tuple[tuple[int, int], tuple[int, int]] | None=None) -> 'Image.Image | None':
+        '''
+        data 不为 None 时 img 尚未解码, data 为其文件内容.
+        scaled 不为 None 时 img 为已缩小的照片, scaled 为 (原图转正后的尺寸, 输出尺寸): 水印条按原图排版与绘制,
+        再按整图缩放时所在的位置(包括不足一个像素的偏移)取样缩小, 字号、logo 与分隔线与先加水印再整图缩放相同.
+        '''
+        from PIL import Image
+        if scaled is not None:
+            return self._draw_scaled(img, exif_data, manual, timer, *scaled)
         img_width, img_height = img.size
-        # if resolution != 0 and img_width <= img_height and img_width != resolution:
-        #     img = img.resize((resolution, int(img_height / img_width * resolution)))
-        # elif resolution != 0 and img_width >= img_height and img_height != resolution:
-        #     img = img.resize((int(img_width / img_height * resolution), resolution))
-        # img_width, img_height = img.size
+        margin, layout = self._strip_layout(img_width, img_height)
+        band = self._render_band(layout, exif_data, manual, timer)
+        if band is None:
+            return None
+
+        if data is not None:
+            # 画布上方直接由解码器写入照片, 下方由水印条覆盖, 无需白底填充与整图复制
+            background_img = Image.new("RGB", (layout.width, img_height + layout.height), None)
+            with timer('decode'):
+                if not ingest.decode_into(img, background_img, data):
+                    # Pillow 的内部接口不可用, 改为先解码再粘贴
+                    img.load()
+                    background_img.paste(img, (0, 0))
+            timer.count('pixels_in', img_width * img_height)
+            with timer('compose'):
+                background_img.paste(band, (0, img_height))
+            return background_img
 
-        margin = int(self.margin_ratio * max(img_width, img_height))
-        watermark_height = int(self.watermark_ratio * max(img_width, img_height))
-        watermark_margin = int(watermark_height * 0.3)
-        if watermark_margin < margin:
-            watermark_margin = margin
-        content_height = watermark_height - watermark_margin * 2
-        guideline_logo_margin = int(self.guideline_logo_margin_ratio * content_height)
-
-        new_height = margin + img_height + watermark_height
-        new_width = margin + img_width + margin
-        background_img = Image.new("RGB", (new_width, new_height), 'white')
-
-        # draw img
-        background_img.paste(img, (margin, margin))
-
-        # judge logo
-        brand = exif_data['CameraMaker'].split(' ')[0]
-        brand = brand.title()
-        if brand == 'Xiaomi':
-            brand = 'Leica'
-        logo_file = os.path.join(ROOT_PATH, 'resources', 'logos', F"{brand}.png")
-        if not os.path.exists(logo_file):
-            print(F"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {brand}'s logo doesn't exist.\n", end='')
-            return False
-
-        # draw guideline
-        guideline_width = int(0.0012 * max(img_width, img_height))
-        guideline_length = watermark_height - 2 * watermark_margin
-        guideline = Image.new("RGB", (guideline_width, guideline_length), "#D0D0D0")
-        guideline_left = int(new_width / 2)
-        guideline_top = new_height - watermark_height + watermark_margin
-        background_img.paste(guideline, (guideline_left, guideline_top))
-
-        # draw logo
-        logo_img = Image.open(logo_file)
-        logo_img = logo_img.convert("RGBA")
-        logo_img = logo_img.resize((content_height, content_height), Image.LANCZOS)
-
-        logo_left = guideline_left - guideline_logo_margin - content_height
-        logo_top = guideline_top
-        r, g, b, a = logo_img.split()
-        background_img.paste(logo_img, (logo_left, logo_top), mask=a)
-
-        # draw text
-        right_text_1 = exif_data['Camera']
-        right_text_2 = exif_data['LenModel']
-        if not right_text_2:
-            right_text_2 = time.strftime("%Y.%m.%d", time.localtime()) 
-
-        draw = ImageDraw.Draw(background_img)
-
-        font_file_1 = os.path.join(ROOT_PATH, 'resources', 'fonts', 'MiSans-DemiBold.ttf')
-        font_pt_1 = int(content_height * self.font_1_ratio)
-        font_1 = ImageFont.truetype(font_file_1, font_pt_1)
-
-        font_file_2 = os.path.join(ROOT_PATH, 'resources', 'fonts', 'MiSans-Regular.ttf')
-        font_pt_2 = int(content_height * self.font_2_ratio)
-        font_2 = ImageFont.truetype(font_file_2, font_pt_2)
-        
-        text_1_left = guideline_left + guideline_logo_margin
-        text_1_top = guideline_top
-        text_2_baseline = new_height - watermark_margin
-        draw.text((text_1_left, text_1_top), right_text_1, fill='black', anchor="lt", font=font_1)
-        draw.text((text_1_left, text_2_baseline), right_text_2, fill='#888888', anchor="ls", font=font_2)
-
-        img_width, img_height = background_img.size
-        if resolution != 0 and img_width <= img_height and img_width != resolution:
-            background_img = background_img.resize((resolution, int(img_height / img_width * resolution)))
-        elif resolution != 0 and img_width >= img_height and img_height != resolution:
-            background_img = background_img.resize((int(img_width / img_height * resolution), resolution))
-
-        # 保存修改后的图片
-        out_filename = os.path.join(out_dir, F"Mark_{image_name[0]}.{out_format}")
-        background_img.save(out_filename, dpi=(300, 300), quality=out_quality)
\ No newline at end of file
+        # 加水印后 从上到下 margin + img_height + watermark
+        with timer('compose'):
+            new_height = margin + img_height + layout.height
+            background_img = Image.new("RGB", (layout.width, new_height), 'white')
+            background_img.paste(img, (margin, margin))
+            background_img.paste(band, (0, new_height - layout.height))
+        return background_img
+
+    def _draw_scaled(self, img: 'Image.Image', exif_data: dict, manual: bool, timer: NullTimer | StageTimer, source_size: tuple[int, int], out_size: tuple[int, int]) -> 'Image.Image | None':
+        from PIL import Image
+        margin, layout = self._strip_layout(*source_size)
+        band = self._render_band(layout, exif_data, manual, timer)
+        if band is None:
+            return None
+        (left, top), photo_size, band_top = self._scaled_layout(*source_size, *out_size)
+        out_width, out_height = out_size
+        # 输出第 band_top 行起对应原图画布中的位置
+        source_height = margin + source_size[1] + layout.height
+        band_y = band_top * source_height / out_height - (margin + source_size[1])
+        with timer('scale'):
+            if band_y < 0:
+                # 取样位置略高于水印条时在上方补白
+                pad = math.ceil(-band_y)
+                padded = Image.new("RGB", (band.width, band.height + pad), 'white')
+                padded.paste(band, (0, pad))
+                band, band_y = padded, band_y + pad
+            # 与整图缩放相同的重采样方式
+            band = band.resize((out_width, out_height - band_top), box=(0, band_y, band.width, band.height))
+        if img.size != photo_size:
+            with timer('scale'):
+                img = img.resize(photo_size, Image.BICUBIC, reducing_gap=3.0)
+        with timer('compose'):
+            background_img = Image.new("RGB", out_size, 'white')
+            background_img.paste(img, (left, top))
+            background_img.paste(band, (0, band_top))
+        return background_img
@@ -0,0 +1,57 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import strip
+
+
+def make_photo(size: tuple[int, int], orientation: int=1, mode: str='RGB', exif: bool=True) -> bytes:
+    '''
+    生成一张 JPEG: 渐变加色块, 便于发现错位; exif 中带有水印所需的标签与方向.
+    '''
+    from PIL import Image, ImageDraw
+    from PIL.TiffImagePlugin import IFDRational
+    width, height = size
+    img = Image.linear_gradient('L').resize(size)
+    if mode == 'RGB':
+        img = Image.merge('RGB', (img, img.transpose(Image.Transpose.ROTATE_90).resize(size), Image.new('L', size, 96)))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((width // 8, height // 8, width // 3, height // 3), fill=(255, 0, 0) if mode == 'RGB' else 255)
+    info = Image.Exif()
+    if exif:
+        info[0x010F] = 'Canon'
+        info[0x0110] = 'Canon EOS R5'
+        info[0x0112] = orientation
+        info.get_ifd(0x8769).update({
+            0x9003: '2024:05:01 10:20:30',
+            0x829A: IFDRational(1, 250),
+            0x829D: IFDRational(28, 10),
+            0x8827: 200,
+            0x920A: IFDRational(50, 1),
+            0xA434: 'RF50mm F1.8 STM',
+        })
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90, exif=info.tobytes())
+    return buffer.getvalue()
+
+
+# 字体不随仓库提供, 没有时跳过需要绘制水印条的测试
+requires_fonts = pytest.mark.skipif(not os.path.exists(strip.FONT_FILE_1), reason='fonts are not installed')
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    '''
+    相机/镜头记录只保存在内存中, 元数据索引放在临时目录, 测试不修改 resources/data.
+    '''
+    import functools
+    import watermark
+    from records import RecordStore
+    monkeypatch.setattr(watermark, 'MetadataIndex', functools.partial(watermark.MetadataIndex, str(tmp_path / 'metadata.sqlite3')))
+    agent = watermark.WaterMarkAgent()
+    agent.records = RecordStore(None)
+    return agent
@@ -0,0 +1,44 @@
+'''
+照片直接解码到画布上(compose_in_place)时, 输出应与先解码再粘贴的结果逐字节相同.
+'''
+import sys
+
+import pytest
+from PIL import Image
+
+import ingest
+import watermark
+from conftest import make_photo, requires_fonts
+
+
+def _render(data: bytes, compose_in_place: bool, margin_ratio: float) -> bytes:
+    agent = watermark.WaterMarkAgent()
+    agent.compose_in_place = compose_in_place
+    agent.margin_ratio = margin_ratio
+    return agent.render(data, out_format='jpg', out_quality=95)
+
+
+@requires_fonts
+@pytest.mark.parametrize('orientation', [1, 3, 6, 8])
+@pytest.mark.parametrize('mode', ['RGB', 'L'])
+@pytest.mark.parametrize('margin_ratio', [0.0, 0.02])
+def test_compose_in_place_is_byte_identical(orientation, mode, margin_ratio):
+    data = make_photo((320, 240), orientation, mode)
+    assert _render(data, True, margin_ratio) == _render(data, False, margin_ratio)
+
+
+@requires_fonts
+def test_decode_into_falls_back_without_pillow_internals(monkeypatch):
+    data = make_photo((320, 240))
+    expected = _render(data, False, 0.0)
+    monkeypatch.setattr(ingest, '_decode_into_supported', True)
+    # 模拟内部接口已改变的 Pillow 版本: 只有 ingest 的调用失败, Pillow 自身的 load 照常工作
+    getdecoder = Image._getdecoder
+
+    def changed_getdecoder(*args):
+        if sys._getframe(1).f_globals.get('__name__') == 'ingest':
+            raise AttributeError('_getdecoder')
+        return getdecoder(*args)
+    monkeypatch.setattr(Image, '_getdecoder', changed_getdecoder)
+    assert _render(data, True, 0.0) == expected
+    assert not ingest._decode_into_supported
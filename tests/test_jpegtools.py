@@ -0,0 +1,95 @@
+'''
+无损拼接: 照片区域使用原图的压缩数据, 解码结果与原图一致, 水印条与常规输出一致.
+'''
+import io
+
+import pytest
+
+import jpegtools
+from conftest import make_photo, requires_fonts
+
+
+def _decode(data: bytes):
+    from PIL import Image, ImageOps
+    return ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+
+
+def _reencode(data: bytes, **options) -> bytes:
+    # 保留 exif 重新编码, 例如加入重启标记
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90, exif=img.info['exif'], **options)
+    return buffer.getvalue()
+
+
+def _max_diff(a, b) -> int:
+    from PIL import ImageChops
+    return max(high for _, high in ImageChops.difference(a, b).getextrema())
+
+
+def _render(agent, data: bytes, lossless: bool) -> bytes:
+    agent.lossless_jpeg = lossless
+    return agent.render(data, out_format='jpg', out_quality=90)
+
+
+@requires_fonts
+# 前置水印条(方向 3, 4)需要原图带有重启间隔
+@pytest.mark.parametrize('orientation, restart', [(1, False), (2, False), (1, True), (2, True), (3, True), (4, True)])
+def test_lossless_matches_source_and_normal_band(agent, orientation, restart):
+    data = make_photo((320, 240), orientation=orientation)
+    if restart:
+        data = _reencode(data, restart_marker_rows=1)
+    source = jpegtools.parse(data)
+    assert (source.restart_interval != 0) == restart
+    lossless = _render(agent, data, True)
+    normal = _render(agent, data, False)
+    if not restart:
+        # 照片的熵编码数据原样保留
+        assert data[source.scan_start:source.scan_end] in lossless
+    output, expected, photo = _decode(lossless), _decode(normal), _decode(data)
+    assert output.size == expected.size
+    width, height = photo.size
+    # 照片区域与原图的解码结果一致; 与水印条相邻的一行受色度上采样影响
+    assert _max_diff(output.crop((0, 0, width, height - 1)), photo.crop((0, 0, width, height - 1))) == 0
+    # 水印条按原图的量化表编码, 与常规输出相同(不含接缝行); 左右镜像后编码时色度的舍入略有不同
+    band = (0, height + 1, width, output.height)
+    assert _max_diff(output.crop(band), expected.crop(band)) <= (8 if orientation in (2, 3) else 0)
+
+
+@requires_fonts
+def test_unsupported_sources_fall_back_to_normal_rendering(agent):
+    cases = [
+        # 旋转 90 度的方向
+        make_photo((320, 240), orientation=6),
+        # 高度不是 MCU 高度的整数倍
+        make_photo((320, 250)),
+        # 前置水印条时原图没有重启间隔
+        make_photo((320, 240), orientation=3),
+        # 渐进式与优化哈夫曼表
+        _reencode(make_photo((320, 240)), progressive=True),
+        _reencode(make_photo((320, 240)), optimize=True),
+    ]
+    for data in cases:
+        assert _render(agent, data, True) == _render(agent, data, False)
+
+
+def test_restart_interval():
+    data = _reencode(make_photo((320, 240)), restart_marker_rows=1)
+    source = jpegtools.parse(data)
+    # 4:2:0 采样, MCU 为 16x16, 每行 20 个
+    assert source.mcu_size == (16, 16)
+    assert source.restart_interval == 20
+    assert jpegtools.header_restart_interval(data) == 20
+    source.orientation = 1
+    assert jpegtools.restart_interval(source, 40) == 20
+    source.orientation = 3
+    assert jpegtools.restart_interval(source, 32) == 20
+    assert jpegtools.restart_interval(source, 40) is None
+    source.orientation = 6
+    assert jpegtools.restart_interval(source, 32) is None
+    # 没有重启间隔时整张原图作为一个间隔
+    source = jpegtools.parse(make_photo((320, 240)))
+    source.orientation = 1
+    assert jpegtools.restart_interval(source, 40) == 20 * 15
+    assert jpegtools.header_restart_interval(make_photo((320, 240))) == 0
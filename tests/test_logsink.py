@@ -0,0 +1,33 @@
+'''
+界面日志通道: 多线程写入按行交出, 超出上限时丢弃最旧的行.
+'''
+import threading
+
+from logsink import LogSink
+
+
+def test_lines_from_threads_are_not_mixed():
+    sink = LogSink()
+
+    def work(name: str) -> None:
+        for i in range(200):
+            # 与 print 相同, 内容与换行分两次写入
+            sink.write(F"{name} {i}")
+            sink.write('\n')
+
+    threads = [threading.Thread(target=work, args=(F"t{n}",)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lines = sink.drain()
+    assert sorted(lines) == sorted(F"t{n} {i}" for n in range(4) for i in range(200))
+    assert sink.drain() == []
+
+
+def test_partial_lines_wait_and_old_lines_are_dropped():
+    sink = LogSink(maxlen=3)
+    assert sink.write('a\nb') == 3
+    assert sink.drain() == ['a']
+    sink.write('c\nd\ne\nf\n')
+    assert sink.drain() == ['d', 'e', 'f']
@@ -0,0 +1,95 @@
+'''
+输出清单(增量处理)与原子写入.
+'''
+import os
+
+import manifest
+from conftest import make_photo, requires_fonts
+
+
+def _photos(folder, names: list) -> list:
+    folder.mkdir(exist_ok=True)
+    files = []
+    for name in names:
+        path = folder / name
+        path.write_bytes(make_photo((160, 120)))
+        files.append(str(path))
+    return files
+
+
+def _statuses(agent, in_dir, out_dir, **kwargs) -> dict:
+    os.makedirs(out_dir, exist_ok=True)
+    statuses = {}
+    for job in agent.iter_run(str(in_dir), str(out_dir), out_quality=90, **kwargs):
+        statuses[os.path.basename(job.image_file)] = job.status
+    return statuses
+
+
+@requires_fonts
+def test_incremental_skips_unchanged_photos(agent, tmp_path):
+    _photos(tmp_path / 'in', ['a.jpg', 'b.jpg'])
+    out_dir = tmp_path / 'out'
+    assert _statuses(agent, tmp_path / 'in', out_dir, incremental=True) == {'a.jpg': 'ok', 'b.jpg': 'ok'}
+    assert _statuses(agent, tmp_path / 'in', out_dir, incremental=True) == {'a.jpg': 'skipped', 'b.jpg': 'skipped'}
+    # 源文件改变或渲染参数改变时重新渲染
+    (tmp_path / 'in' / 'a.jpg').write_bytes(make_photo((200, 120)))
+    assert _statuses(agent, tmp_path / 'in', out_dir, incremental=True) == {'a.jpg': 'ok', 'b.jpg': 'skipped'}
+    agent.margin_ratio = 0.02
+    assert _statuses(agent, tmp_path / 'in', out_dir, incremental=True) == {'a.jpg': 'ok', 'b.jpg': 'ok'}
+
+
+@requires_fonts
+def test_incremental_after_run2(agent, tmp_path):
+    files = _photos(tmp_path / 'in', ['a.jpg'])
+    out_dir = tmp_path / 'out'
+    assert _statuses(agent, tmp_path / 'in', out_dir) == {'a.jpg': 'ok'}
+    # run2 与不使用索引的 run 也记录源文件指纹, 之后的增量处理可以判断
+    assert agent.run2(files, 'Sony', 'ILCE-7M4', 'FE 35mm F1.4 GM', str(out_dir), out_quality=90) == []
+    assert _statuses(agent, tmp_path / 'in', out_dir, use_index=False) == {'a.jpg': 'ok'}
+    assert _statuses(agent, tmp_path / 'in', out_dir, incremental=True) == {'a.jpg': 'skipped'}
+
+
+@requires_fonts
+def test_same_name_in_other_folder_is_not_current(agent, tmp_path):
+    # 两个子目录中的同名文件输出到同一目录, 清单中的记录属于另一个源文件
+    first = _photos(tmp_path / 'one', ['a.jpg'])[0]
+    second = _photos(tmp_path / 'two', ['a.jpg'])[0]
+    os.utime(second, ns=(os.stat(first).st_atime_ns, os.stat(first).st_mtime_ns))
+    out_dir = tmp_path / 'out'
+    assert _statuses(agent, tmp_path / 'one', out_dir, incremental=True) == {'a.jpg': 'ok'}
+    assert _statuses(agent, tmp_path / 'two', out_dir, incremental=True) == {'a.jpg': 'ok'}
+
+
+def test_manifest_without_source_fingerprint_is_not_current(tmp_path):
+    out_file = tmp_path / 'Mark_a.jpg'
+    manifest.write_atomic(str(out_file), b'data')
+    out_manifest = manifest.OutputManifest(str(tmp_path))
+    out_manifest.record(str(tmp_path / 'a.jpg'), None, {}, str(out_file), manifest.digest(b'data'))
+    reloaded = manifest.OutputManifest(str(tmp_path))
+    assert not reloaded.is_current(str(out_file), str(tmp_path / 'a.jpg'), (4, 0), {})
+
+
+def test_write_atomic_leaves_no_partial_file(tmp_path):
+    out_file = tmp_path / 'out.bin'
+    manifest.write_atomic(str(out_file), b'old')
+    try:
+        with manifest.open_atomic(str(out_file)) as f:
+            f.write(b'new, half written')
+            raise RuntimeError('crash')
+    except RuntimeError:
+        pass
+    assert out_file.read_bytes() == b'old'
+    assert os.listdir(tmp_path) == ['out.bin']
+    # 权限与直接创建的文件相同(由 umask 决定)
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(out_file).st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_manifest_keeps_last_record_and_skips_torn_line(tmp_path):
+    out_manifest = manifest.OutputManifest(str(tmp_path))
+    for digest in ('1', '2'):
+        out_manifest.record(str(tmp_path / 'a.jpg'), (1, 2), {}, str(tmp_path / 'Mark_a.jpg'), digest)
+    with open(out_manifest.path, 'a', encoding='utf-8') as f:
+        f.write('{"output": "Mark_b.jpg", "sou')
+    assert manifest.OutputManifest(str(tmp_path)).entries['Mark_a.jpg']['sha256'] == '2'
@@ -0,0 +1,65 @@
+'''
+exif 索引: 以文件大小与修改时间判断记录是否失效.
+'''
+import os
+
+from metaindex import MetadataIndex, fingerprint
+from conftest import make_photo, requires_fonts
+
+EXIF = {'CameraMaker': 'Canon', 'Camera': 'Canon EOS R5', 'LenModel': 'RF50mm F1.8 STM'}
+
+
+def _touch(path, delta_ns: int) -> None:
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + delta_ns))
+
+
+def test_records_are_invalidated_by_size_or_mtime(tmp_path):
+    files = []
+    for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+        path = tmp_path / name
+        path.write_bytes(b'x' * 10)
+        files.append(str(path))
+    index = MetadataIndex(str(tmp_path / 'data' / 'index.sqlite3'), flush_size=2)
+    for image_file in files:
+        index.put(image_file, fingerprint(image_file), EXIF)
+    # 无法读取(没有指纹)的文件不记录
+    index.put(str(tmp_path / 'missing.jpg'), fingerprint(str(tmp_path / 'missing.jpg')), EXIF)
+    index.flush()
+    assert index.get_many((f, fingerprint(f)) for f in files) == {f: EXIF for f in files}
+
+    (tmp_path / 'a.jpg').write_bytes(b'x' * 11)
+    _touch(tmp_path / 'b.jpg', 1000)
+    # 相对路径与绝对路径指向同一条记录, 以传入的路径返回
+    relative = os.path.relpath(files[2])
+    assert index.get_many((f, fingerprint(f)) for f in files[:2] + [relative]) == {relative: EXIF}
+    index.close()
+
+    # 其他连接读取到已提交的记录; 删除文件已改变或不存在的记录
+    os.remove(files[2])
+    index = MetadataIndex(str(tmp_path / 'data' / 'index.sqlite3'))
+    assert index.prune() == 3
+    # 没有 exif 的文件同样记录
+    index.put(files[0], fingerprint(files[0]), {})
+    assert index.prune() == 0
+    assert index.get_many([(files[0], fingerprint(files[0]))]) == {files[0]: {}}
+    index.close()
+
+
+@requires_fonts
+def test_batch_run_reuses_index(agent, tmp_path):
+    in_dir = tmp_path / 'in'
+    in_dir.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        (in_dir / name).write_bytes(make_photo((160, 120)))
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+
+    def indexed(**kwargs) -> dict:
+        return {os.path.basename(job.image_file): (job.status, job.indexed) for job in agent.iter_run(str(in_dir), str(out_dir), out_quality=90, **kwargs)}
+
+    assert indexed() == {'a.jpg': ('ok', False), 'b.jpg': ('ok', False)}
+    assert indexed() == {'a.jpg': ('ok', True), 'b.jpg': ('ok', True)}
+    _touch(in_dir / 'a.jpg', 1000)
+    assert indexed() == {'a.jpg': ('ok', False), 'b.jpg': ('ok', True)}
+    assert indexed(use_index=False) == {'a.jpg': ('ok', False), 'b.jpg': ('ok', False)}
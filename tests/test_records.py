@@ -0,0 +1,105 @@
+'''
+相机/镜头记录: 日志与快照, 多进程同时追加, 以及只在写入输出文件时记录.
+'''
+import os
+import json
+
+from records import RecordStore
+from pipeline import RenderSettings
+from conftest import make_photo, requires_fonts
+
+
+@requires_fonts
+def test_in_memory_rendering_does_not_write_records(agent, tmp_path):
+    records_file = tmp_path / 'data' / 'records.json'
+    agent.records = RecordStore(str(records_file), flush_size=1)
+    photo = tmp_path / 'a.jpg'
+    photo.write_bytes(make_photo((160, 120)))
+    agent.render(photo.read_bytes(), out_quality=90)
+    assert [job.status for job in agent.render_many([photo.read_bytes()], out_quality=90)] == ['ok']
+    jobs = list(agent.iter_files([str(photo)], RenderSettings(None, 'jpg', 90, 0), use_index=False))
+    assert [job.status for job in jobs] == ['ok']
+    assert not (tmp_path / 'data').exists()
+
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    jobs = list(agent.iter_files([str(photo)], RenderSettings(str(out_dir), 'jpg', 90, 0), use_index=False))
+    assert [job.status for job in jobs] == ['ok']
+    assert RecordStore(str(records_file)).models('Canon') == ['Canon EOS R5']
+
+
+def _add_lenses(path: str, prefix: str, count: int) -> None:
+    # 每条记录立即写入日志, 日志较短时即合并, 与其他进程的写入和合并交错
+    store = RecordStore(path, flush_size=1, compact_size=8)
+    for i in range(count):
+        store.add('Canon', F"{prefix} body", F"{prefix} lens {i}")
+    store.save()
+
+
+def test_journal_is_read_by_other_stores(tmp_path):
+    path = str(tmp_path / 'records.json')
+    # 已有的快照
+    with open(path, 'w') as f:
+        json.dump({'Camera_records': {'Canon': ['Canon EOS R5']}, 'Lens_records': ['RF50mm F1.8 STM']}, f)
+    first = RecordStore(path, flush_size=2)
+    reader = RecordStore(path)
+    assert reader.lenses() == ['RF50mm F1.8 STM']
+    first.add('Sony', 'ILCE-7M4', 'FE 35mm F1.4 GM')
+    # 未写满 flush_size 时只在内存中
+    assert reader.brands() == ['Canon']
+    first.add('Canon', 'Canon EOS R5', 'RF24-70mm F2.8 L IS USM')
+    assert reader.brands() == ['Canon', 'Sony']
+    assert reader.models('Sony') == ['ILCE-7M4']
+    assert reader.lenses() == ['RF50mm F1.8 STM', 'FE 35mm F1.4 GM', 'RF24-70mm F2.8 L IS USM']
+    # 快照只在合并时重写
+    with open(path) as f:
+        assert json.load(f)['Lens_records'] == ['RF50mm F1.8 STM']
+    first.save(compact=True)
+    with open(path) as f:
+        assert json.load(f) == {'Camera_records': {'Canon': ['Canon EOS R5'], 'Sony': ['ILCE-7M4']}, 'Lens_records': ['RF50mm F1.8 STM', 'FE 35mm F1.4 GM', 'RF24-70mm F2.8 L IS USM']}
+    assert os.path.getsize(first.journal_path) == 0
+    # 快照重写后重新读取, 记录不重复
+    assert reader.lenses() == ['RF50mm F1.8 STM', 'FE 35mm F1.4 GM', 'RF24-70mm F2.8 L IS USM']
+    reader.add('Nikon', 'Z 8', '')
+    reader.save()
+    assert RecordStore(path).brands() == ['Canon', 'Sony', 'Nikon']
+
+
+def test_torn_journal_line_is_skipped(tmp_path):
+    path = str(tmp_path / 'records.json')
+    store = RecordStore(path, flush_size=1)
+    store.add('Canon', 'Canon EOS R5', '')
+    # 写入中途崩溃留下的不完整的行
+    with open(store.journal_path, 'ab') as f:
+        f.write(b'["Sony", "ILCE')
+    assert RecordStore(path).brands() == ['Canon']
+    other = RecordStore(path, flush_size=1)
+    other.add('Nikon', 'Z 8', '')
+    assert RecordStore(path).brands() == ['Canon', 'Nikon']
+
+
+def test_concurrent_processes_do_not_lose_records(tmp_path):
+    import multiprocessing
+    path = str(tmp_path / 'records.json')
+    processes = [multiprocessing.Process(target=_add_lenses, args=(path, F"p{i}", 20)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    store = RecordStore(path)
+    assert sorted(store.models('Canon')) == [F"p{i} body" for i in range(4)]
+    assert sorted(store.lenses()) == sorted(F"p{i} lens {j}" for i in range(4) for j in range(20))
+
+
+def test_memory_store_hands_over_new_records(tmp_path):
+    worker = RecordStore(None)
+    worker.add_exif({'CameraMaker': 'CANON INC.', 'Camera': 'Canon EOS R5', 'LenModel': 'RF50mm F1.8 STM'})
+    worker.add_exif({'CameraMaker': 'CANON INC.', 'Camera': 'Canon EOS R5'})
+    assert worker.take_new() == [('Canon', 'Canon EOS R5', 'RF50mm F1.8 STM')]
+    assert worker.take_new() == []
+    worker.save()
+    main = RecordStore(str(tmp_path / 'records.json'))
+    main.merge([('Canon', 'Canon EOS R5', 'RF50mm F1.8 STM')])
+    main.save()
+    assert RecordStore(str(tmp_path / 'records.json')).lenses() == ['RF50mm F1.8 STM']
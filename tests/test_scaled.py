@@ -0,0 +1,34 @@
+'''
+1080P/2k 输出在解码时缩小照片, 水印条部分应与先按原图加水印再整图缩放的结果相同.
+'''
+import pytest
+from PIL import Image, ImageChops
+
+import watermark
+from conftest import make_photo, requires_fonts
+
+
+def _old_path(agent: watermark.WaterMarkAgent, data: bytes, resolution: int) -> Image.Image:
+    # 先按原图分辨率加水印, 再缩放整张图片
+    canvas = agent.render(data, out_format=None)
+    return canvas.resize(agent._output_size(canvas.width, canvas.height, resolution))
+
+
+@requires_fonts
+@pytest.mark.parametrize('orientation', [1, 6])
+@pytest.mark.parametrize('margin_ratio', [0.0, 0.03])
+@pytest.mark.parametrize('resolution_key', ['1080P', '2k'])
+def test_scaled_band_matches_full_size_resize(orientation, margin_ratio, resolution_key):
+    agent = watermark.WaterMarkAgent()
+    agent.margin_ratio = margin_ratio
+    data = make_photo((4800, 3200), orientation)
+    old = _old_path(agent, data, watermark.OUT_RESOLUTION[resolution_key])
+    new = agent.render(data, out_format=None, resolution_key=resolution_key)
+    assert new.size == old.size
+
+    width, height = (3200, 4800) if orientation == 6 else (4800, 3200)
+    _, _, band_top = agent._scaled_layout(width, height, *new.size)
+    # 第一行与照片相邻, 整图缩放时混有照片的像素
+    box = (0, band_top + 1, new.width, new.height)
+    diff = ImageChops.difference(old.crop(box), new.crop(box))
+    assert max(high for _, high in diff.getextrema()) <= 1
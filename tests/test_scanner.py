@@ -0,0 +1,84 @@
+'''
+目录扫描: include/exclude、max_depth 与 sniff, 结果与 os.walk 一致.
+'''
+import os
+import threading
+
+import pytest
+
+from scanner import Scanner, sniff
+from conftest import make_photo
+
+
+@pytest.fixture
+def tree(tmp_path):
+    files = ('a.jpg', 'b.PNG', 'c.txt', 'noext', 'raw/d.jpg', 'raw/e.heic', 'sub/f.jpeg', 'sub/deep/g.jpg', 'sub/deep/skip_h.jpg')
+    for rel in files:
+        path = tmp_path / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'plain text' if rel == 'c.txt' else make_photo((16, 16)))
+    return tmp_path
+
+
+def _scan(scanner: Scanner, root) -> list:
+    return sorted(os.path.relpath(path, root).replace(os.sep, '/') for path in scanner.scan(str(root)))
+
+
+def test_scan_by_extension(tree):
+    assert _scan(Scanner(), tree) == ['a.jpg', 'b.PNG', 'raw/d.jpg', 'raw/e.heic', 'sub/deep/g.jpg', 'sub/deep/skip_h.jpg', 'sub/f.jpeg']
+
+
+def test_include_matches_name_or_relative_path(tree):
+    assert _scan(Scanner(include=['*.jpg']), tree) == ['a.jpg', 'raw/d.jpg', 'sub/deep/g.jpg', 'sub/deep/skip_h.jpg']
+    assert _scan(Scanner(include=['sub/*']), tree) == ['sub/deep/g.jpg', 'sub/deep/skip_h.jpg', 'sub/f.jpeg']
+
+
+def test_exclude_skips_files_and_folders(tree):
+    assert _scan(Scanner(exclude=['raw', 'skip_*']), tree) == ['a.jpg', 'b.PNG', 'sub/deep/g.jpg', 'sub/f.jpeg']
+    assert _scan(Scanner(exclude=['sub/deep']), tree) == ['a.jpg', 'b.PNG', 'raw/d.jpg', 'raw/e.heic', 'sub/f.jpeg']
+
+
+def test_max_depth(tree):
+    assert _scan(Scanner(max_depth=0), tree) == ['a.jpg', 'b.PNG']
+    assert _scan(Scanner(max_depth=1), tree) == ['a.jpg', 'b.PNG', 'raw/d.jpg', 'raw/e.heic', 'sub/f.jpeg']
+
+
+def test_sniff_uses_file_header(tree):
+    # e.heic 实际是 JPEG; 没有扩展名的 JPEG 也能找到, 文本文件不算
+    assert _scan(Scanner(sniff=True, max_depth=1), tree) == ['a.jpg', 'b.PNG', 'noext', 'raw/d.jpg', 'raw/e.heic', 'sub/f.jpeg']
+    assert sniff(b'\x89PNG\r\n\x1a\n\0\0\0\0') == 'png'
+    assert sniff(b'\0\0\0\x18ftypheic') == 'heif'
+    assert sniff(b'GIF89a') is None
+
+
+def test_scan_file_yields_itself(tree):
+    assert list(Scanner().scan(str(tree / 'c.txt'))) == [str(tree / 'c.txt')]
+
+
+def test_parallel_scan_finds_every_file(tmp_path):
+    # 每个目录都有图片和多个子目录, 多个线程同时扫描时不能在交出父目录的图片之前结束
+    expected = []
+    for i in range(8):
+        for j in range(8):
+            folder = tmp_path / F"d{i}" / F"e{j}"
+            folder.mkdir(parents=True)
+            (folder / 'x.jpg').write_bytes(b'')
+            expected.append(F"d{i}/e{j}/x.jpg")
+        (tmp_path / F"d{i}" / 'y.jpg').write_bytes(b'')
+        expected.append(F"d{i}/y.jpg")
+    (tmp_path / 'z.jpg').write_bytes(b'')
+    expected.append('z.jpg')
+    scanner = Scanner(workers=8)
+    for _ in range(20):
+        assert _scan(scanner, tmp_path) == sorted(expected)
+
+
+def test_closing_scan_stops_threads(tmp_path):
+    for i in range(50):
+        (tmp_path / F"d{i}").mkdir()
+        (tmp_path / F"d{i}" / 'x.jpg').write_bytes(b'')
+    threads = threading.active_count()
+    it = Scanner(workers=4).scan(str(tmp_path))
+    next(it)
+    it.close()
+    assert threading.active_count() == threads
@@ -0,0 +1,100 @@
+'''
+按预估内存准入(MemoryBudget)与流水线中的使用.
+'''
+import threading
+import time
+
+import pytest
+
+import pipeline
+import scheduler
+from pipeline import RenderJob
+from conftest import make_photo, requires_fonts
+
+
+def test_parse_size():
+    assert scheduler.parse_size('512M') == 512 * 1024 ** 2
+    assert scheduler.parse_size('1.5g') == int(1.5 * 1024 ** 3)
+    assert scheduler.parse_size('2GiB') == 2 * 1024 ** 3
+    assert scheduler.parse_size('0') is None
+    with pytest.raises(ValueError):
+        scheduler.parse_size('-1G')
+
+
+def test_budget_admits_within_limit():
+    budget = scheduler.MemoryBudget(100)
+    assert budget.acquire(60, blocking=False)
+    assert budget.acquire(40, blocking=False)
+    assert not budget.acquire(1, blocking=False)
+    budget.release(60)
+    assert budget.acquire(50, blocking=False)
+    assert budget.peak == 100 and budget.admitted == 3
+
+
+def test_oversized_job_runs_alone():
+    budget = scheduler.MemoryBudget(100)
+    # 超过预算的任务在没有其他任务时准入
+    assert budget.acquire(500, blocking=False)
+    assert not budget.acquire(1, blocking=False)
+    budget.release(500)
+    assert budget.acquire(10, blocking=False)
+    assert not budget.acquire(500, blocking=False)
+
+
+def test_blocked_acquire_waits_for_release_or_stop():
+    budget = scheduler.MemoryBudget(100)
+    budget.acquire(80)
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(budget.acquire(50)))
+    waiter.start()
+    time.sleep(0.2)
+    assert not admitted
+    budget.release(80)
+    waiter.join(5)
+    assert admitted == [True]
+
+    stop = threading.Event()
+    stop.set()
+    assert not budget.acquire(80, stop)
+
+
+def test_pipeline_keeps_in_flight_jobs_within_budget():
+    budget = scheduler.MemoryBudget(100)
+    lock = threading.Lock()
+    in_flight = []
+    samples = []
+
+    def stage(job: RenderJob) -> None:
+        with lock:
+            in_flight.append(job.reserved)
+            samples.append(list(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.remove(job.reserved)
+
+    jobs = []
+    for i, cost in enumerate([30, 30, 30, 30, 250, 30, 30]):
+        job = RenderJob(i, F"{i}.jpg", None)
+        job.reserved = cost
+        jobs.append(job)
+    done = list(pipeline.run_pipeline(jobs, [(stage, 4)], maxsize=8, budget=budget))
+    assert len(done) == len(jobs) and budget.in_use == 0
+    for sample in samples:
+        assert sum(sample) <= 100 or sample == [250]
+    # 限制内的小图同时处理
+    assert max(len(sample) for sample in samples) == 3
+
+
+@requires_fonts
+def test_no_estimate_without_limit(agent, tmp_path, monkeypatch):
+    (tmp_path / 'a.jpg').write_bytes(make_photo((160, 120)))
+    calls = []
+    estimate = agent._estimate_memory
+    monkeypatch.setattr(agent, '_estimate_memory', lambda job: calls.append(job) or estimate(job))
+    for limit, expected in ((None, 0), (1 << 30, 1)):
+        agent.memory_budget = limit
+        calls.clear()
+        jobs = list(agent.iter_files([str(tmp_path / 'a.jpg')], pipeline.RenderSettings(None, 'jpg', 90, 0), backend='thread', use_index=False))
+        assert [job.status for job in jobs] == ['ok']
+        assert len(calls) == expected
+        assert bool(agent.memory_report) == bool(limit)
@@ -0,0 +1,104 @@
+'''
+分条渲染: 逐条编码的 JPEG/PNG 与照片的逐段解码, 输出与常规方式的像素相同.
+'''
+import io
+
+import pytest
+
+import tiled
+import jpegtools
+from conftest import make_photo, requires_fonts
+
+# 每条 4096 像素, 宽 320 的图片每条 16 行
+SMALL_STRIP_PIXELS = 4096
+
+
+@pytest.fixture
+def small_strips(monkeypatch):
+    # 分条大小是参数默认值, 定义时已经确定
+    monkeypatch.setattr(tiled.PhotoRows.__init__, '__defaults__', (SMALL_STRIP_PIXELS,))
+    monkeypatch.setattr(tiled.TiledImage.write, '__defaults__', (None, tiled.NULL_TIMER, SMALL_STRIP_PIXELS))
+
+
+def _decode(data: bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+def _same_pixels(a, b) -> bool:
+    from PIL import ImageChops
+    return a.size == b.size and ImageChops.difference(a.convert('RGB'), b.convert('RGB')).getbbox() is None
+
+
+def _with_restart_markers(data: bytes) -> bytes:
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90, exif=img.info['exif'], restart_marker_rows=1)
+    return buffer.getvalue()
+
+
+@requires_fonts
+@pytest.mark.parametrize('out_format', ['jpg', 'png'])
+@pytest.mark.parametrize('restart', [False, True])
+def test_tiled_matches_normal_render(agent, small_strips, out_format, restart):
+    data = make_photo((320, 250))
+    if restart:
+        data = _with_restart_markers(data)
+    for margin_ratio in (0.0, 0.03):
+        agent.margin_ratio = margin_ratio
+        agent.tiled_threshold = None
+        normal = agent.render(data, out_format=out_format, out_quality=90)
+        agent.tiled_threshold = 1
+        output = agent.render(data, out_format=out_format, out_quality=90)
+        assert output != normal
+        assert _same_pixels(_decode(output), _decode(normal))
+
+
+def test_photo_rows_streams_jpeg_with_restart_markers():
+    from PIL import Image
+    for data, streamed in ((make_photo((320, 250)), False), (_with_restart_markers(make_photo((320, 250))), True)):
+        expected = _decode(data)
+        photo = tiled.PhotoRows(Image.open(io.BytesIO(data)), data, SMALL_STRIP_PIXELS)
+        assert photo.streamed == streamed
+        # 读取的行数与分段的边界不对齐
+        canvas = Image.new('RGB', (340, 260), 'white')
+        y = 0
+        for rows in (7, 30, 16, 100, 97):
+            photo.paste_into(canvas, 10, 5 + y, rows)
+            y += rows
+        photo.close()
+        assert _same_pixels(canvas.crop((10, 5, 330, 255)), expected)
+
+
+@pytest.mark.parametrize('subsampling', [0, 2])
+def test_strip_writer_matches_single_encode(subsampling):
+    img = _decode(make_photo((300, 150)))
+    chunks = []
+    writer = jpegtools.StripWriter(chunks.append, img.width, img.height, 85, (300, 300), subsampling)
+    for y in range(0, img.height, jpegtools.StripWriter.STRIP_ALIGN * 2):
+        writer.add(img.crop((0, y, img.width, min(y + jpegtools.StripWriter.STRIP_ALIGN * 2, img.height))))
+    writer.close()
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=85, subsampling=subsampling, dpi=(300, 300))
+    output = _decode(b''.join(chunks))
+    assert output.info['dpi'] == (300, 300)
+    assert _same_pixels(output, _decode(buffer.getvalue()))
+
+
+def test_png_strip_writer_is_lossless():
+    from PIL import Image
+    img = _decode(make_photo((300, 150)))
+    exif = Image.open(io.BytesIO(make_photo((16, 16)))).info['exif']
+    chunks = []
+    writer = tiled.PngStripWriter(chunks.append, img.width, img.height, (300, 300), exif=exif)
+    for y in range(0, img.height, 40):
+        writer.add(img.crop((0, y, img.width, min(y + 40, img.height))))
+    writer.close()
+    output = _decode(b''.join(chunks))
+    assert output.format == 'PNG'
+    assert tuple(round(d) for d in output.info['dpi']) == (300, 300)
+    assert output.getexif()[0x0110] == 'Canon EOS R5'
+    assert _same_pixels(output, img)
@@ -0,0 +1,49 @@
+'''
+监视模式按 agent.scanner 的规则识别图片, 与批量处理找到的文件相同.
+'''
+import os
+
+import pytest
+
+import watermark
+from scanner import Scanner
+from watcher import WatchService
+from conftest import make_photo
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'in'
+    for rel in ('a.jpg', 'b.png', 'skip_c.jpg', 'noext', 'notes.txt', 'raw/d.jpg', 'sub/e.JPG', 'sub/deep/f.jpg', '.hidden.jpg'):
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'not an image' if rel == 'notes.txt' else make_photo((16, 16)))
+    return root
+
+
+@pytest.mark.parametrize('scanner', [
+    Scanner(),
+    Scanner(include=['*.jpg']),
+    Scanner(exclude=['raw', 'skip_*']),
+    Scanner(max_depth=1),
+    Scanner(max_depth=0, sniff=True),
+    Scanner(sniff=True, exclude=['sub/deep']),
+], ids=['default', 'include', 'exclude', 'max_depth', 'sniff_depth0', 'sniff_exclude_path'])
+def test_watch_accepts_the_same_files_as_scan(tree, tmp_path, scanner):
+    agent = watermark.WaterMarkAgent()
+    agent.scanner = scanner
+    service = WatchService(agent, [str(tree)], str(tmp_path / 'out'), use_inotify=False)
+    watched = sorted(service.watcher._scan(str(tree)))
+    # 监视模式另外忽略以 . 开头的文件
+    scanned = sorted(path for path in scanner.scan(str(tree)) if not os.path.basename(path).startswith('.'))
+    assert watched == scanned
+    for path in scanned:
+        assert service._accept(path)
+
+
+def test_watch_ignores_output_folder_inside_input(tree):
+    agent = watermark.WaterMarkAgent()
+    service = WatchService(agent, [str(tree)], str(tree / 'sub'), use_inotify=False)
+    assert service._accept(str(tree / 'a.jpg'))
+    assert not service._accept(str(tree / 'sub'))
+    assert not service._accept(str(tree / 'sub' / 'e.JPG'))